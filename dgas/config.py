@@ -74,7 +74,12 @@ def setup_config():
 
     config.set_from_os_environ('database', 'max_size', 'MAX_DATABASE_CONNECTIONS')
     config.set_from_os_environ('database', 'min_size', 'MIN_DATABASE_CONNECTIONS')
+    config.set_from_os_environ('database', 'ethereum_codecs', 'PGSQL_ETHEREUM_CODECS')
+    config.set_from_os_environ('database_shards', 'dsns', 'DATABASE_SHARD_URLS')
     config.set_from_os_environ('redis', 'url', 'REDIS_URL')
+    config.set_from_os_environ('redis', 'replica_url', 'REDIS_REPLICA_URL')
+    config.set_from_os_environ('redis', 'sentinels', 'REDIS_SENTINELS')
+    config.set_from_os_environ('redis', 'sentinel_master', 'REDIS_SENTINEL_MASTER')
 
     config.set_from_os_environ('s3', 'aws_access_key_id', 'AWS_ACCESS_KEY_ID')
     config.set_from_os_environ('s3', 'aws_secret_access_key', 'AWS_SECRET_ACCESS_KEY')
@@ -1,12 +1,19 @@
 import asyncio
 import asyncpg
+import hashlib
 import os
+import regex
 import sys
 import ssl
+import struct
+import weakref
 from collections import ItemsView
+from decimal import Decimal
 from dgas.config import config
 from dgas.errors import DatabaseError
 from dgas.log import log
+from dgas.utils import (
+    parse_int, parse_boolean, validate_hex_string, validate_int_string, validate_decimal_string)
 
 if hasattr(asyncpg.pool.Pool, '_acquire_impl'):
     # pre 0.12.0 version
@@ -39,6 +46,133 @@ SSL_CTX = ssl.create_default_context()
 SSL_CTX.check_hostname = False
 SSL_CTX.verify_mode = ssl.CERT_NONE
 
+_NUMERIC_HEADER = struct.Struct('!hhHh')
+_NUMERIC_POS = 0x0000
+_NUMERIC_NEG = 0x4000
+_NUMERIC_NAN = 0xC000
+_NUMERIC_NBASE = 10000
+
+def _numeric_value(value):
+    """converts `value` to an int, or to a Decimal if it isn't an int or
+    an int string, without going through float"""
+    if isinstance(value, int):
+        return value
+    if isinstance(value, bytes):
+        value = value.decode('ascii', 'replace')
+    if isinstance(value, str):
+        if validate_hex_string(value) or validate_int_string(value):
+            return parse_int(value)
+        if not validate_decimal_string(value):
+            raise TypeError("expected int or Decimal, got {!r}".format(value))
+        return Decimal(value)
+    if isinstance(value, float):
+        # the shortest repr, so 0.1 is stored as 0.1
+        return Decimal(repr(value))
+    if isinstance(value, Decimal):
+        return value
+    raise TypeError("expected int or Decimal, got {!r}".format(value))
+
+def _encode_numeric_int(value):
+    """encodes an int, Decimal, float or numeric string as the binary
+    representation of a postgres NUMERIC"""
+    value = _numeric_value(value)
+    if isinstance(value, Decimal):
+        return _encode_numeric_decimal(value)
+    sign = _NUMERIC_NEG if value < 0 else _NUMERIC_POS
+    value = abs(value)
+    digits = []
+    while value:
+        value, digit = divmod(value, _NUMERIC_NBASE)
+        digits.append(digit)
+    weight = len(digits) - 1 if digits else 0
+    # trailing zero digits are implied by the weight
+    while digits and digits[0] == 0:
+        digits.pop(0)
+    digits.reverse()
+    return _NUMERIC_HEADER.pack(len(digits), weight, sign, 0) + \
+        struct.pack('!{}H'.format(len(digits)), *digits)
+
+def _encode_numeric_decimal(value):
+    if value.is_nan():
+        return _NUMERIC_HEADER.pack(0, 0, _NUMERIC_NAN, 0)
+    if not value.is_finite():
+        raise ValueError("cannot store {!r} in NUMERIC".format(value))
+    sign, digits, exponent = value.as_tuple()
+    digits = ''.join(str(digit) for digit in digits)
+    if exponent > 0:
+        digits += '0' * exponent
+        exponent = 0
+    scale = -exponent
+    digits = digits.rjust(scale + 1, '0')
+    integer, fraction = digits[:len(digits) - scale], digits[len(digits) - scale:]
+    # split into base 10000 digits either side of the decimal point
+    integer = integer.rjust((len(integer) + 3) // 4 * 4, '0')
+    fraction = fraction.ljust((len(fraction) + 3) // 4 * 4, '0')
+    groups = [int(integer[i:i + 4]) for i in range(0, len(integer), 4)]
+    weight = len(groups) - 1
+    groups += [int(fraction[i:i + 4]) for i in range(0, len(fraction), 4)]
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        weight = 0
+    return _NUMERIC_HEADER.pack(len(groups), weight, _NUMERIC_NEG if sign else _NUMERIC_POS, scale) + \
+        struct.pack('!{}H'.format(len(groups)), *groups)
+
+def _decode_numeric_int(data):
+    """decodes the binary representation of a postgres NUMERIC into an int,
+    or into a Decimal if it has a non zero scale (e.g. NUMERIC(10, 2)
+    columns)"""
+    ndigits, weight, sign, scale = _NUMERIC_HEADER.unpack_from(data)
+    if sign == _NUMERIC_NAN:
+        return Decimal('NaN')
+    if sign not in (_NUMERIC_POS, _NUMERIC_NEG):
+        raise ValueError("cannot convert special NUMERIC value")
+    digits = struct.unpack_from('!{}H'.format(ndigits), data, _NUMERIC_HEADER.size)
+    if scale == 0:
+        value = 0
+        for i in range(weight + 1):
+            value = value * _NUMERIC_NBASE + (digits[i] if i < ndigits else 0)
+        return -value if sign == _NUMERIC_NEG else value
+    value = 0
+    for digit in digits:
+        value = value * _NUMERIC_NBASE + digit
+    exponent = 4 * (weight - ndigits + 1)
+    value = str(value)
+    if exponent > -scale:
+        value += '0' * (exponent + scale)
+    elif exponent < -scale:
+        # digits past the scale are always zero
+        value = value[:exponent + scale] or '0'
+    return Decimal((1 if sign == _NUMERIC_NEG else 0, tuple(int(d) for d in value), -scale))
+
+def _encode_hex_bytea(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value)
+    if isinstance(value, str):
+        if value[:2] in ('0x', '0X'):
+            value = value[2:]
+        if len(value) % 2:
+            value = '0' + value
+        return bytes.fromhex(value)
+    raise TypeError("expected hex string or bytes, got {!r}".format(value))
+
+def _decode_hex_bytea(data):
+    return '0x' + data.hex()
+
+async def init_ethereum_codecs(con):
+    """Registers binary codecs on the connection that convert BYTEA values
+    (including domains based on BYTEA) to and from 0x prefixed hex strings,
+    and NUMERIC values to and from python ints (or Decimals for values
+    with a non zero scale), for storing addresses, hashes and wei values
+    without per row conversions"""
+    await con.set_type_codec('bytea', schema='pg_catalog', format='binary',
+                             encoder=_encode_hex_bytea, decoder=_decode_hex_bytea)
+    await con.set_type_codec('numeric', schema='pg_catalog', format='binary',
+                             encoder=_encode_numeric_int, decoder=_decode_numeric_int)
+
 def create_pool(dsn=None, *,
                 min_size=10,
                 max_size=10,
@@ -49,7 +183,12 @@ def create_pool(dsn=None, *,
                 init=None,
                 ssl=None,
                 connection_class=asyncpg.connection.Connection,
+                ethereum_codecs=False,
                 **connect_kwargs):
+    if isinstance(ethereum_codecs, str):
+        ethereum_codecs = parse_boolean(ethereum_codecs)
+    if ethereum_codecs:
+        init = _chain_init(init_ethereum_codecs, init)
     try:
         # check for 0.11.0 support
         if '_connection_class' in asyncpg.pool.Pool.__slots__:
@@ -78,6 +217,15 @@ def create_pool(dsn=None, *,
                     max_queries=max_queries, loop=loop, setup=setup,
                     **connect_kwargs)
 
+def _chain_init(first, second):
+    if second is None:
+        return first
+
+    async def init(con):
+        await first(con)
+        await second(con)
+    return init
+
 def get_database_pool():
     assert _global_database_pool is not None, "database not prepared before use"
     return _global_database_pool
@@ -93,13 +241,18 @@ async def _prepare_global_pool():
     if _global_database_pool is None:
         dbconfig = dict(config['database'])
         dbconfig.pop('ssl', None)
+        dbconfig.pop('ethereum_codecs', None)
         ssl = config['database'].getboolean('ssl')
-        _global_database_pool = await create_pool(ssl=ssl, **dbconfig)
+        ethereum_codecs = config['database'].getboolean('ethereum_codecs', False)
+        _global_database_pool = await create_pool(ssl=ssl, ethereum_codecs=ethereum_codecs, **dbconfig)
     return _global_database_pool
 
-async def prepare_database(config=None, handle_migration=None):
+async def prepare_database(config=None, handle_migration=None, warm_up_statements=None):
     """If handle_migration is False, will instead wait until the database's
-    version matches the expected"""
+    version matches the expected.
+
+    If warm_up_statements is not None the pool is warmed up once the
+    migration is complete (see `warm_up_pool`)"""
 
     if config is None:
         pool = await _prepare_global_pool()
@@ -111,15 +264,191 @@ async def prepare_database(config=None, handle_migration=None):
         else:
             await wait_for_migration(con)
 
+    if warm_up_statements is not None:
+        await warm_up_pool(pool, warm_up_statements)
+
     return pool
 
+async def warm_up_pool(pool, statements=()):
+    """Acquires the pool's `min_size` connections concurrently, making sure
+    they are all connected, and prepares each of the given statements on
+    every connection. This moves the cost of connecting, ssl handshakes,
+    type introspection and statement preparation to before the first
+    requests are handled"""
+
+    if hasattr(pool, 'get_min_size'):
+        min_size = pool.get_min_size()
+    else:
+        min_size = pool._minsize
+    connections = await asyncio.gather(*[pool.acquire() for _ in range(max(min_size, 1))],
+                                       return_exceptions=True)
+    try:
+        for con in connections:
+            if isinstance(con, Exception):
+                raise con
+        await asyncio.gather(*[_prepare_statements(con, statements) for con in connections])
+    finally:
+        for con in connections:
+            if not isinstance(con, Exception):
+                await pool.release(con)
+
+async def _prepare_statements(con, statements):
+    for query in statements:
+        if hasattr(con, '_get_statement'):
+            # adds the statement to the connection's statement cache
+            # so it's reused by the first execution of the query
+            await con._get_statement(query, None)
+        else:
+            await con.prepare(query)
+
+def get_shard_index(key, shard_count):
+    """returns the index of the shard the given key belongs to. Keys are
+    hashed so that the same key always maps to the same shard regardless
+    of the process. string keys are case insensitive to avoid differences
+    in the capitalisation of addresses changing the shard"""
+
+    if isinstance(key, str):
+        key = key.lower().encode('utf-8')
+    elif isinstance(key, int):
+        key = str(key).encode('utf-8')
+    digest = hashlib.sha1(key).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count
+
+class ShardedDatabasePool:
+    """A set of database pools where rows are distributed between the
+    pools by a hash of their key (e.g. an ethereum address)"""
+
+    __slots__ = ('pools',)
+
+    def __init__(self, pools):
+        if not pools:
+            raise DatabaseError("At least one shard is required")
+        self.pools = list(pools)
+
+    def __len__(self):
+        return len(self.pools)
+
+    def get_pool(self, key):
+        return self.pools[get_shard_index(key, len(self.pools))]
+
+    async def _fanout(self, method, query, args, timeout):
+        async def run(pool):
+            async with pool.acquire(timeout=timeout) as con:
+                return await getattr(con, method)(query, *args, timeout=timeout)
+        return await asyncio.gather(*[run(pool) for pool in self.pools])
+
+    async def fetch(self, query, *args, timeout=None):
+        """runs the query on all the shards concurrently, returning the
+        combined list of rows"""
+        results = await self._fanout('fetch', query, args, timeout)
+        return [row for rows in results for row in rows]
+
+    def execute(self, query, *args, timeout=None):
+        """runs the query on all the shards concurrently, returning the
+        list of status strings in shard order"""
+        return self._fanout('execute', query, args, timeout)
+
+    async def close(self):
+        await asyncio.gather(*[pool.close() for pool in self.pools])
+
+def get_database_shards():
+    assert _global_database_shards is not None, "database shards not prepared before use"
+    return _global_database_shards
+
+def set_database_shards(shards):
+    global _global_database_shards
+    _global_database_shards = shards
+
+_global_database_shards = None
+
+def _global_shards_config():
+    shardsconfig = dict(config['database_shards'])
+    shardsconfig['ssl'] = config['database_shards'].getboolean('ssl', False)
+    return shardsconfig
+
+async def prepare_database_shards(config=None, handle_migration=None, warm_up_statements=None):
+    """Creates a ShardedDatabasePool with a pool for each dsn in the
+    config's `dsns` entry (a list, or a comma or whitespace separated
+    string). The rest of the config is used for each of the pools.
+    If no config is given, the `database_shards` section of the global
+    config is used, and the result is set as the global shard set.
+    Migrations and warming up are handled for each shard the same way as
+    `prepare_database`"""
+
+    is_global = config is None
+    if is_global:
+        if _global_database_shards is not None:
+            return _global_database_shards
+        config = _global_shards_config()
+    else:
+        config = dict(config)
+    dsns = config.pop('dsns')
+    if isinstance(dsns, str):
+        dsns = dsns.replace(',', ' ').split()
+
+    pools = await asyncio.gather(*[create_pool(dsn, **config) for dsn in dsns])
+    shards = ShardedDatabasePool(pools)
+    for pool in shards.pools:
+        async with pool.acquire() as con:
+            if handle_migration is True or (is_global and handle_migration is None):
+                await create_tables(con)
+            else:
+                await wait_for_migration(con)
+
+    if warm_up_statements is not None:
+        await asyncio.gather(*[warm_up_pool(pool, warm_up_statements) for pool in shards.pools])
+
+    if is_global:
+        set_database_shards(shards)
+    return shards
+
+MIGRATION_SCRIPT_RE = regex.compile('^migrate_([0-9]{8})\\.sql$')
+# arbitrary (but fixed) key used with pg_advisory_lock to make sure only
+# one process is running the migration scripts at any one time
+MIGRATION_ADVISORY_LOCK_ID = 0x64676173
+MIGRATION_NOTIFY_CHANNEL = 'dgas_database_migration'
+
+def get_latest_migration_version(sql_dir="sql"):
+    """returns the highest migration script version available in `sql_dir`,
+    stopping at the first gap in the version numbers"""
+
+    try:
+        filenames = os.listdir(sql_dir)
+    except FileNotFoundError:
+        return 0
+    versions = set()
+    for fn in filenames:
+        match = MIGRATION_SCRIPT_RE.match(fn)
+        if match:
+            versions.add(int(match.group(1)))
+    version = 0
+    while version + 1 in versions:
+        version += 1
+    return version
+
 async def create_tables(con):
+    """Creates the database tables and applies any outstanding migration
+    scripts. A postgres advisory lock is held while doing so, which makes it
+    safe for multiple processes to call this at the same time. Each script is
+    applied in its own transaction, and the new version is sent to
+    `MIGRATION_NOTIFY_CHANNEL` once complete"""
 
     # make sure the create tables script exists
     if not os.path.exists("sql/create_tables.sql"):
         log.warning("Missing sql/create_tables.sql: cannot initialise database")
         return
 
+    await con.execute("SELECT pg_advisory_lock($1)", MIGRATION_ADVISORY_LOCK_ID)
+    try:
+        version = await _apply_migrations(con)
+    finally:
+        await con.execute("SELECT pg_advisory_unlock($1)", MIGRATION_ADVISORY_LOCK_ID)
+    await con.execute("SELECT pg_notify($1, $2)", MIGRATION_NOTIFY_CHANNEL, str(version))
+
+async def _apply_migrations(con):
+
+    latest_version = get_latest_migration_version()
+
     try:
         row = await con.fetchrow("SELECT version_number FROM database_version LIMIT 1")
         version = row['version_number']
@@ -128,98 +457,151 @@ async def create_tables(con):
 
         # fresh DB path
 
-        await con.execute("CREATE TABLE database_version (version_number INTEGER)")
-        await con.execute("INSERT INTO database_version (version_number) VALUES (0)")
-
         # fresh database, nothing to migrate
         with open("sql/create_tables.sql") as create_tables_file:
-
             sql = create_tables_file.read()
 
+        async with con.transaction():
+            await con.execute("CREATE TABLE database_version (version_number INTEGER)")
+            await con.execute("INSERT INTO database_version (version_number) VALUES (0)")
             await con.execute(sql)
+            version = await con.fetchval("SELECT version_number FROM database_version LIMIT 1")
 
         # verify that if there are any migration scripts, that the
         # database_version table has been updated appropriately
-        version = 0
-        while True:
-            version += 1
-            if not os.path.exists("sql/migrate_{:08}.sql".format(version)):
-                version -= 1
-                break
-
-        if version > 0:
-            row = await con.fetchrow("SELECT version_number FROM database_version LIMIT 1")
-            if row['version_number'] != version:
-                log.warning("Warning, migration scripts exist but database version has not been set in create_tables.sql")
-                log.warning("DB version: {}, latest migration script: {}".format(row['version_number'], version))
+        if latest_version > 0 and version != latest_version:
+            log.warning("Warning, migration scripts exist but database version has not been set in create_tables.sql")
+            log.warning("DB version: {}, latest migration script: {}".format(version, latest_version))
 
-        return
-
-    # check for migration files
+        return version
 
-    exception = None
-    while True:
+    # apply the outstanding migration files
+    while version < latest_version:
         version += 1
+        log.info("applying migration script: {:08}".format(version))
+        with open("sql/migrate_{:08}.sql".format(version)) as migrate_file:
+            sql = migrate_file.read()
+        async with con.transaction():
+            await con.execute(sql)
+            await con.execute("UPDATE database_version SET version_number = $1", version)
 
-        fn = "sql/migrate_{:08}.sql".format(version)
-        if os.path.exists(fn):
-            log.info("applying migration script: {:08}".format(version))
-            with open(fn) as migrate_file:
-                sql = migrate_file.read()
-                try:
-                    await con.execute(sql)
-                except Exception as e:
-                    version -= 1
-                    exception = e
-                    break
-        else:
-            version -= 1
-            break
-
-    await con.execute("UPDATE database_version SET version_number = $1", version)
-    if exception:
-        raise exception
+    return version
 
-async def wait_for_migration(con, poll_frequency=1):
+async def wait_for_migration(con, poll_frequency=10):
     """finds the latest expected database version and only exits once the current
     version in the database matches. Use for sub processes that depend on a main
-    process handling database migration"""
+    process handling database migration.
+
+    Listens on `MIGRATION_NOTIFY_CHANNEL` to be woken as soon as the migration
+    completes, `poll_frequency` is only used as a fallback in case the
+    notification is missed"""
 
     if not os.path.exists("sql/create_tables.sql"):
         log.warning("Missing sql/create_tables.sql: cannot initialise database")
         return
 
-    version = 0
-    while True:
-        version += 1
-        if not os.path.exists("sql/migrate_{:08}.sql".format(version)):
-            version -= 1
-            break
+    version = get_latest_migration_version()
 
-    while True:
-        try:
-            row = await con.fetchrow("SELECT version_number FROM database_version LIMIT 1")
-            if version == row['version_number']:
-                break
-        except asyncpg.exceptions.UndefinedTableError:
-            # if this happens, it could just be the first time starting the app,
-            # just keep waiting
-            pass
-        log.info("waiting for database migration...".format(version))
-        # wait some time before checking again
-        await asyncio.sleep(poll_frequency)
+    notified = asyncio.Event()
+
+    def on_notify(con, pid, channel, payload):
+        notified.set()
+
+    # start listening before the first check to avoid missing the notification
+    await con.add_listener(MIGRATION_NOTIFY_CHANNEL, on_notify)
+    try:
+        while True:
+            notified.clear()
+            try:
+                row = await con.fetchrow("SELECT version_number FROM database_version LIMIT 1")
+                if row is not None and version == row['version_number']:
+                    break
+            except asyncpg.exceptions.UndefinedTableError:
+                # if this happens, it could just be the first time starting the app,
+                # just keep waiting
+                pass
+            log.info("waiting for database migration...")
+            try:
+                await asyncio.wait_for(notified.wait(), poll_frequency)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        await con.remove_listener(MIGRATION_NOTIFY_CHANNEL, on_notify)
     # done!
     log.info("got database version: {}".format(version))
     return
 
+class QueryCoalescer:
+    """Shares the results of identical read queries that are in flight at the
+    same time. The first caller of a given (query, args) pair acquires a
+    connection from the pool and runs the query, any identical calls made
+    before it completes await that result instead of using another connection.
+
+    Queries are run outside of any transaction, so this must only be used
+    for reads that don't need to see uncommitted changes"""
+
+    __slots__ = ('pool', 'timeout', '_inflight')
+
+    def __init__(self, pool, timeout=None):
+        self.pool = pool
+        self.timeout = timeout
+        self._inflight = {}
+
+    async def _run(self, method, query, args, kwargs):
+        async with self.pool.acquire(timeout=self.timeout) as con:
+            return await getattr(con, method)(query, *args, **kwargs)
+
+    async def _coalesce(self, method, query, args, kwargs):
+        key = (method, query, args, tuple(sorted(kwargs.items())))
+        try:
+            future = self._inflight.get(key)
+        except TypeError:
+            # unhashable arguments, can't be shared
+            return await self._run(method, query, args, kwargs)
+        if future is None:
+            # run as a separate task so that the query isn't cancelled
+            # along with the first caller if others are still waiting
+            future = asyncio.ensure_future(self._run(method, query, args, kwargs))
+            self._inflight[key] = future
+            future.add_done_callback(lambda f: self._inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def fetch(self, query, *args, timeout=None):
+        rval = await self._coalesce('fetch', query, args, {'timeout': timeout})
+        # each caller gets their own copy of the list
+        return list(rval)
+
+    def fetchval(self, query, *args, column=0, timeout=None):
+        return self._coalesce('fetchval', query, args, {'column': column, 'timeout': timeout})
+
+    def fetchrow(self, query, *args, timeout=None):
+        return self._coalesce('fetchrow', query, args, {'timeout': timeout})
+
+_query_coalescers = weakref.WeakKeyDictionary()
+
+def get_query_coalescer(pool):
+    """returns the shared QueryCoalescer for the given pool"""
+    coalescer = _query_coalescers.get(pool)
+    if coalescer is None:
+        coalescer = _query_coalescers[pool] = QueryCoalescer(pool)
+    return coalescer
+
+# the typed unnest array parameters used by update_many and delete_many,
+# per pool and (table, columns)
+_array_parameters_cache = weakref.WeakKeyDictionary()
+
 class HandlerDatabasePoolContext():
 
-    __slots__ = ('timeout', 'connection', 'transaction', 'autocommit', 'pool', 'done', 'callbacks')
+    __slots__ = ('timeout', 'connection', 'transaction', 'autocommit', 'pool', 'done', 'callbacks',
+                 'concurrent_callbacks')
 
-    def __init__(self, pool, autocommit=False, timeout=None):
+    def __init__(self, pool, autocommit=False, timeout=None, concurrent_callbacks=False):
         self.pool = pool
         self.timeout = timeout
         self.autocommit = autocommit
+        # if True, coroutines returned by on_commit callbacks are run
+        # concurrently rather than one after the other
+        self.concurrent_callbacks = concurrent_callbacks
         self.connection = None
         self.transaction = None
         self.done = False
@@ -229,7 +611,28 @@ class HandlerDatabasePoolContext():
         """creates a new context with the values of this one"""
         if autocommit is None:
             autocommit = self.autocommit
-        return HandlerDatabasePoolContext(self.pool, autocommit, self.timeout)
+        return HandlerDatabasePoolContext(self.pool, autocommit, self.timeout, self.concurrent_callbacks)
+
+    @property
+    def coalesced(self):
+        """opt-in access to read queries that are shared with identical
+        queries currently in flight (see `QueryCoalescer`). These do not
+        use this context's transaction"""
+        return get_query_coalescer(self.pool)
+
+    def for_key(self, key, autocommit=None):
+        """creates a new context using the pool of the database shard
+        that `key` belongs to"""
+        if autocommit is None:
+            autocommit = self.autocommit
+        return HandlerDatabasePoolContext(get_database_shards().get_pool(key), autocommit, self.timeout,
+                                          self.concurrent_callbacks)
+
+    @property
+    def shards(self):
+        """the global ShardedDatabasePool, e.g. for running queries on all
+        shards with `self.db.shards.fetch(...)`"""
+        return get_database_shards()
 
     async def __aenter__(self):
         if self.connection is not None:
@@ -275,10 +678,15 @@ class HandlerDatabasePoolContext():
                 callbacks = self.callbacks[:]
                 self.callbacks.clear()
                 rval = await self.transaction.commit()
-                for callback in callbacks:
-                    f = callback()
-                    if asyncio.iscoroutine(f):
-                        await f
+                if self.concurrent_callbacks:
+                    coros = [f for f in (callback() for callback in callbacks) if asyncio.iscoroutine(f)]
+                    if coros:
+                        await asyncio.gather(*coros)
+                else:
+                    for callback in callbacks:
+                        f = callback()
+                        if asyncio.iscoroutine(f):
+                            await f
                 return rval
             finally:
                 if create_new_transaction:
@@ -371,6 +779,110 @@ class HandlerDatabasePoolContext():
             raise DatabaseError(resp)
         return resp
 
+    async def _get_array_parameters(self, tablename, columns, column_types=None):
+        """returns the typed array parameters (e.g. `$1::integer[]`) for the
+        given columns of the table, used to pass one array per column.
+        the column types are looked up once per pool, table and columns
+        unless `column_types` (a dict of column name to type) is given"""
+        if column_types is not None:
+            return self._format_array_parameters(tablename, columns, column_types)
+        cache = _array_parameters_cache.setdefault(self.pool, {})
+        key = (tablename, tuple(columns))
+        params = cache.get(key)
+        if params is None:
+            rows = await self.connection.fetch(
+                "SELECT attname, format_type(atttypid, atttypmod) AS type FROM pg_attribute "
+                "WHERE attrelid = $1::regclass AND attnum > 0 AND NOT attisdropped",
+                tablename)
+            types = {row['attname']: row['type'] for row in rows}
+            params = cache[key] = self._format_array_parameters(tablename, columns, types)
+        return params
+
+    @staticmethod
+    def _format_array_parameters(tablename, columns, types):
+        params = []
+        for i, column in enumerate(columns):
+            if column not in types:
+                raise DatabaseError("unknown column '{}' in table '{}'".format(column, tablename))
+            params.append("${}::{}[]".format(i + 1, types[column]))
+        return ', '.join(params)
+
+    async def update_many(self, tablename, rows, key_columns, column_types=None):
+        """Updates many rows with a single statement. `rows` is a list of
+        dicts (all with the same keys) containing the new values for the
+        row, as well as the values of the `key_columns` used to identify
+        the row to update. The values are sent as one array per column
+        which are joined against the table using `unnest`. The column
+        types are read from the database (and cached) unless given in
+        `column_types`.
+        """
+
+        if not self.transaction:
+            raise DatabaseError("No transaction in progress")
+        if isinstance(key_columns, str):
+            key_columns = [key_columns]
+        if not rows:
+            return "UPDATE 0"
+
+        columns = list(rows[0].keys())
+        if any(k not in columns for k in key_columns):
+            raise DatabaseError("rows must contain values for all the key_columns")
+        set_columns = [c for c in columns if c not in key_columns]
+        if not set_columns:
+            raise DatabaseError("rows contain no columns to update")
+        arrays = await self._get_array_parameters(tablename, columns, column_types)
+
+        query = "UPDATE {table} AS t SET {set} FROM unnest({arrays}) AS v({columns}) WHERE {where}".format(
+            table=tablename,
+            set=', '.join("{0} = v.{0}".format(c) for c in set_columns),
+            arrays=arrays,
+            columns=', '.join(columns),
+            where=' AND '.join("t.{0} = v.{0}".format(c) for c in key_columns))
+        try:
+            arglist = [[row[c] for row in rows] for c in columns]
+        except KeyError:
+            raise DatabaseError("all rows must contain the same columns")
+
+        return await self.connection.execute(query, *arglist)
+
+    async def delete_many(self, tablename, keys, column_types=None):
+        """Deletes many rows with a single statement. `keys` is either a
+        dict mapping a single key column to a list of values, or a list of
+        dicts (all with the same keys) of the key column values of each row
+        to delete. As with `update_many` the column types can be given in
+        `column_types`.
+        """
+
+        if not self.transaction:
+            raise DatabaseError("No transaction in progress")
+
+        if isinstance(keys, dict):
+            if len(keys) != 1:
+                raise DatabaseError("expected a single key column")
+            (column, values), = keys.items()
+            return await self.connection.execute(
+                "DELETE FROM {} WHERE {} = ANY($1)".format(tablename, column),
+                list(values))
+        if not keys:
+            return "DELETE 0"
+
+        columns = list(keys[0].keys())
+        if len(columns) == 1:
+            return await self.delete_many(tablename, {columns[0]: [key[columns[0]] for key in keys]})
+        arrays = await self._get_array_parameters(tablename, columns, column_types)
+
+        query = "DELETE FROM {table} AS t USING unnest({arrays}) AS v({columns}) WHERE {where}".format(
+            table=tablename,
+            arrays=arrays,
+            columns=', '.join(columns),
+            where=' AND '.join("t.{0} = v.{0}".format(c) for c in columns))
+        try:
+            arglist = [[key[c] for key in keys] for c in columns]
+        except KeyError:
+            raise DatabaseError("all keys must contain the same columns")
+
+        return await self.connection.execute(query, *arglist)
+
 def with_database(fn):
     async def wrapper(self, *args, **kwargs):
         async with self.db:
@@ -386,3 +898,200 @@ class DatabaseMixin:
         if not hasattr(self, '_dbcontext'):
             self._dbcontext = HandlerDatabasePoolContext(get_database_pool())
         return self._dbcontext
+
+_POOL_ONLY_CONFIG_KEYS = ('min_size', 'max_size', 'max_queries', 'max_inactive_connection_lifetime',
+                          'ethereum_codecs', 'ssl')
+
+def _global_connect_kwargs():
+    """returns the kwargs for asyncpg.connect based on the global database config"""
+    connect_kwargs = {k: v for k, v in config['database'].items() if k not in _POOL_ONLY_CONFIG_KEYS}
+    if config['database'].getboolean('ssl', False):
+        connect_kwargs['ssl'] = SSL_CTX
+    return connect_kwargs
+
+_CLOSED = object()
+
+class NotificationSubscription:
+    """An async iterator of the payloads of notifications sent to a channel.
+    Created by `DatabaseNotificationListener.subscribe`"""
+
+    __slots__ = ('listener', 'channel', '_queue', '_closed')
+
+    def __init__(self, listener, channel, max_queue_size=0):
+        self.listener = listener
+        self.channel = channel
+        self._queue = asyncio.Queue(max_queue_size)
+        self._closed = False
+
+    def _put(self, payload):
+        if self._closed:
+            return
+        try:
+            self._queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            log.warning("dropping notification on channel '{}': subscriber queue full".format(self.channel))
+
+    def _close(self):
+        if not self._closed:
+            self._closed = True
+            # make sure anything waiting in __anext__ wakes up
+            if self._queue.full():
+                self._queue.get_nowait()
+            self._queue.put_nowait(_CLOSED)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        payload = await self._queue.get()
+        if payload is _CLOSED:
+            self._queue.put_nowait(_CLOSED)
+            raise StopAsyncIteration
+        return payload
+
+    async def close(self):
+        await self.listener.unsubscribe(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, extype, ex, tb):
+        await self.close()
+
+class DatabaseNotificationListener:
+    """Keeps a single dedicated connection LISTENing to all the channels
+    that have subscribers in this process, and delivers each notification
+    to all of the channel's subscribers. The connection is checked every
+    `keepalive_interval` seconds and re-established if it is lost
+    (notifications sent while disconnected are lost).
+
+        async with await listener.subscribe('new_payment') as payments:
+            async for payload in payments:
+                ...
+    """
+
+    def __init__(self, connect_kwargs=None, *, keepalive_interval=5.0, reconnect_delay=1.0,
+                 subscribe_timeout=10.0):
+        self.connect_kwargs = connect_kwargs
+        self.keepalive_interval = keepalive_interval
+        self.reconnect_delay = reconnect_delay
+        self.subscribe_timeout = subscribe_timeout
+        self._subscribers = {}
+        self._connection = None
+        self._connected = asyncio.Event()
+        # completed with the error if connecting fails
+        self._connect_failed = asyncio.Future()
+        self._runner = None
+        self._closing = False
+
+    def _on_notification(self, con, pid, channel, payload):
+        for subscription in list(self._subscribers.get(channel, ())):
+            subscription._put(payload)
+
+    async def _connect(self):
+        connect_kwargs = self.connect_kwargs
+        if connect_kwargs is None:
+            connect_kwargs = _global_connect_kwargs()
+        con = await asyncpg.connect(**connect_kwargs)
+        try:
+            for channel in list(self._subscribers):
+                await con.add_listener(channel, self._on_notification)
+        except:
+            await con.close()
+            raise
+        return con
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                try:
+                    self._connection = await self._connect()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    if not self._connect_failed.done():
+                        self._connect_failed.set_result(e)
+                    raise
+                self._connect_failed = asyncio.Future()
+                self._connected.set()
+                while not self._closing:
+                    await asyncio.sleep(self.keepalive_interval)
+                    await self._connection.fetchval("SELECT 1")
+            except asyncio.CancelledError:
+                break
+            except:
+                log.exception("Error in database notification listener, reconnecting")
+                await asyncio.sleep(self.reconnect_delay)
+            finally:
+                self._connected.clear()
+                con = self._connection
+                self._connection = None
+                if con is not None and not con.is_closed():
+                    con.terminate()
+
+    async def subscribe(self, channel, max_queue_size=0, timeout=None):
+        """returns a NotificationSubscription for the given channel, once
+        the listening connection is LISTENing to it. raises a DatabaseError
+        if the connection isn't established within `timeout` seconds
+        (defaults to `subscribe_timeout`) or connecting to the database
+        fails"""
+        if self._closing:
+            raise DatabaseError("Notification listener is closed")
+        subscription = NotificationSubscription(self, channel, max_queue_size)
+        subscribers = self._subscribers.setdefault(channel, set())
+        subscribers.add(subscription)
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.ensure_future(self._run())
+        if not self._connected.is_set():
+            connected = asyncio.ensure_future(self._connected.wait())
+            failed = self._connect_failed
+            await asyncio.wait([connected, failed], timeout=timeout or self.subscribe_timeout,
+                               return_when=asyncio.FIRST_COMPLETED)
+            connected.cancel()
+            if not self._connected.is_set():
+                await self.unsubscribe(subscription)
+                if failed.done():
+                    raise DatabaseError("Unable to connect notification listener: {}".format(failed.result()))
+                raise DatabaseError("Timed out connecting notification listener")
+        if len(subscribers) == 1 and self._connection is not None:
+            await self._connection.add_listener(channel, self._on_notification)
+        return subscription
+
+    async def unsubscribe(self, subscription):
+        subscription._close()
+        subscribers = self._subscribers.get(subscription.channel)
+        if subscribers is None or subscription not in subscribers:
+            return
+        subscribers.discard(subscription)
+        if not subscribers:
+            del self._subscribers[subscription.channel]
+            if self._connection is not None and not self._connection.is_closed():
+                try:
+                    await self._connection.remove_listener(subscription.channel, self._on_notification)
+                except Exception:
+                    # the keepalive check will deal with broken connections
+                    log.exception("Error removing notification listener")
+
+    async def close(self):
+        self._closing = True
+        for subscribers in list(self._subscribers.values()):
+            for subscription in subscribers:
+                subscription._close()
+        self._subscribers.clear()
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+
+def get_notification_listener():
+    """returns the process wide DatabaseNotificationListener using the
+    global database config"""
+    global _global_notification_listener
+    if _global_notification_listener is None or _global_notification_listener._closing:
+        _global_notification_listener = DatabaseNotificationListener()
+    return _global_notification_listener
+
+_global_notification_listener = None
@@ -57,7 +57,12 @@ class RequestVerificationMixin:
     if ETHEREUM_SUPPORTED:
         def verify_request(self):
             """Verifies that the signature and the payload match the expected address
-            raising a JSONHTTPError (400) if something is wrong with the request"""
+            raising a JSONHTTPError (400) if something is wrong with the request.
+            The result is remembered so further calls for the same request
+            don't repeat the signature recovery"""
+
+            if getattr(self, '_verified_address', None) is not None:
+                return self._verified_address
 
             if TOSHI_ID_ADDRESS_HEADER in self.request.headers:
                 expected_address = self.request.headers[TOSHI_ID_ADDRESS_HEADER]
@@ -125,6 +130,7 @@ class RequestVerificationMixin:
                 raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_timestamp',
                                                            'message': 'The difference between the timestamp and the current time is too large'}]})
 
+            self._verified_address = expected_address
             return expected_address
 
         def is_request_signed(self, raise_if_partial=True):
@@ -0,0 +1,192 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict
+
+from dgas.errors import JSONHTTPError
+from dgas.log import log
+from dgas.redis import get_redis_connection, scripts
+
+class _Bucket:
+
+    __slots__ = ('tokens', 'updated', 'pending', 'last_sync', 'blocked_until')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        # requests allowed locally that haven't been counted in redis yet
+        self.pending = 0
+        self.last_sync = 0
+        self.blocked_until = 0
+
+class RateLimiter:
+    """Limits the number of requests for each key to `rate` per `period`
+    seconds across all processes sharing the redis server.
+
+    Each process checks requests against a local token bucket (holding up
+    to `burst` tokens) and only every `sync_interval` seconds adds the
+    number of requests it allowed to a counter in redis for the current
+    period. If the cluster wide count goes over the limit the key is
+    blocked locally until the end of the period. Rejected requests never
+    touch redis.
+
+    Counts still pending when a key goes quiet are flushed to redis
+    `sync_interval` seconds later, and by `close`.
+
+    If redis is unavailable requests are only limited by the local bucket.
+    """
+
+    def __init__(self, rate, period=1.0, burst=None, *, prefix='ratelimit:',
+                 sync_interval=1.0, max_keys=10000, redis=None):
+        self.rate = rate
+        self.period = period
+        self.burst = burst if burst is not None else rate
+        self.prefix = prefix
+        self.sync_interval = sync_interval
+        self.max_keys = max_keys
+        self._redis = redis
+        self._buckets = OrderedDict()
+        self._flusher = None
+
+    @property
+    def redis(self):
+        if self._redis is not None:
+            return self._redis
+        return get_redis_connection()
+
+    def _get_bucket(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = _Bucket(self.burst, now)
+            while len(self._buckets) > self.max_keys:
+                old_key, old_bucket = self._buckets.popitem(last=False)
+                if old_bucket.pending:
+                    asyncio.ensure_future(self._sync(old_key, old_bucket, now))
+        else:
+            self._buckets.move_to_end(key)
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate / self.period)
+            bucket.updated = now
+        return bucket
+
+    async def check(self, key):
+        """returns True if the request for `key` is allowed"""
+
+        now = time.time()
+        bucket = self._get_bucket(key, now)
+        if bucket.blocked_until > now or bucket.tokens < 1:
+            return False
+        bucket.tokens -= 1
+        bucket.pending += 1
+
+        if now - bucket.last_sync < self.sync_interval:
+            if self._flusher is None or self._flusher.done():
+                self._flusher = asyncio.ensure_future(self._flush_pending())
+            return True
+
+        return await self._sync(key, bucket, now)
+
+    async def _sync(self, key, bucket, now):
+        """adds the bucket's pending requests to the redis counter, blocking
+        the key if the limit has been reached. returns False if it has"""
+        window = int(now // self.period)
+        pending, bucket.pending = bucket.pending, 0
+        bucket.last_sync = now
+        try:
+            count = await scripts.rate_counter(
+                keys=["{}{}:{}".format(self.prefix, key, window)],
+                args=[pending, math.ceil(self.period) + 1],
+                redis=self.redis)
+        except Exception:
+            log.exception("Unable to sync rate limit counter")
+            return True
+        if count > self.rate:
+            bucket.blocked_until = (window + 1) * self.period
+            bucket.tokens = 0
+            return False
+        return True
+
+    async def _flush_pending(self):
+        # runs while there are pending counts, so they don't wait for the
+        # next request for their key to reach redis
+        while any(bucket.pending for bucket in self._buckets.values()):
+            await asyncio.sleep(self.sync_interval)
+            await self.flush()
+
+    async def flush(self):
+        """sends all pending counts to redis"""
+        now = time.time()
+        syncs = [self._sync(key, bucket, now) for key, bucket in list(self._buckets.items())
+                 if bucket.pending]
+        if syncs:
+            await asyncio.gather(*syncs)
+
+    async def close(self):
+        """stops the flush timer and sends the pending counts to redis"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+
+def _address_key(handler):
+    return handler.verify_request()
+
+def _ip_key(handler):
+    return handler.request.remote_ip
+
+def _route_key(handler):
+    return "{}.{}".format(type(handler).__name__, handler.request.method)
+
+_KEY_FUNCTIONS = {
+    'address': _address_key,
+    'ip': _ip_key,
+    'route': _route_key
+}
+
+def _get_key_function(key):
+    if callable(key):
+        return key
+    if key not in _KEY_FUNCTIONS:
+        raise ValueError("key must be a callable or one of: {}".format(', '.join(_KEY_FUNCTIONS)))
+    return _KEY_FUNCTIONS[key]
+
+def _rate_limited_error():
+    return JSONHTTPError(429, body={'errors': [{'id': 'rate_limited', 'message': 'Too many requests'}]})
+
+def rate_limit(rate, period=1.0, burst=None, key='ip', **kwargs):
+    """Decorator for handler methods limiting requests to `rate` per
+    `period` seconds (see RateLimiter). `key` is one of 'address' (the
+    address returned by `verify_request`), 'ip', 'route', or a function
+    taking the handler and returning the key to limit by"""
+
+    keyfn = _get_key_function(key)
+    limiter = RateLimiter(rate, period, burst, **kwargs)
+
+    def wrap(fn):
+        async def wrapper(self, *args, **kwargs):
+            if not await limiter.check(keyfn(self)):
+                raise _rate_limited_error()
+            f = fn(self, *args, **kwargs)
+            if asyncio.iscoroutine(f):
+                f = await f
+            return f
+        wrapper.rate_limiter = limiter
+        return wrapper
+
+    return wrap
+
+class RateLimitMixin:
+    """Applies the limits of the `rate_limiter` class attribute (a
+    RateLimiter) to all requests to the handler, using `rate_limit_key`
+    (see `rate_limit`) as the key"""
+
+    rate_limiter = None
+    rate_limit_key = 'ip'
+
+    async def prepare(self):
+        f = super().prepare()
+        if asyncio.iscoroutine(f):
+            await f
+        if self._finished or self.rate_limiter is None:
+            return
+        if not await self.rate_limiter.check(_get_key_function(self.rate_limit_key)(self)):
+            raise _rate_limited_error()
@@ -1,38 +1,564 @@
+import asyncio
 import aioredis
+import hashlib
+import inspect
+import msgpack
+import time
+import uuid
+from collections import OrderedDict
+from functools import partial
 from dgas.config import config
+from dgas.log import log
 
 _global_connection = None
+_global_replica_connection = None
+_global_sentinel = None
 
-def get_redis_connection():
+def get_redis_connection(readonly=False):
+    """returns the global redis connection. If `readonly` is True and
+    replicas are configured a connection to the replicas is returned"""
     assert _global_connection is not None, "redis not prepared before use"
+    if readonly and _global_replica_connection is not None:
+        return _global_replica_connection
     return _global_connection
 
-def set_redis_connection(connection):
-    global _global_connection
+def set_redis_connection(connection, replica_connection=None, sentinel=None):
+    global _global_connection, _global_replica_connection, _global_sentinel
     _global_connection = connection
+    _global_replica_connection = replica_connection
+    _global_sentinel = sentinel
+
+def get_redis_sentinel():
+    return _global_sentinel
+
+def parse_sentinel_addresses(sentinels):
+    """parses a comma or whitespace separated string of `host:port`
+    sentinel addresses into a list of (host, port) tuples"""
+    if isinstance(sentinels, str):
+        sentinels = sentinels.replace(',', ' ').split()
+    addresses = []
+    for sentinel in sentinels:
+        if isinstance(sentinel, str):
+            host, _, port = sentinel.rpartition(':')
+            if not host:
+                host, port = port, 26379
+            addresses.append((host, int(port)))
+        else:
+            addresses.append(tuple(sentinel))
+    return addresses
+
+async def create_redis_pools(config, *, replica=True):
+    """Creates the redis connections for the given config, returning a
+    tuple of (master, replica, sentinel). `replica` and `sentinel` are
+    None if not configured, or if `replica` is False for the replica.
+
+    If `sentinels` is in the config the master and replicas of the
+    `sentinel_master` service are discovered using the sentinels, and
+    are re-resolved automatically after a failover. Otherwise `url` is
+    used for the master and the optional `replica_url` for the replica"""
+
+    db = config.get('db', None)
+    db = int(db) if db else None
+    password = config.get('password', None)
+    if 'sentinels' in config:
+        sentinel = await aioredis.create_sentinel(
+            parse_sentinel_addresses(config['sentinels']),
+            db=db, password=password)
+        name = config.get('sentinel_master', 'mymaster')
+        return sentinel.master_for(name), sentinel.slave_for(name) if replica else None, sentinel
+    master = await aioredis.create_redis_pool(config['url'], password=password, db=db)
+    if replica and 'replica_url' in config:
+        replica = await aioredis.create_redis_pool(config['replica_url'], password=password, db=db)
+    else:
+        replica = None
+    return master, replica, None
 
 async def prepare_redis(config=None):
+    """returns the global redis connection, or a new connection to the
+    master for `config` which the caller is responsible for closing.
+    with `sentinels` the master's address is only looked up once, so
+    the new connection doesn't follow failovers"""
     if config is None:
         return await _prepare_global_redis()
-    else:
+    if 'sentinels' in config:
+        sentinel = await aioredis.create_sentinel(parse_sentinel_addresses(config['sentinels']))
+        try:
+            address = await sentinel.master_address(config.get('sentinel_master', 'mymaster'))
+        finally:
+            sentinel.close()
+            await sentinel.wait_closed()
         db = config.get('db', None)
-        return await aioredis.create_redis_pool(
-            config['url'],
-            password=config.get('password', None),
-            db=int(db) if db else None)
+        return await aioredis.create_redis_pool(address, password=config.get('password', None),
+                                                db=int(db) if db else None)
+    master, _, _ = await create_redis_pools(config, replica=False)
+    return master
 
 async def _prepare_global_redis():
-    global _global_connection
     if _global_connection is None:
-        db = config['redis'].get('db', None)
-        _global_connection = await aioredis.create_redis_pool(
-            config['redis']['url'],
-            password=config['redis'].get('password', None),
-            db=int(db) if db else None)
+        set_redis_connection(*(await create_redis_pools(config['redis'])))
     return _global_connection
 
+class RedisScript:
+    """A lua script that is called by its SHA1 digest using EVALSHA, only
+    sending the script source (using EVAL, which also caches it in redis)
+    if redis replies that it doesn't know the script"""
+
+    __slots__ = ('name', 'source', 'sha')
+
+    def __init__(self, source, name=None):
+        self.name = name
+        self.source = source
+        self.sha = hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    async def __call__(self, keys=(), args=(), *, redis=None):
+        if redis is None:
+            redis = get_redis_connection()
+        keys = list(keys)
+        args = list(args)
+        try:
+            return await redis.evalsha(self.sha, keys=keys, args=args)
+        except aioredis.errors.ReplyError as e:
+            if not str(e).startswith('NOSCRIPT'):
+                raise
+            return await redis.eval(self.source, keys=keys, args=args)
+
+class RedisScriptRegistry:
+    """A collection of named RedisScripts, accessible as attributes:
+
+        scripts.register('compare_and_delete', COMPARE_AND_DELETE_SCRIPT)
+        await scripts.compare_and_delete(keys=[key], args=[token])
+    """
+
+    def __init__(self):
+        self._scripts = {}
+
+    def register(self, name, source):
+        if name in self._scripts and self._scripts[name].source != source:
+            raise ValueError("A different script is already registered as '{}'".format(name))
+        script = self._scripts[name] = RedisScript(source, name)
+        return script
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._scripts[name]
+        except KeyError:
+            raise AttributeError("No script registered as '{}'".format(name))
+
+    def __contains__(self, name):
+        return name in self._scripts
+
+    async def load_all(self, redis=None):
+        """preloads all the registered scripts with SCRIPT LOAD, e.g. at
+        startup, to avoid the EVAL fallback on first use"""
+        if redis is None:
+            redis = get_redis_connection()
+        await asyncio.gather(*[redis.script_load(script.source) for script in self._scripts.values()])
+
+scripts = RedisScriptRegistry()
+
+def register_script(name, source):
+    """registers a lua script in the global script registry"""
+    return scripts.register(name, source)
+
+# deletes KEYS[1] if its value is ARGV[1], returns 1 if deleted
+register_script('compare_and_delete', """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+# sets KEYS[1] to ARGV[2] if its current value is ARGV[1] (or the key
+# doesn't exist and ARGV[1] is empty), returns 1 if set
+register_script('compare_and_set', """
+local current = redis.call('GET', KEYS[1])
+if (current == false and ARGV[1] == '') or current == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+""")
+
+# increments KEYS[1] by ARGV[1] setting the expiry to ARGV[2] seconds if
+# the key has no expiry yet, returns the new value
+register_script('rate_counter', """
+local value = redis.call('INCRBY', KEYS[1], ARGV[1])
+if redis.call('TTL', KEYS[1]) == -1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return value
+""")
+
+_MISSING = object()
+
+class RedisCache:
+    """A two tier cache: an in process LRU in front of redis.
+
+    Values are serialized with msgpack and stored in redis with a per key
+    TTL. Cache misses are computed only once across all processes sharing
+    the redis server: the first process to take a short lived lock in
+    redis computes the value, while the others wait for it to appear.
+    Keys that are set or invalidated are published on `channel` so
+    other processes drop them from their local cache.
+
+    Values returned from the local cache are shared between callers and
+    should not be modified.
+    """
+
+    def __init__(self, redis=None, *, prefix='cache:', channel='cache-invalidation',
+                 local_size=1024, local_ttl=60, default_ttl=300,
+                 lock_timeout=10, lock_poll_interval=0.05):
+        """
+        redis: the aioredis pool to use, defaults to the global redis connection
+        local_size: the maximum number of entries in the local cache
+        local_ttl: the maximum time in seconds entries stay in the local cache
+        default_ttl: the TTL in seconds used when none is given for a key
+        lock_timeout: the time in seconds a process gets to compute a missing value
+        """
+        self._redis = redis
+        self.prefix = prefix
+        self.channel = channel
+        self.local_size = local_size
+        self.local_ttl = local_ttl
+        self.default_ttl = default_ttl
+        self.lock_timeout = lock_timeout
+        self.lock_poll_interval = lock_poll_interval
+        self._local = OrderedDict()
+        self._computing = {}
+        self._invalidation_task = None
+        # used to ignore our own invalidation messages
+        self._id = uuid.uuid4().hex
+
+    @property
+    def redis(self):
+        if self._redis is not None:
+            return self._redis
+        return get_redis_connection()
+
+    def _get_local(self, key):
+        entry = self._local.get(key)
+        if entry is None:
+            return _MISSING
+        value, expires = entry
+        if expires < time.time():
+            del self._local[key]
+            return _MISSING
+        self._local.move_to_end(key)
+        return value
+
+    def _set_local(self, key, value, ttl):
+        self._local[key] = (value, time.time() + min(ttl, self.local_ttl))
+        self._local.move_to_end(key)
+        while len(self._local) > self.local_size:
+            self._local.popitem(last=False)
+
+    def _ensure_invalidation_listener(self):
+        if self._invalidation_task is None or self._invalidation_task.done():
+            self._invalidation_task = asyncio.ensure_future(self._invalidation_loop())
+
+    async def _invalidation_loop(self):
+        while True:
+            try:
+                channel, = await self.redis.subscribe(self.channel)
+                # anything cached while not subscribed may be stale
+                self._local.clear()
+                while (await channel.wait_message()):
+                    origin, key = msgpack.unpackb(await channel.get(), encoding='utf-8')
+                    if origin != self._id:
+                        self._local.pop(key, None)
+                # stop if the subscription was closed intentionally
+                return
+            except asyncio.CancelledError:
+                raise
+            except:
+                log.exception("Error in cache invalidation listener")
+                self._local.clear()
+                await asyncio.sleep(1)
+
+    async def close(self):
+        if self._invalidation_task is not None:
+            self._invalidation_task.cancel()
+            try:
+                await self._invalidation_task
+            except asyncio.CancelledError:
+                pass
+            self._invalidation_task = None
+            try:
+                await self.redis.unsubscribe(self.channel)
+            except aioredis.errors.RedisError:
+                pass
+        self._local.clear()
+
+    async def get(self, key, default=None):
+        """returns the cached value for the key, or `default` if the key
+        isn't cached"""
+        self._ensure_invalidation_listener()
+        value = self._get_local(key)
+        if value is not _MISSING:
+            return value
+        pipe = self.redis.pipeline()
+        pipe.get(self.prefix + key)
+        pipe.ttl(self.prefix + key)
+        data, ttl = await pipe.execute()
+        if data is None:
+            return default
+        value = msgpack.unpackb(data, encoding='utf-8')
+        if ttl > 0:
+            self._set_local(key, value, ttl)
+        return value
+
+    def _publish_invalidation(self, key):
+        return self.redis.publish(self.channel, msgpack.packb([self._id, key], use_bin_type=True, encoding="utf-8"))
+
+    async def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.default_ttl
+        self._ensure_invalidation_listener()
+        await self.redis.set(self.prefix + key, msgpack.packb(value, use_bin_type=True, encoding="utf-8"),
+                             expire=ttl)
+        await self._publish_invalidation(key)
+        self._set_local(key, value, ttl)
+
+    async def invalidate(self, key):
+        """removes the key from the cache in all processes"""
+        self._local.pop(key, None)
+        await self.redis.delete(self.prefix + key)
+        await self._publish_invalidation(key)
+
+    async def get_or_compute(self, key, fn, ttl=None):
+        """returns the cached value for the key, if it's not cached `fn`
+        is called to compute the value (making sure that only one process
+        computes it) and the result is cached"""
+
+        value = self._get_local(key)
+        if value is not _MISSING:
+            return value
+
+        # only one compute per key in this process
+        future = self._computing.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._compute(key, fn, ttl))
+            self._computing[key] = future
+            future.add_done_callback(lambda f: self._computing.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def _compute(self, key, fn, ttl):
+        lock_key = "{}lock:{}".format(self.prefix, key)
+        token = uuid.uuid4().hex
+        deadline = time.time() + self.lock_timeout
+        while True:
+            value = await self.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+            if await self.redis.set(lock_key, token, expire=self.lock_timeout,
+                                    exist=self.redis.SET_IF_NOT_EXIST):
+                # make sure the value wasn't set just before we got the lock
+                value = await self.get(key, _MISSING)
+                if value is not _MISSING:
+                    await self._release_lock(lock_key, token)
+                    return value
+                break
+            if time.time() > deadline:
+                # the process holding the lock is taking too long
+                # compute the value without it
+                token = None
+                break
+            await asyncio.sleep(self.lock_poll_interval)
+
+        try:
+            value = fn()
+            if inspect.isawaitable(value):
+                value = await value
+            await self.set(key, value, ttl)
+            return value
+        finally:
+            if token is not None:
+                await self._release_lock(lock_key, token)
+
+    async def _release_lock(self, lock_key, token):
+        await scripts.compare_and_delete(keys=[lock_key], args=[token], redis=self.redis)
+
+    def cached(self, ttl=None, key=None):
+        """decorator that caches the results of the decorated function
+        (see `cached`)"""
+        return _cache_decorator(lambda: self, ttl, key)
+
+def _cache_decorator(get_cache, ttl, key):
+
+    def wrap(fn):
+        params = list(inspect.signature(fn).parameters)
+        skip_self = bool(params) and params[0] in ('self', 'cls')
+        name = "{}.{}".format(fn.__module__, fn.__qualname__)
+
+        def default_key(*args, **kwargs):
+            if skip_self:
+                args = args[1:]
+            return "{}:{!r}:{!r}".format(name, args, sorted(kwargs.items()))
+
+        keyfn = key or default_key
+
+        async def wrapper(*args, **kwargs):
+            return await get_cache().get_or_compute(keyfn(*args, **kwargs), lambda: fn(*args, **kwargs), ttl)
+        return wrapper
+
+    return wrap
+
+_global_cache = None
+
+def get_redis_cache():
+    """returns the RedisCache using the global redis connection"""
+    global _global_cache
+    if _global_cache is None:
+        _global_cache = RedisCache()
+    return _global_cache
+
+def cached(ttl=None, key=None):
+    """decorator that caches the results of the decorated function in the
+    global RedisCache. `key` is a function that is called with the same
+    arguments as the decorated function and returns the cache key. By
+    default the key is built from the function's name and the repr of
+    its arguments (excluding `self`)"""
+    return _cache_decorator(get_redis_cache, ttl, key)
+
+class AutoPipeline:
+    """Batches all the redis commands issued through it during the same
+    iteration of the event loop into a single pipeline, sending them to
+    redis in one round trip. Commands are called the same way as on the
+    aioredis pool and return futures with their results:
+
+        balance, nonce = await asyncio.gather(
+            batch.get(balance_key), batch.incr(nonce_key))
+    """
+
+    def __init__(self, redis=None):
+        self._redis = redis
+        self._pipeline = None
+        self._futures = None
+
+    @property
+    def redis(self):
+        if self._redis is not None:
+            return self._redis
+        return get_redis_connection()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            if self._pipeline is None:
+                self._pipeline = self.redis.pipeline()
+                self._futures = []
+                asyncio.get_event_loop().call_soon(self._flush)
+            # chain the result onto a separate future so it can
+            # be failed if the whole pipeline fails
+            future = asyncio.Future()
+            task = getattr(self._pipeline, name)(*args, **kwargs)
+            task.add_done_callback(partial(_chain_future, future))
+            self._futures.append(future)
+            return future
+
+        return command
+
+    def _flush(self):
+        pipeline, futures = self._pipeline, self._futures
+        self._pipeline = self._futures = None
+        asyncio.ensure_future(self._execute(pipeline, futures))
+
+    async def _execute(self, pipeline, futures):
+        try:
+            await pipeline.execute(return_exceptions=True)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+
+def _chain_future(future, task):
+    if future.done():
+        return
+    if task.cancelled():
+        future.cancel()
+    elif task.exception() is not None:
+        future.set_exception(task.exception())
+    else:
+        future.set_result(task.result())
+
+_global_auto_pipeline = None
+
+def get_auto_pipeline():
+    """returns the AutoPipeline using the global redis connection"""
+    global _global_auto_pipeline
+    if _global_auto_pipeline is None:
+        _global_auto_pipeline = AutoPipeline()
+    return _global_auto_pipeline
+
+def _chunks(items, chunk_size):
+    for i in range(0, len(items), chunk_size):
+        yield items[i:i + chunk_size]
+
+async def mget_many(keys, *, redis=None, chunk_size=1000, encoding=None):
+    """gets the values of all the keys, splitting them into MGETs of at
+    most `chunk_size` keys sent together in a single pipeline"""
+    if redis is None:
+        redis = get_redis_connection()
+    keys = list(keys)
+    if not keys:
+        return []
+    pipeline = redis.pipeline()
+    for chunk in _chunks(keys, chunk_size):
+        if encoding is None:
+            pipeline.mget(*chunk)
+        else:
+            pipeline.mget(*chunk, encoding=encoding)
+    results = await pipeline.execute()
+    return [value for values in results for value in values]
+
+async def mset_many(pairs, *, redis=None, chunk_size=1000, expire=None):
+    """sets all the key/value pairs (a dict or list of tuples), splitting
+    them into MSETs of at most `chunk_size` pairs sent together in a
+    single pipeline. If `expire` is given each key is set with that
+    expiry (in seconds) instead"""
+    if redis is None:
+        redis = get_redis_connection()
+    if isinstance(pairs, dict):
+        pairs = pairs.items()
+    pairs = list(pairs)
+    if not pairs:
+        return
+    pipeline = redis.pipeline()
+    if expire:
+        for key, value in pairs:
+            pipeline.set(key, value, expire=expire)
+    else:
+        for chunk in _chunks(pairs, chunk_size):
+            pipeline.mset(*[item for pair in chunk for item in pair])
+    await pipeline.execute()
+
 class RedisMixin:
 
     @property
     def redis(self):
         return get_redis_connection()
+
+    @property
+    def redis_replica(self):
+        """a connection to the redis replicas if configured, otherwise
+        the master. use for reads that can tolerate replication lag"""
+        return get_redis_connection(readonly=True)
+
+    @property
+    def redis_batch(self):
+        """an AutoPipeline batching commands sent in the same loop iteration"""
+        return get_auto_pipeline()
+
+    @property
+    def cache(self):
+        return get_redis_cache()
+
+    def mget_many(self, keys, **kwargs):
+        return mget_many(keys, redis=self.redis, **kwargs)
+
+    def mset_many(self, pairs, **kwargs):
+        return mset_many(pairs, redis=self.redis, **kwargs)
@@ -1,16 +1,37 @@
 import asyncio
 import aioredis
+import bisect
+import calendar
+import collections
+import datetime
+import concurrent.futures
+import hashlib
+import importlib
 import tornado.ioloop
 import urllib
 import msgpack
 import sys
+import time
 import uuid
 import traceback
 import logging
 from functools import partial
 from tornado.platform.asyncio import to_asyncio_future
+from dgas.database import get_shard_index
+from dgas.redis import parse_sentinel_addresses, register_script, scripts
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
 
 TASK_QUEUE_CHANNEL_NAME = 'task-queue'
+DEFAULT_PRIORITY = 'normal'
 
 log = logging.getLogger("task-log")
 
@@ -35,15 +56,172 @@ class TaskError(Exception):
     def __repr__(self):
         return self.exc_message
 
+class TaskTimeoutError(TaskError):
+    def __init__(self, function, timeout):
+        super().__init__('TaskTimeoutError', "'{}' did not finish within {} seconds".format(function, timeout), '')
+
+class TaskQueueFullError(TaskError):
+    def __init__(self, function):
+        super().__init__('TaskQueueFullError', "Task queue full, dropped call to '{}'".format(function), '')
+
+class RetryPolicy:
+    """Retries calls failing with one of the exceptions in `retry_on`
+    (exception classes or their names, or None for any exception) up to
+    `max_retries` times, waiting `backoff * multiplier ** n` seconds
+    (at most `max_backoff`) before the nth retry"""
+
+    def __init__(self, max_retries=3, backoff=0.1, multiplier=2, max_backoff=30, retry_on=None):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.multiplier = multiplier
+        self.max_backoff = max_backoff
+        if retry_on is not None:
+            retry_on = {exc if isinstance(exc, str) else exc.__name__ for exc in retry_on}
+        self.retry_on = retry_on
+
+    def should_retry(self, error, retries):
+        if retries >= self.max_retries:
+            return False
+        return self.retry_on is None or error.exc_type_name in self.retry_on
+
+    def get_delay(self, retries):
+        return min(self.max_backoff, self.backoff * self.multiplier ** retries)
+
+class TaskSerializer:
+    """Encodes task messages as a version byte, a flags byte and the body
+    serialized with `dumps` (msgpack by default, subclasses can override
+    `dumps` and `loads`).
+
+    compression: None, 'zstd' or 'lz4' to compress bodies of at least
+      `compression_threshold` bytes
+    reference_threshold: messages larger than this many bytes are stored
+      in redis for `reference_ttl` seconds, and only their key is sent
+    envelope: whether to add the version and flags bytes. listeners that
+      predate TaskSerializer can only read messages without them, so by
+      default they're only added when compression, references or a custom
+      `dumps` need them. only enable these once every listener sharing
+      the queue has been upgraded
+    """
+
+    VERSION = 1
+    FLAG_ZSTD = 0x01
+    FLAG_LZ4 = 0x02
+    FLAG_REFERENCE = 0x04
+
+    def __init__(self, compression=None, compression_threshold=4096, reference_threshold=None, reference_ttl=300,
+                 envelope=None):
+        if compression == 'zstd' and zstandard is None:
+            raise Exception("Missing optional zstandard module, install with pip install dgas-services[zstd]")
+        if compression == 'lz4' and lz4 is None:
+            raise Exception("Missing optional lz4 module, install with pip install dgas-services[lz4]")
+        if compression not in (None, 'zstd', 'lz4'):
+            raise ValueError("Unknown compression: {}".format(compression))
+        needs_envelope = compression is not None or reference_threshold is not None or \
+            type(self).dumps is not TaskSerializer.dumps
+        if envelope is None:
+            envelope = needs_envelope
+        elif not envelope and needs_envelope:
+            raise ValueError("compression, reference_threshold and custom serialization need the envelope")
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.reference_threshold = reference_threshold
+        self.reference_ttl = reference_ttl
+        self.envelope = envelope
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True, encoding="utf-8")
+
+    def loads(self, data):
+        return msgpack.unpackb(data, encoding='utf-8')
+
+    def encode(self, obj):
+        body = self.dumps(obj)
+        if not self.envelope:
+            return body
+        flags = 0
+        if self.compression is not None and len(body) >= self.compression_threshold:
+            if self.compression == 'zstd':
+                body = zstandard.ZstdCompressor().compress(body)
+                flags |= self.FLAG_ZSTD
+            else:
+                body = lz4.frame.compress(body)
+                flags |= self.FLAG_LZ4
+        return bytes([self.VERSION, flags]) + body
+
+    def decode(self, data):
+        # messages without the version byte are from older listeners,
+        # they always start with a msgpack array header
+        if not data or data[0] != self.VERSION:
+            if data and data[0] < 0x80:
+                raise ValueError("Unsupported task message version: {}".format(data[0]))
+            return msgpack.unpackb(data, encoding='utf-8')
+        flags = data[1]
+        body = data[2:]
+        if flags & self.FLAG_REFERENCE:
+            raise ValueError("Task message payload stored by reference")
+        if flags & self.FLAG_ZSTD:
+            if zstandard is None:
+                raise Exception("Missing optional zstandard module, install with pip install dgas-services[zstd]")
+            body = zstandard.ZstdDecompressor().decompress(body)
+        elif flags & self.FLAG_LZ4:
+            if lz4 is None:
+                raise Exception("Missing optional lz4 module, install with pip install dgas-services[lz4]")
+            body = lz4.frame.decompress(body)
+        return self.loads(body)
+
+    def should_store(self, data):
+        return self.reference_threshold is not None and len(data) > self.reference_threshold
+
+    def encode_reference(self, key, task_id=None, reply_to=None):
+        # the task id and reply channel let the caller know if the
+        # stored message expires before it's read
+        return bytes([self.VERSION, self.FLAG_REFERENCE]) + msgpack.packb(
+            [key, task_id, reply_to], use_bin_type=True, encoding="utf-8")
+
+    def get_reference(self, data):
+        """returns (key, task_id, reply_to) if `data` is a reference to a
+        stored message, otherwise None"""
+        if len(data) > 2 and data[0] == self.VERSION and data[1] & self.FLAG_REFERENCE:
+            return tuple(msgpack.unpackb(data[2:], encoding='utf-8'))
+        return None
+
+DEFAULT_SERIALIZER = TaskSerializer()
+
 class Task:
-    def __init__(self, task_id, function, *args):
+    def __init__(self, task_id, function, *args, reply_to=None, timeout=None, retry=None, priority=None,
+                 shard=None, idempotency_key=None):
         self.task_id = task_id
         self._future = asyncio.Future()
         self.function = function
         self.arguments = args
+        self.reply_to = reply_to
+        self.timeout = timeout
+        self.retry = retry
+        self.priority = priority
+        self.shard = shard
+        self.idempotency_key = idempotency_key
+        self.retries = 0
+        # set when the call is sent
+        self.deadline = None
+        self.expires = None
+        self.sent = None
+
+    @property
+    def options(self):
+        options = {}
+        if self.reply_to is not None:
+            options['reply_to'] = self.reply_to
+        if self.expires is not None:
+            options['expires'] = self.expires
+        if self.priority is not None:
+            options['priority'] = self.priority
+        if self.idempotency_key is not None:
+            options['idempotency_key'] = self.idempotency_key
+        return options
 
-    def pack(self):
-        return msgpack.packb([self.task_id, 'call', self.function, *self.arguments], use_bin_type=True, encoding="utf-8")
+    def pack(self, serializer=None):
+        return (serializer or DEFAULT_SERIALIZER).encode(
+            [self.task_id, 'task', self.function, list(self.arguments), self.options])
 
     def cancel(self):
         self._future.cancel()
@@ -65,6 +243,11 @@ class Task:
 
 class TaskHandler:
 
+    # stateless handlers are created once when they are added to the
+    # listener and the same instance handles every call, so they can't
+    # keep state for a call on `self` and their `task_id` is None
+    stateless = False
+
     def __init__(self, listener, task_id, **kwargs):
         self.application = self.listener = listener
         self.task_id = task_id
@@ -73,29 +256,35 @@ class TaskHandler:
     def initialize(self, *args, **kwargs):
         pass
 
-    async def _call_handler(self, fnname, args):
+    async def _call_handler(self, task_id, fnname, method, args, reply_to=None, idempotency_key=None):
+        # results are sent to the `reply_to` channel, calls without one
+        # (e.g. scheduled calls) don't send results
+        replies = [(reply_to, task_id)] if reply_to is not None else []
+        state = None
+        lease = None
         try:
-            func = getattr(self, fnname)
-            r = func(*args)
-            if asyncio.iscoroutine(r):
-                r = await to_asyncio_future(r)
-            while True:
-                try:
-                    await self.listener.aio_redis_connection_pool.publish(
-                        self.listener.queue_name,
-                        msgpack.packb([self.task_id, 'result', r], use_bin_type=True, encoding="utf-8"))
-                    break
-                except aioredis.errors.PoolClosedError:
-                    # only send results back if the listener is still running
-                    if not self.listener._shutdown_task_dispatch:
-                        log.warning("'{}' result done after connection pool closed".format(fnname))
-                    break
-                except asyncio.CancelledError:
-                    continue
-                except:
-                    log.exception("Error when sending task result")
-                    await asyncio.sleep(0.1)
+            if idempotency_key is not None:
+                state, r = await self.listener._claim_idempotency_key(idempotency_key, task_id, reply_to)
+                if state == 'attached':
+                    # the call already running sends the result
+                    return
+                if state == 'claimed':
+                    lease = asyncio.ensure_future(self.listener._refresh_idempotency_lease(idempotency_key, task_id))
+            if state != 'result':
+                r = await self._run_method(method, args)
+            if lease is not None:
+                lease.cancel()
+                replies.extend(await self.listener._complete_idempotency_key(idempotency_key, task_id, r))
+            for channel, reply_task_id in replies:
+                await self._send_reply(fnname, channel, [reply_task_id, 'result', r])
         except:
+            if lease is not None:
+                lease.cancel()
+                try:
+                    # failed calls can be run again
+                    replies.extend(await self.listener._complete_idempotency_key(idempotency_key, task_id))
+                except Exception:
+                    log.exception("Error releasing idempotency key")
             if self.listener._shutdown_task_dispatch:
                 pass
             elif not self.listener.aio_redis_connection_pool.closed:
@@ -104,31 +293,985 @@ class TaskHandler:
                 exc_type = "{}".format(info[0].__name__)
                 msg = "{}".format(info[1])
                 trace = "".join(traceback.format_exception(*info))
-                await self.listener.aio_redis_connection_pool.publish(
-                    self.listener.queue_name,
-                    msgpack.packb([self.task_id, 'exception', exc_type, msg, trace], use_bin_type=True, encoding="utf-8"))
+                for channel, reply_task_id in replies:
+                    await self.listener.aio_redis_connection_pool.publish(
+                        channel,
+                        await self.listener._pack_message([reply_task_id, 'exception', exc_type, msg, trace]))
             else:
                 log.exception("'{}' threw exception after connection pool closed".format(fnname))
 
+    async def _send_reply(self, fnname, channel, message):
+        while True:
+            try:
+                await self.listener.aio_redis_connection_pool.publish(
+                    channel,
+                    await self.listener._pack_message(message))
+                break
+            except aioredis.errors.PoolClosedError:
+                # only send results back if the listener is still running
+                if not self.listener._shutdown_task_dispatch:
+                    log.warning("'{}' result done after connection pool closed".format(fnname))
+                break
+            except asyncio.CancelledError:
+                continue
+            except:
+                log.exception("Error when sending task result")
+                await asyncio.sleep(0.1)
+
+    async def _run_method(self, method, args):
+        if getattr(method, '_task_cpu_bound', False):
+            return await self.listener.run_in_process(method, *args)
+        r = method(*args)
+        if asyncio.iscoroutine(r):
+            r = await to_asyncio_future(r)
+        return r
+
+def cpu_bound(fn):
+    """Marks a TaskHandler method to be run in the listener's process pool
+    instead of on the event loop. The method is called without `self`
+    (it becomes a staticmethod), and its arguments and result have to be
+    picklable."""
+
+    fn._task_cpu_bound = True
+    return staticmethod(fn)
+
+def _import_modules(modules):
+    for module in modules:
+        importlib.import_module(module)
+
 _reserved_task_handler_functions = ['initialize']
 
+class _HandlerEntry:
+    """a handler class registered for a function, with its shared
+    instance and bound method if the handler is stateless"""
+
+    __slots__ = ('handler_class', 'optionals', 'instance', 'method')
+
+    def __init__(self, handler_class, optionals, instance=None, method=None):
+        self.handler_class = handler_class
+        self.optionals = optionals
+        self.instance = instance
+        self.method = method
+
+class _WeightedRoundRobin:
+    """picks priority lanes in proportion to their weights using smooth
+    weighted round robin"""
+
+    def __init__(self, weights):
+        self.weights = weights
+        self._credits = {lane: 0 for lane in weights}
+
+    def next(self, lanes=None):
+        """returns the next lane to use out of `lanes` (defaults to every
+        lane), or None if `lanes` is empty"""
+        chosen = None
+        total = 0
+        for lane, weight in self.weights.items():
+            if lanes is not None and lane not in lanes:
+                continue
+            self._credits[lane] += weight
+            total += weight
+            if chosen is None or self._credits[lane] > self._credits[chosen]:
+                chosen = lane
+        if chosen is not None:
+            self._credits[chosen] -= total
+        return chosen
+
+class PubSubTaskQueue:
+    """Publishes calls on the listener's queue channel, every listener with
+    a handler for the function runs the task. Calls are picked up by the
+    listener's dispatch loop along with the results."""
+
+    # large calls are stored in redis and only a reference is published
+    holds_calls = False
+
+    def __init__(self, listener):
+        self.listener = listener
+
+    def channel(self, priority=None):
+        if priority is None or priority == DEFAULT_PRIORITY:
+            return self.listener.queue_name
+        return "{}:{}".format(self.listener.queue_name, priority)
+
+    @property
+    def channels(self):
+        return [self.channel(priority) for priority in self.listener.priorities]
+
+    async def publish(self, fnname, data, priority=None):
+        await self.listener.aio_redis_connection_pool.publish(self.channel(priority), data)
+
+    async def publish_many(self, calls):
+        """publishes a list of (fnname, data, priority) calls"""
+        # commands sent on a single connection without waiting for the
+        # replies are written together
+        with await self.listener.aio_redis_connection_pool as con:
+            await asyncio.gather(*[con.publish(self.channel(priority), data) for fnname, data, priority in calls])
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+def _next_stream_id(entry_id):
+    """returns the stream id following `entry_id`, for exclusive ranges"""
+    ms, seq = entry_id.split(b'-')
+    return ms + b'-' + str(int(seq) + 1).encode('ascii')
+
+class StreamTaskQueue:
+    """Uses redis stream consumer groups so that each call is run by only
+    one of the listeners sharing the queue. Calls for each function are
+    added to their own stream (`<queue>:<function>`) so listeners only
+    read the calls they have handlers for.
+
+    Entries are acknowledged and deleted once all the handlers for the
+    call have finished. Entries left pending by a listener that stopped
+    before finishing them are claimed by another listener once they have
+    been idle for `claim_timeout` seconds, so this should be longer than
+    the longest running task.
+    """
+
+    # calls wait in the stream until they're read, so large calls are
+    # kept in the entry rather than in a key that could expire first
+    holds_calls = True
+
+    def __init__(self, listener, *, group=None, batch_size=10, block_timeout=1.0,
+                 claim_timeout=60.0, claim_interval=10.0):
+        self.listener = listener
+        self.group = group or listener.queue_name
+        self.consumer = listener.listener_id
+        self.batch_size = batch_size
+        self.block_timeout = block_timeout
+        self.claim_timeout = claim_timeout
+        self.claim_interval = claim_interval
+        self._groups = set()
+        self._processing = set()
+        self._acks = set()
+        self._lanes = _WeightedRoundRobin(listener.priorities)
+        self._read_con = None
+        self._read_task = None
+        self._claim_task = None
+
+    @property
+    def channels(self):
+        return []
+
+    def stream_key(self, fnname, priority=None):
+        if priority is None or priority == DEFAULT_PRIORITY:
+            return "{}:{}".format(self.listener.queue_name, fnname)
+        return "{}:{}:{}".format(self.listener.queue_name, priority, fnname)
+
+    @property
+    def redis(self):
+        return self.listener.aio_redis_connection_pool
+
+    async def publish(self, fnname, data, priority=None):
+        await self.redis.execute(b'XADD', self.stream_key(fnname, priority), b'*', b'task', data)
+
+    async def publish_many(self, calls):
+        with await self.redis as con:
+            await asyncio.gather(*[con.execute(b'XADD', self.stream_key(fnname, priority), b'*', b'task', data)
+                                   for fnname, data, priority in calls])
+
+    def start(self):
+        if self._read_task is None or self._read_task.done():
+            self._read_task = asyncio.ensure_future(self._read_loop())
+        if self._claim_task is None or self._claim_task.done():
+            self._claim_task = asyncio.ensure_future(self._claim_loop())
+
+    def close(self):
+        """stops reading new entries"""
+        if self._claim_task is not None:
+            self._claim_task.cancel()
+        if self._read_con is not None:
+            self._read_con.close()
+
+    async def wait_closed(self):
+        """waits for the read loop to stop and outstanding acks to be sent,
+        then removes this listener's consumer from the groups"""
+        for task in (self._read_task, self._claim_task):
+            if task is None:
+                continue
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            except:
+                log.exception("exception when waiting for stream queue close")
+        if self._acks:
+            await asyncio.wait(list(self._acks))
+        try:
+            await self._delete_consumer()
+        except:
+            log.exception("Error removing task stream consumer")
+
+    async def _delete_consumer(self):
+        # consumers are only deleted once they have nothing pending, as
+        # deleting a consumer drops its pending entries, which would then
+        # never be claimed by another listener
+        for key in list(self._groups):
+            pending = await self.redis.execute(b'XPENDING', key, self.group, b'-', b'+', 1, self.consumer)
+            if not pending:
+                await self.redis.execute(b'XGROUP', b'DELCONSUMER', key, self.group, self.consumer)
+
+    async def _ensure_groups(self, redis, keys):
+        for key in keys:
+            if key in self._groups:
+                continue
+            try:
+                # start from the beginning of the stream so tasks
+                # published before any listener was running are handled
+                await redis.execute(b'XGROUP', b'CREATE', key, self.group, b'0', b'MKSTREAM')
+            except aioredis.errors.ReplyError as e:
+                if not str(e).startswith('BUSYGROUP'):
+                    raise
+            self._groups.add(key)
+
+    async def _read_loop(self):
+        while not self.listener._shutdown_task_dispatch:
+            try:
+                await self._read_loop_main()
+            except:
+                if self.listener._shutdown_task_dispatch:
+                    break
+                log.exception("Unhandled Error in task stream read loop")
+                await asyncio.sleep(0.1)
+
+    async def _read_loop_main(self):
+        with await self.redis as con:
+            self._read_con = con
+            try:
+                while not self.listener._shutdown_task_dispatch:
+                    # only read calls that can be started straight away,
+                    # the rest are left in the streams for other listeners
+                    fnnames = self.listener.functions_with_capacity()
+                    count = self.batch_size
+                    if self.listener.available_capacity is not None:
+                        count = min(count, self.listener.available_capacity)
+                    if not fnnames or count == 0 or self.listener.queue_depth:
+                        await self.listener.wait_for_capacity(self.block_timeout)
+                        continue
+                    lanes = [[(self.stream_key(fnname, priority), fnname) for fnname in fnnames]
+                             for priority in self._lane_order()]
+                    all_keys = [key for keys in lanes for key in keys]
+                    await self._ensure_groups(con, [key for key, fnname in all_keys])
+                    # the lane picked by weight is read first, the others
+                    # fill what is left of the batch
+                    read = 0
+                    for keys in lanes:
+                        read += await self._read_streams(con, keys, count - read)
+                        if read >= count:
+                            break
+                    if read == 0:
+                        # blocks for a limited time so that streams for newly
+                        # added handlers are included in the next read
+                        await self._read(con, [key for key, fnname in all_keys],
+                                         self._block_count(all_keys, count), int(self.block_timeout * 1000))
+            finally:
+                self._read_con = None
+
+    def _read_limit(self, fnname, count):
+        """the number of calls to `fnname` that can be read, out of `count`"""
+        capacity = self.listener.function_capacity(fnname)
+        return count if capacity is None else min(count, capacity)
+
+    async def _read_streams(self, con, keys, count):
+        """reads up to `count` entries from the (stream key, function)
+        pairs in `keys`. XREADGROUP's COUNT applies to each stream, so
+        the streams are read one at a time, each limited to what is left
+        of `count` and the function's remaining capacity"""
+        read = 0
+        for key, fnname in keys:
+            limit = self._read_limit(fnname, count - read)
+            if limit > 0:
+                read += await self._read(con, [key], limit)
+                if read >= count:
+                    break
+        return read
+
+    def _block_count(self, keys, count):
+        """the COUNT for a blocking read of all the streams. a blocked read
+        is normally served by the first stream that gets an entry, but
+        could return entries from every stream, so `count` is split
+        between them (reading at least one entry from each)"""
+        return max(1, min([count // len(keys)] + [self._read_limit(fnname, count) for key, fnname in keys]))
+
+    def _lane_order(self):
+        """returns the priority lanes in the order to read them, the first
+        is picked by smooth weighted round robin"""
+        chosen = self._lanes.next()
+        return [chosen] + [priority for priority in self.listener.priorities if priority != chosen]
+
+    async def _read(self, con, keys, count, block=None):
+        args = [b'COUNT', count]
+        if block is not None:
+            args.extend([b'BLOCK', block])
+        response = await con.execute(
+            b'XREADGROUP', b'GROUP', self.group, self.consumer, *args,
+            b'STREAMS', *keys, *([b'>'] * len(keys)))
+        read = 0
+        for key, entries in response or ():
+            self._dispatch_entries(key.decode('utf-8'), entries)
+            read += len(entries)
+        return read
+
+    def _dispatch_entries(self, key, entries):
+        for entry in entries:
+            if entry is None:
+                # claimed entry that was deleted
+                continue
+            entry_id, fields = entry
+            if fields is None:
+                self._ack(key, entry_id)
+                continue
+            fields = dict(zip(fields[::2], fields[1::2]))
+            if b'task' not in fields:
+                log.error("Invalid stream entry: {}".format(fields))
+                self._ack(key, entry_id)
+                continue
+            self._processing.add((key, entry_id))
+            self.listener._dispatch_message(fields[b'task'], ack=partial(self._ack, key, entry_id))
+
+    def _ack(self, key, entry_id):
+        self._processing.discard((key, entry_id))
+        ack = asyncio.ensure_future(self._send_ack(key, entry_id))
+        self._acks.add(ack)
+        ack.add_done_callback(self._acks.discard)
+
+    async def _send_ack(self, key, entry_id):
+        try:
+            await asyncio.gather(
+                self.redis.execute(b'XACK', key, self.group, entry_id),
+                self.redis.execute(b'XDEL', key, entry_id))
+        except:
+            log.exception("Error acknowledging task stream entry")
+
+    async def _claim_loop(self):
+        while not self.listener._shutdown_task_dispatch:
+            await asyncio.sleep(self.claim_interval)
+            try:
+                await self.claim_stale_entries()
+            except asyncio.CancelledError:
+                raise
+            except:
+                if self.listener._shutdown_task_dispatch:
+                    break
+                log.exception("Error claiming stale task stream entries")
+
+    async def claim_stale_entries(self):
+        """claims and runs entries that have been pending on other
+        consumers for longer than `claim_timeout`"""
+
+        min_idle = int(self.claim_timeout * 1000)
+        for key in list(self._groups):
+            # the pending entries are listed in id order, so page through
+            # all of them starting after the last id seen
+            start = b'-'
+            while True:
+                pending = await self.redis.execute(b'XPENDING', key, self.group, start, b'+', self.batch_size)
+                if not pending:
+                    break
+                entry_ids = [entry_id for entry_id, consumer, idle, deliveries in pending
+                             if idle >= min_idle and (key, entry_id) not in self._processing]
+                if entry_ids:
+                    entries = await self.redis.execute(b'XCLAIM', key, self.group, self.consumer, min_idle,
+                                                       *entry_ids)
+                    if entries:
+                        log.warning("Claimed {} stale task(s) from '{}'".format(len(entries), key))
+                        self._dispatch_entries(key, entries)
+                if len(pending) < self.batch_size:
+                    break
+                start = _next_stream_id(pending[-1][0])
+
+TASK_QUEUE_BACKENDS = {
+    'pubsub': PubSubTaskQueue,
+    'streams': StreamTaskQueue
+}
+
+class _HashRing:
+    """consistent hash ring mapping keys to members"""
+
+    def __init__(self, members, replicas=64):
+        self._points = sorted(
+            (self._hash("{}:{}".format(member, i)), member)
+            for member in members for i in range(replicas))
+        self._hashes = [point for point, member in self._points]
+
+    @staticmethod
+    def _hash(value):
+        return int(hashlib.sha1(value.encode('utf-8')).hexdigest()[:16], 16)
+
+    def get(self, key):
+        if not self._points:
+            return None
+        i = bisect.bisect(self._hashes, self._hash(key)) % len(self._points)
+        return self._points[i][1]
+
+class ShardedTaskQueue:
+    """Ordered task queues. Calls with a `shard_key` are added to one of
+    `shards` streams (`<queue>:shard:<n>`) picked by a hash of the key,
+    and each shard is consumed by a single listener which runs its calls
+    one at a time in the order they were sent.
+
+    Consuming listeners announce themselves in the `<queue>:shard-members`
+    sorted set every `heartbeat_interval` seconds, and the shards are
+    assigned to the live members with a consistent hash ring, so only a
+    fraction of the shards move when listeners join or leave. Listeners
+    only read a shard while holding its lock, a shard that moves to
+    another listener is released once its current call has finished.
+    Locks (and memberships) of listeners that stop without releasing
+    them expire after `lease_timeout` seconds.
+
+    Entries are deleted once their call has finished, so a call is run
+    again by the next owner if its listener stops while running it.
+    """
+
+    def __init__(self, listener, shards, *, consume=False, heartbeat_interval=2.0, lease_timeout=10.0,
+                 batch_size=10, block_timeout=1.0, replicas=64):
+        self.listener = listener
+        self.shards = shards
+        self.consume = consume
+        self.heartbeat_interval = heartbeat_interval
+        self.lease_timeout = lease_timeout
+        self.batch_size = batch_size
+        self.block_timeout = block_timeout
+        self.replicas = replicas
+        self.members_key = "{}:shard-members".format(listener.queue_name)
+        self.owned = set()
+        self._busy = set()
+        self._outbox = []
+        self._flushing = False
+        self._wakeup = asyncio.Event()
+        self._read_con = None
+        self._read_task = None
+        self._membership_task = None
+        self._shard_tasks = set()
+
+    @property
+    def redis(self):
+        return self.listener.aio_redis_connection_pool
+
+    def shard_for(self, key):
+        # the same mapping as the database shards (string keys are case
+        # insensitive), so calls for a key line up with its rows
+        if not isinstance(key, (str, int, bytes)):
+            key = str(key)
+        return get_shard_index(key, self.shards)
+
+    def stream_key(self, shard):
+        return "{}:shard:{}".format(self.listener.queue_name, shard)
+
+    def lock_key(self, shard):
+        return "{}:shard-lock:{}".format(self.listener.queue_name, shard)
+
+    def send(self, shard, data):
+        """queues the call to be added to the shard, calls are written in
+        the order they are sent"""
+        self._outbox.append((shard, data))
+        if not self._flushing:
+            self._flushing = True
+            asyncio.ensure_future(self._flush())
+
+    async def add(self, shard, data):
+        """adds the call to the shard straight away, without keeping its
+        order with the calls queued by `send`"""
+        await self.redis.execute(b'XADD', self.stream_key(shard), b'*', b'task', data)
+
+    async def _flush(self):
+        try:
+            while self._outbox:
+                calls, self._outbox = self._outbox, []
+                # a single connection keeps the calls in order
+                with await self.redis as con:
+                    await asyncio.gather(*[con.execute(b'XADD', self.stream_key(shard), b'*', b'task', data)
+                                           for shard, data in calls])
+        except aioredis.errors.PoolClosedError:
+            pass
+        except:
+            log.exception("Error sending sharded task calls")
+        finally:
+            self._flushing = False
+
+    def start(self):
+        if not self.consume:
+            return
+        if self._membership_task is None or self._membership_task.done():
+            self._membership_task = asyncio.ensure_future(self._membership_loop())
+        if self._read_task is None or self._read_task.done():
+            self._read_task = asyncio.ensure_future(self._read_loop())
+
+    def close(self):
+        if self._membership_task is not None:
+            self._membership_task.cancel()
+        if self._read_con is not None:
+            self._read_con.close()
+        self._wakeup.set()
+
+    async def wait_closed(self):
+        for task in (self._membership_task, self._read_task):
+            if task is None:
+                continue
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            except:
+                log.exception("exception when waiting for shard queue close")
+        if self._shard_tasks:
+            if self.listener._cancelling_tasks:
+                for task in self._shard_tasks:
+                    task.cancel()
+            await asyncio.wait(list(self._shard_tasks))
+        if not self.consume:
+            return
+        try:
+            await self.redis.zrem(self.members_key, self.listener.listener_id)
+            for shard in list(self.owned):
+                await self._release(shard)
+        except:
+            log.exception("Error releasing task shards")
+        self.owned.clear()
+
+    async def _membership_loop(self):
+        while not self.listener._shutdown_task_dispatch:
+            try:
+                await self.rebalance()
+            except asyncio.CancelledError:
+                raise
+            except:
+                log.exception("Error updating task shard membership")
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def rebalance(self):
+        """refreshes the listener's membership and takes or releases
+        shards to match the current members"""
+
+        now = time.time()
+        await self.redis.zadd(self.members_key, now, self.listener.listener_id)
+        await self.redis.zremrangebyscore(self.members_key, max=now - self.lease_timeout)
+        members = await self.redis.zrange(self.members_key, encoding='utf-8')
+        ring = _HashRing(members, self.replicas)
+        wanted = {shard for shard in range(self.shards) if ring.get(str(shard)) == self.listener.listener_id}
+
+        # shards being run are kept locked until their call finishes
+        for shard in sorted(wanted | self._busy):
+            locked = await scripts.acquire_lock(
+                keys=[self.lock_key(shard)], args=[self.listener.listener_id, int(self.lease_timeout * 1000)],
+                redis=self.redis) == 1
+            if locked and shard in wanted:
+                self.owned.add(shard)
+            else:
+                self.owned.discard(shard)
+        for shard in list(self.owned - wanted):
+            self.owned.discard(shard)
+            if shard not in self._busy:
+                await self._release(shard)
+        self._wakeup.set()
+
+    async def _release(self, shard):
+        await scripts.compare_and_delete(keys=[self.lock_key(shard)], args=[self.listener.listener_id],
+                                         redis=self.redis)
+
+    async def _read_loop(self):
+        while not self.listener._shutdown_task_dispatch:
+            try:
+                await self._read_loop_main()
+            except:
+                if self.listener._shutdown_task_dispatch:
+                    break
+                log.exception("Unhandled Error in task shard read loop")
+                await asyncio.sleep(0.1)
+
+    async def _read_loop_main(self):
+        with await self.redis as con:
+            self._read_con = con
+            try:
+                while not self.listener._shutdown_task_dispatch:
+                    idle = sorted(self.owned - self._busy)
+                    if not idle:
+                        self._wakeup.clear()
+                        try:
+                            await asyncio.wait_for(self._wakeup.wait(), self.block_timeout)
+                        except asyncio.TimeoutError:
+                            pass
+                        continue
+                    # processed entries are deleted, so reading from the
+                    # start of the stream returns the oldest pending calls
+                    keys = [self.stream_key(shard) for shard in idle]
+                    response = await con.execute(
+                        b'XREAD', b'COUNT', self.batch_size, b'BLOCK', int(self.block_timeout * 1000),
+                        b'STREAMS', *keys, *([b'0-0'] * len(keys)))
+                    for key, entries in response or ():
+                        shard = int(key.decode('utf-8').rsplit(':', 1)[1])
+                        if shard not in self.owned or shard in self._busy:
+                            continue
+                        self._busy.add(shard)
+                        task = asyncio.ensure_future(self._run_shard(shard, entries))
+                        self._shard_tasks.add(task)
+                        task.add_done_callback(self._shard_tasks.discard)
+            finally:
+                self._read_con = None
+
+    async def _run_shard(self, shard, entries):
+        try:
+            for entry_id, fields in entries:
+                if shard not in self.owned or self.listener._shutdown_task_dispatch:
+                    break
+                fields = dict(zip(fields[::2], fields[1::2]))
+                if b'task' in fields:
+                    done = asyncio.get_event_loop().create_future()
+                    self.listener._dispatch_message(fields[b'task'], ack=partial(_set_done, done))
+                    await done
+                await self.redis.execute(b'XDEL', self.stream_key(shard), entry_id)
+        except asyncio.CancelledError:
+            raise
+        except:
+            log.exception("Error running calls from task shard {}".format(shard))
+        finally:
+            self._busy.discard(shard)
+            if shard not in self.owned and not self.redis.closed:
+                asyncio.ensure_future(self._release(shard))
+            self._wakeup.set()
+
+def _set_done(future):
+    if not future.done():
+        future.set_result(None)
+
+class CronSchedule:
+    """Parses cron style schedules ("minute hour day month weekday", in
+    UTC) supporting `*`, ranges (`1-5`), lists (`1,15`) and steps (`*/10`)"""
+
+    FIELD_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError("Invalid cron expression: {}".format(expression))
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+            self._parse_field(field, *limits) for field, limits in zip(fields, self.FIELD_RANGES)]
+        # 0 and 7 are both sunday
+        if 7 in self.weekdays:
+            self.weekdays = (self.weekdays - {7}) | {0}
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def _parse_field(field, low, high):
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/', 1)
+                step = int(step)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = [int(v) for v in part.split('-', 1)]
+            else:
+                start = int(part)
+                end = start if step == 1 else high
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError("Invalid cron field: {}".format(field))
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, dt):
+        day = dt.day in self.days
+        weekday = (dt.weekday() + 1) % 7 in self.weekdays
+        if self._any_day:
+            return weekday
+        if self._any_weekday:
+            return day
+        # like cron, match either field when both are restricted
+        return day or weekday
+
+    def next_after(self, timestamp):
+        """returns the timestamp of the first run after `timestamp`"""
+        dt = datetime.datetime.utcfromtimestamp(timestamp).replace(second=0, microsecond=0)
+        dt += datetime.timedelta(minutes=1)
+        last_year = dt.year + 5
+        while dt.year <= last_year:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1) + datetime.timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            elif not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + datetime.timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += datetime.timedelta(minutes=1)
+            else:
+                return calendar.timegm(dt.timetuple())
+        raise ValueError("Cron expression never matches: {}".format(self.expression))
+
+class IntervalSchedule:
+
+    def __init__(self, interval):
+        self.interval = interval
+
+    def next_after(self, timestamp):
+        return timestamp + self.interval
+
+class PeriodicTask:
+
+    def __init__(self, name, function, args, schedule, priority=None):
+        self.name = name
+        self.function = function
+        self.arguments = args
+        self.schedule = schedule
+        self.priority = priority
+
+# acquires the lock KEYS[1] for ARGV[1] for ARGV[2] milliseconds, or
+# extends it if it's already held by ARGV[1], returns 1 if acquired
+register_script('acquire_lock', """
+local owner = redis.call('GET', KEYS[1])
+if owner == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+elseif not owner then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+end
+return 0
+""")
+
+# claims the idempotency key KEYS[1] for the call ARGV[1] with a lease
+# of ARGV[2] milliseconds, returning the stored result if there is one.
+# claims by the same call (i.e. redeliveries and retries) take the key
+# over, otherwise the waiter ARGV[3] is added to the waiters list KEYS[2]
+# which expires after ARGV[4] seconds
+register_script('claim_idempotency_key', """
+local result = redis.call('HGET', KEYS[1], 'result')
+if result then
+    return {'result', result}
+end
+local running = redis.call('HGET', KEYS[1], 'running')
+if not running or running == ARGV[1] then
+    redis.call('HSET', KEYS[1], 'running', ARGV[1])
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return {'claimed'}
+end
+redis.call('RPUSH', KEYS[2], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+return {'attached'}
+""")
+
+# extends the lease on the idempotency key KEYS[1] to ARGV[2]
+# milliseconds if it's still claimed by the call ARGV[1]
+register_script('refresh_idempotency_key', """
+if redis.call('HGET', KEYS[1], 'running') == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+# stores the result ARGV[3] for the idempotency key KEYS[1] for ARGV[2]
+# seconds, or clears the key if there's no result, and returns the
+# waiters. does nothing if the key has been claimed by another call
+# since the lease of the call ARGV[1] expired
+register_script('complete_idempotency_key', """
+local running = redis.call('HGET', KEYS[1], 'running')
+if running and running ~= ARGV[1] then
+    return {}
+end
+local waiters = redis.call('LRANGE', KEYS[2], 0, -1)
+redis.call('DEL', KEYS[1], KEYS[2])
+if ARGV[3] then
+    redis.call('HSET', KEYS[1], 'result', ARGV[3])
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return waiters
+""")
+
+class TaskScheduler:
+    """Holds delayed calls in a redis sorted set (`<queue>:scheduled`)
+    scored by the time they are due, and runs periodic tasks.
+
+    Every listener runs the poller, but only the one holding the
+    `<queue>:scheduler-lock` lock moves due calls to the task queue and
+    calls periodic tasks, so each is only sent once. Due calls that can't
+    be sent (e.g. they can't be decoded) are moved to the
+    `<queue>:scheduled-failed` sorted set, scored by when they failed.
+    """
+
+    def __init__(self, listener, *, interval=1.0, batch_size=100, lock_timeout=10.0):
+        self.listener = listener
+        self.interval = interval
+        self.batch_size = batch_size
+        self.lock_timeout = lock_timeout
+        self.scheduled_key = "{}:scheduled".format(listener.queue_name)
+        self.failed_key = "{}:scheduled-failed".format(listener.queue_name)
+        self.periodic_key = "{}:periodic".format(listener.queue_name)
+        self.lock_key = "{}:scheduler-lock".format(listener.queue_name)
+        self.periodic_tasks = {}
+        self._task = None
+
+    @property
+    def redis(self):
+        return self.listener.aio_redis_connection_pool
+
+    def add_periodic_task(self, task):
+        self.periodic_tasks[task.name] = task
+
+    async def schedule(self, fnname, data, when, priority=None, shard=None):
+        await self.redis.zadd(self.scheduled_key, when,
+                              msgpack.packb([fnname, data, priority, shard], use_bin_type=True, encoding="utf-8"))
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._poll_loop())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        try:
+            await scripts.compare_and_delete(keys=[self.lock_key], args=[self.listener.listener_id], redis=self.redis)
+        except:
+            log.exception("Error releasing scheduler lock")
+
+    async def _poll_loop(self):
+        while not self.listener._shutdown_task_dispatch:
+            try:
+                if await self.acquire_lock():
+                    await self.poll()
+            except asyncio.CancelledError:
+                raise
+            except:
+                log.exception("Error polling scheduled tasks")
+            await asyncio.sleep(self.interval)
+
+    async def acquire_lock(self):
+        return await scripts.acquire_lock(
+            keys=[self.lock_key], args=[self.listener.listener_id, int(self.lock_timeout * 1000)],
+            redis=self.redis) == 1
+
+    async def poll(self):
+        """sends the calls that are due, should only be called while
+        holding the scheduler lock"""
+
+        now = time.time()
+        while True:
+            entries = await self.redis.zrangebyscore(self.scheduled_key, max=now, offset=0, count=self.batch_size)
+            for entry in entries:
+                try:
+                    fnname, data, priority, shard = msgpack.unpackb(entry, encoding='utf-8')
+                    await self.listener._send_call(fnname, data, priority, shard, wait=True)
+                except (asyncio.CancelledError, asyncio.TimeoutError, aioredis.errors.RedisError, OSError):
+                    # calls are only removed once they've been sent, so
+                    # failing to reach redis part way through a batch
+                    # leaves the rest for the next poll (a call can be
+                    # sent twice if the listener dies between the two)
+                    raise
+                except Exception:
+                    # any other error would fail the call on every poll
+                    log.exception("Unable to send scheduled call, moving it to '{}'".format(self.failed_key))
+                    await self.redis.zadd(self.failed_key, now, entry)
+                await self.redis.zrem(self.scheduled_key, entry)
+            if len(entries) < self.batch_size:
+                break
+
+        if not self.periodic_tasks:
+            return
+        names = list(self.periodic_tasks)
+        next_runs = await self.redis.hmget(self.periodic_key, *names)
+        for name, next_run in zip(names, next_runs):
+            periodic = self.periodic_tasks[name]
+            if next_run is not None and float(next_run) <= now:
+                task = Task(uuid.uuid4().hex, periodic.function, *periodic.arguments, priority=periodic.priority)
+                await self.listener._send_call(
+                    periodic.function, await self.listener._pack_call(task), periodic.priority)
+            if next_run is None or float(next_run) <= now:
+                await self.redis.hset(self.periodic_key, name, periodic.schedule.next_after(now))
+
 class TaskListener:
 
-    def __init__(self, handlers, application, queue=None, ioloop=None, listener_id=None):
+    def __init__(self, handlers, application, queue=None, ioloop=None, listener_id=None, backend='pubsub',
+                 max_concurrency=None, concurrency_limits=None, max_pending=None,
+                 task_timeout=None, retry_policy=None, sweep_interval=1.0,
+                 durable_delays=False, scheduler_interval=1.0, local_dispatch=None,
+                 process_pool_size=None, process_pool_modules=(), priorities=None,
+                 shards=None, consume_shards=False, shard_options=None, serializer=None,
+                 idempotency_ttl=3600, idempotency_lease=10.0, max_task_age=3600):
         """
         handlers: list of TaskHandler classes
         application: a dgas.web.Application
         queue: the name of the subscribe channel to use for the tasks
+        listener_id: unique id for the listener, results of the tasks it
+          calls are sent to the `<queue>:reply:<listener_id>` channel.
+          defaults to a random id
+        backend: how calls are delivered to the listeners, either 'pubsub'
+          (every listener with a handler runs the task), 'streams' (each
+          task is run by a single listener, see StreamTaskQueue) or a
+          callable taking the listener and returning a task queue
+        max_concurrency: the maximum number of calls to run at once
+        concurrency_limits: dict of function name to the maximum number
+          of calls to that function to run at once
+        max_pending: the maximum number of calls to hold while waiting
+          for a free slot. the 'streams' backend leaves calls in the
+          stream instead, with the 'pubsub' backend calls over the limit
+          are dropped
+        task_timeout: default number of seconds to wait for the result of
+          a call before failing with a TaskTimeoutError
+        max_task_age: calls without a timeout fail with a TaskTimeoutError
+          if they have no result this many seconds after being sent, so
+          calls that never get a result aren't kept forever. None waits
+          for the result indefinitely
+        retry_policy: default RetryPolicy for calls
+        sweep_interval: how often (in seconds) calls are checked for
+          timeouts
+        durable_delays: if True, calls with a delay are stored in redis
+          until they are due instead of being held by the caller
+        scheduler_interval: how often (in seconds) the scheduler checks
+          for due calls and periodic tasks
+        local_dispatch: calls to functions with handlers registered on this
+          listener are run directly, skipping redis, if this is 'always',
+          or if it is 'available' and the concurrency limits allow it
+          to start straight away. local calls pass the arguments and
+          results as they are, without serializing them
+        process_pool_size: number of processes to run `cpu_bound` task
+          methods in (defaults to the number of cpus)
+        process_pool_modules: names of modules to import in the process
+          pool workers before they run any calls
+        priorities: dict of priority lane names to weights, e.g.
+          {'high': 10, 'normal': 3, 'low': 1}. calls waiting to be run
+          are taken from each lane in proportion to its weight. must
+          include 'normal', the lane used for calls without a priority.
+          all listeners sharing the queue need the same lanes
+        shards: number of ordered shard queues for calls with a
+          `shard_key` (see ShardedTaskQueue). all listeners sharing the
+          queue need the same number
+        consume_shards: if True the listener takes a share of the shards
+          and runs their calls, it needs handlers for every function
+          called with a shard key
+        shard_options: extra arguments for the ShardedTaskQueue
+        serializer: the TaskSerializer used for messages, listeners
+          sharing the queue need to be able to decode each other's
+          messages
+        idempotency_ttl: how long (in seconds) the results of calls with
+          an `idempotency_key` are kept
+        idempotency_lease: how long (in seconds) a key stays claimed by a
+          call if the listener running it stops refreshing the claim
+          (e.g. because it died), before other calls can claim it
         """
 
         if queue is None:
             queue = TASK_QUEUE_CHANNEL_NAME
-        self.listener_id = listener_id
+        self.listener_id = listener_id or uuid.uuid4().hex
 
         self.application = application
+        self.serializer = serializer or DEFAULT_SERIALIZER
 
         self.ioloop = ioloop or tornado.ioloop.IOLoop.current()
         self.queue_name = queue
+        self.reply_channel = "{}:reply:{}".format(queue, self.listener_id)
         self._task_handlers = {}
         for handler, *optionals in handlers:
             if optionals:
@@ -139,10 +1282,57 @@ class TaskListener:
         self._tasks = {}
         self._running_tasks = {}
         self._shutdown_task_dispatch = False
+        self._cancelling_tasks = False
+
+        self.max_concurrency = max_concurrency
+        self.concurrency_limits = concurrency_limits or {}
+        self.max_pending = max_pending
+
+        if priorities is None:
+            priorities = {DEFAULT_PRIORITY: 1}
+        if DEFAULT_PRIORITY not in priorities:
+            raise ValueError("priorities must include '{}'".format(DEFAULT_PRIORITY))
+        self.priorities = collections.OrderedDict(
+            sorted(priorities.items(), key=lambda item: item[1], reverse=True))
+        self._pending_calls = {priority: collections.deque() for priority in self.priorities}
+        self._lanes = _WeightedRoundRobin(self.priorities)
+        self._in_flight = 0
+        self._in_flight_by_function = {}
+        self._dropped_calls = 0
+        self._capacity_available = asyncio.Event()
+
+        self.task_timeout = task_timeout
+        self.max_task_age = max_task_age
+        self.retry_policy = retry_policy
+        self.sweep_interval = sweep_interval
+        self.idempotency_ttl = idempotency_ttl
+        self.idempotency_lease = idempotency_lease
+
+        self.durable_delays = durable_delays
+        self.scheduler = TaskScheduler(self, interval=scheduler_interval)
+
+        if local_dispatch not in (None, 'always', 'available'):
+            raise ValueError("local_dispatch must be one of None, 'always' or 'available'")
+        self.local_dispatch = local_dispatch
+
+        if shards:
+            self.shard_queue = ShardedTaskQueue(self, shards, consume=consume_shards, **(shard_options or {}))
+        else:
+            self.shard_queue = None
+
+        self.process_pool_size = process_pool_size
+        self.process_pool_modules = tuple(process_pool_modules)
+        self._process_pool = None
+        if isinstance(backend, str):
+            if backend not in TASK_QUEUE_BACKENDS:
+                raise ValueError("Unknown task queue backend: {}".format(backend))
+            backend = TASK_QUEUE_BACKENDS[backend]
+        self.task_queue = backend(self)
 
     def add_task_handler(self, handler, optionals=None):
         if optionals is None:
             optionals = {}
+        instance = handler(self, None, **optionals) if handler.stateless else None
         for fnname in dir(handler):
             if fnname.startswith('_') or fnname in _reserved_task_handler_functions:
                 continue
@@ -151,7 +1341,8 @@ class TaskListener:
                 continue
             if fnname not in self._task_handlers:
                 self._task_handlers[fnname] = []
-            self._task_handlers[fnname].append((handler, optionals))
+            method = getattr(instance, fnname) if instance is not None else None
+            self._task_handlers[fnname].append(_HandlerEntry(handler, optionals, instance, method))
 
     # wrappers for task handlers to use mixins in the same
     # way tornado request handlers do
@@ -172,6 +1363,14 @@ class TaskListener:
         if not hasattr(self.application, 'config') or 'redis' not in self.application.config:
             raise Exception("Missing redis config")
         config = self.application.config['redis']
+        if 'sentinels' in config:
+            password = config.get('password', None)
+            return {
+                'sentinels': parse_sentinel_addresses(config['sentinels']),
+                'master': config.get('sentinel_master', 'mymaster'),
+                'db': int(config.get('db', 0)),
+                'password': password.encode('utf-8') if password else None
+            }
         if 'unix_socket_path' in config:
             address = config['unix_socket_path']
             db = int(config.get('db', 0))
@@ -192,6 +1391,16 @@ class TaskListener:
             'password': password.encode('utf-8') if password else None
         }
 
+    async def _create_redis_pool(self):
+        redis_config = self._get_redis_config()
+        if 'sentinels' in redis_config:
+            # the master is re-resolved by the sentinel after failovers
+            master = redis_config.pop('master')
+            self._redis_sentinel = await aioredis.create_sentinel(
+                redis_config.pop('sentinels'), **redis_config)
+            return self._redis_sentinel.master_for(master)
+        return await aioredis.create_redis_pool(**redis_config)
+
     async def _task_dispatch_loop(self):
 
         while not self._shutdown_task_dispatch:
@@ -209,43 +1418,364 @@ class TaskListener:
 
         with await self.aio_redis_connection_pool as sub_con:
             self._sub_con = sub_con
-            res = await self._sub_con.subscribe(self.queue_name)
-            ch = res[0]
-            while (await ch.wait_message()):
-                message = await ch.get()
-                try:
-                    task_id, action, *args = msgpack.unpackb(message, encoding='utf-8')
-                except (TypeError, ValueError):
-                    log.exception("Invalid message: {}".format(message))
-                    continue
-                if action == 'call':
-                    fnname, *args = args
-                    if fnname in self._task_handlers:
-                        for handler_class, optionals in self._task_handlers[fnname]:
-                            try:
-                                handler = handler_class(self, task_id, **optionals)
-                                runner = asyncio.ensure_future(handler._call_handler(fnname, args))
-                                self._running_tasks[task_id] = runner
-                                runner.add_done_callback(partial(self._runner_done, task_id))
-                            except:
-                                log.exception("error calling function: {}".format(fnname))
-                elif action == 'result':
-                    if task_id in self._tasks:
-                        f = self._tasks.pop(task_id)
-                        f.set_result(args[0] if args else None)
-                elif action == 'exception':
-                    if task_id in self._tasks:
-                        error = TaskError(*args)
-                        f = self._tasks.pop(task_id)
-                        f.set_exception(error)
-                else:
-                    log.error("Unknown message: {}".format(message))
-                    continue
+            receiver = aioredis.pubsub.Receiver()
+            await self._sub_con.subscribe(*[
+                receiver.channel(name) for name in [self.reply_channel, *self.task_queue.channels]])
+            while (await receiver.wait_message()):
+                message = await receiver.get()
+                if message is None:
+                    break
+                self._dispatch_message(message[1])
 
             self._sub_con = None
 
+    def _dispatch_message(self, message, ack=None):
+        """handles a message from the task queue, `ack` is called once the
+        message has been dealt with"""
+
+        if self.serializer.get_reference(message) is not None:
+            asyncio.ensure_future(self._dispatch_stored_message(message, ack))
+            return
+        try:
+            task_id, action, *args = self.serializer.decode(message)
+        except Exception:
+            log.exception("Invalid message: {}".format(message))
+            if ack:
+                ack()
+            return
+        if action == 'task':
+            fnname, args, options = args
+            self._dispatch_call(task_id, fnname, args, options, ack)
+            return
+        elif action == 'call':
+            # calls from listeners without reply channels
+            fnname, *args = args
+            self._dispatch_call(task_id, fnname, args, {'reply_to': self.queue_name}, ack)
+            return
+        elif action == 'result':
+            if task_id in self._tasks:
+                f = self._tasks.pop(task_id)
+                f.set_result(args[0] if args else None)
+        elif action == 'exception':
+            if task_id in self._tasks:
+                self._task_failed(self._tasks[task_id], TaskError(*args))
+        else:
+            log.error("Unknown message: {}".format(message))
+        if ack:
+            ack()
+
+    async def _dispatch_stored_message(self, message, ack=None):
+        key, task_id, reply_to = self.serializer.get_reference(message)
+        try:
+            data = await self.aio_redis_connection_pool.get(key)
+        except Exception:
+            log.exception("Error loading stored task message")
+            data = None
+        if data is None:
+            log.error("Stored task message '{}' is missing".format(key))
+            if reply_to is not None:
+                await self._send_exception(reply_to, task_id, TaskError(
+                    'TaskMessageExpired', "Stored task message '{}' is missing".format(key), ''))
+            if ack:
+                ack()
+            return
+        self._dispatch_message(data, ack)
+
+    async def _store_large_message(self, data, ttl=None, task_id=None, reply_to=None):
+        """stores `data` in redis if it's over the serializer's reference
+        threshold, returning the message to send instead"""
+        if not self.serializer.should_store(data):
+            return data
+        key = "{}:message:{}".format(self.queue_name, uuid.uuid4().hex)
+        await self.aio_redis_connection_pool.set(key, data, expire=int(ttl or self.serializer.reference_ttl))
+        return self.serializer.encode_reference(key, task_id, reply_to)
+
+    async def _pack_call(self, task, ttl=None):
+        """packs the call, storing it in redis if it's too large unless it
+        goes to a queue that holds on to calls (streams and shards)"""
+        data = task.pack(self.serializer)
+        if task.shard is not None or getattr(self.task_queue, 'holds_calls', False):
+            return data
+        return await self._store_large_message(data, ttl, task.task_id, task.reply_to)
+
+    async def _send_exception(self, reply_to, task_id, error):
+        try:
+            await self.aio_redis_connection_pool.publish(reply_to, await self._pack_message(
+                [task_id, 'exception', error.exc_type_name, error.exc_message, error.formatted_traceback]))
+        except Exception:
+            log.exception("Error sending task exception")
+
+    async def _pack_message(self, message):
+        return await self._store_large_message(self.serializer.encode(message))
+
+    def _idempotency_keys(self, key):
+        key = "{}:idempotency:{}".format(self.queue_name, key)
+        return [key, key + ':waiters']
+
+    async def _claim_idempotency_key(self, key, task_id, reply_to):
+        """returns ('claimed', None) if the call should be run, ('result',
+        result) if it has already been run, or ('attached', None) if it
+        is running and the result will be sent to `reply_to` when done"""
+
+        waiter = msgpack.packb([reply_to, task_id], use_bin_type=True, encoding="utf-8")
+        state, *result = await scripts.claim_idempotency_key(
+            keys=self._idempotency_keys(key),
+            args=[task_id, int(self.idempotency_lease * 1000), waiter, self.idempotency_ttl],
+            redis=self.aio_redis_connection_pool)
+        state = state.decode('utf-8')
+        if state == 'result':
+            return state, self.serializer.decode(result[0])
+        return state, None
+
+    async def _refresh_idempotency_lease(self, key, task_id):
+        """keeps the claim on the key while the call is running"""
+        while True:
+            await asyncio.sleep(self.idempotency_lease / 3)
+            try:
+                refreshed = await scripts.refresh_idempotency_key(
+                    keys=self._idempotency_keys(key)[:1], args=[task_id, int(self.idempotency_lease * 1000)],
+                    redis=self.aio_redis_connection_pool)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Error refreshing idempotency key lease")
+                continue
+            if not refreshed:
+                log.warning("Lost the claim on idempotency key '{}'".format(key))
+                return
+
+    async def _complete_idempotency_key(self, key, task_id, *result):
+        """stores the result of the call (if given), or releases the key
+        so the call can be run again. returns the (channel, task_id) of
+        the calls waiting for the result"""
+
+        args = [task_id, self.idempotency_ttl]
+        if result:
+            args.append(self.serializer.encode(result[0]))
+        waiters = await scripts.complete_idempotency_key(
+            keys=self._idempotency_keys(key), args=args, redis=self.aio_redis_connection_pool)
+        waiters = [msgpack.unpackb(waiter, encoding='utf-8') for waiter in waiters]
+        return [(channel, task_id) for channel, task_id in waiters if channel is not None]
+
+    def _dispatch_call(self, task_id, fnname, args, options, ack=None):
+        if fnname not in self._task_handlers:
+            if ack:
+                ack()
+            return
+        if self._has_capacity(fnname):
+            self._run_call(task_id, fnname, args, options, ack)
+        elif (ack is None and not options.get('local') and self.max_pending is not None and
+              self.queue_depth >= self.max_pending):
+            # calls delivered by a backend that can't hold on to them (i.e.
+            # pubsub) are dropped once the local queue is full
+            self._dropped_calls += 1
+            log.warning("Task queue full, dropping call to '{}'".format(fnname))
+            if options.get('reply_to') is not None:
+                # let the caller fail straight away instead of timing out
+                asyncio.ensure_future(self._send_exception(options['reply_to'], task_id, TaskQueueFullError(fnname)))
+        else:
+            priority = options.get('priority')
+            if priority not in self._pending_calls:
+                priority = DEFAULT_PRIORITY
+            self._pending_calls[priority].append((task_id, fnname, args, options, ack))
+
+    def _has_capacity(self, fnname):
+        if self.max_concurrency is not None and self._in_flight >= self.max_concurrency:
+            return False
+        limit = self.concurrency_limits.get(fnname)
+        return limit is None or self._in_flight_by_function.get(fnname, 0) < limit
+
+    def _run_call(self, task_id, fnname, args, options, ack):
+        expires = options.get('expires')
+        if expires is not None and expires < time.time():
+            # the caller has already given up on the result
+            log.warning("Skipping expired call to '{}'".format(fnname))
+            if ack:
+                ack()
+            return
+        runners = []
+        for entry in self._task_handlers.get(fnname, ()):
+            try:
+                if entry.instance is not None:
+                    handler, method = entry.instance, entry.method
+                else:
+                    handler = entry.handler_class(self, task_id, **entry.optionals)
+                    method = getattr(handler, fnname)
+                if options.get('local'):
+                    runner = asyncio.ensure_future(handler._run_method(method, args))
+                    runner.add_done_callback(partial(self._local_call_done, task_id, fnname))
+                else:
+                    runner = asyncio.ensure_future(handler._call_handler(
+                        task_id, fnname, method, args, options.get('reply_to'), options.get('idempotency_key')))
+                self._running_tasks[task_id] = runner
+                runner.add_done_callback(partial(self._runner_done, task_id))
+                runners.append(runner)
+            except:
+                log.exception("error calling function: {}".format(fnname))
+        self._in_flight += 1
+        self._in_flight_by_function[fnname] = self._in_flight_by_function.get(fnname, 0) + 1
+        done = asyncio.gather(*runners, return_exceptions=True)
+        done.add_done_callback(partial(self._call_done, fnname, ack))
+
+    def _call_done(self, fnname, ack, runners):
+        self._in_flight -= 1
+        self._in_flight_by_function[fnname] -= 1
+        if self._in_flight_by_function[fnname] == 0:
+            del self._in_flight_by_function[fnname]
+        # tasks cancelled by a hard shutdown are left unacknowledged
+        # so they can be picked up by another listener
+        if ack and not self._cancelling_tasks:
+            ack()
+        if not self._cancelling_tasks:
+            self._run_pending_calls()
+        self._capacity_available.set()
+
+    def _run_pending_calls(self):
+        blocked = set()
+        while self.max_concurrency is None or self._in_flight < self.max_concurrency:
+            priority = self._next_lane(blocked)
+            if priority is None:
+                break
+            lane = self._pending_calls[priority]
+            for i, call in enumerate(lane):
+                if self._has_capacity(call[1]):
+                    del lane[i]
+                    self._run_call(*call)
+                    break
+            else:
+                # every call in the lane is waiting on a function limit
+                blocked.add(priority)
+
+    def _next_lane(self, blocked):
+        """picks the lane to run the next pending call from, using smooth
+        weighted round robin over the lanes with calls waiting"""
+        return self._lanes.next([priority for priority, lane in self._pending_calls.items()
+                                 if lane and priority not in blocked])
+
+    async def wait_for_capacity(self, timeout=None):
+        """waits until a call finishes or `timeout` seconds"""
+        self._capacity_available.clear()
+        try:
+            await asyncio.wait_for(self._capacity_available.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def functions_with_capacity(self):
+        """returns the names of the functions with handlers that can be
+        run without going over the concurrency limits"""
+        return [fnname for fnname in self._task_handlers if self._has_capacity(fnname)]
+
+    def function_capacity(self, fnname):
+        """the number of calls to `fnname` that can be started before
+        reaching its limit in `concurrency_limits`, or None if there is
+        no limit"""
+        limit = self.concurrency_limits.get(fnname)
+        if limit is None:
+            return None
+        return max(limit - self._in_flight_by_function.get(fnname, 0), 0)
+
+    @property
+    def available_capacity(self):
+        """the number of calls that can be started before reaching
+        `max_concurrency`, or None if there is no limit"""
+        if self.max_concurrency is None:
+            return None
+        return max(self.max_concurrency - self._in_flight, 0)
+
+    @property
+    def in_flight(self):
+        """the number of calls currently running"""
+        return self._in_flight
+
+    @property
+    def queue_depth(self):
+        """the number of calls waiting for a free slot"""
+        return sum(len(lane) for lane in self._pending_calls.values())
+
+    def get_stats(self):
+        functions = {}
+        for fnname, count in self._in_flight_by_function.items():
+            functions.setdefault(fnname, {'in_flight': 0, 'queue_depth': 0})['in_flight'] = count
+        for lane in self._pending_calls.values():
+            for call in lane:
+                functions.setdefault(call[1], {'in_flight': 0, 'queue_depth': 0})['queue_depth'] += 1
+        return {
+            'in_flight': self._in_flight,
+            'queue_depth': self.queue_depth,
+            'dropped': self._dropped_calls,
+            'functions': functions,
+            'priorities': {priority: len(lane) for priority, lane in self._pending_calls.items()},
+            'shards': sorted(self.shard_queue.owned) if self.shard_queue is not None else []
+        }
+
+    def _local_call_done(self, task_id, fnname, runner):
+        task = self._tasks.get(task_id)
+        if task is None or runner.cancelled():
+            return
+        exc = runner.exception()
+        if exc is None:
+            self._tasks.pop(task_id)
+            task.set_result(runner.result())
+            return
+        log.error("call to '{}' threw exception".format(fnname), exc_info=(type(exc), exc, exc.__traceback__))
+        trace = "".join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+        self._task_failed(task, TaskError(type(exc).__name__, str(exc), trace))
+
+    def _get_process_pool(self):
+        if self._process_pool is None:
+            # forked workers inherit the modules imported here, the
+            # initializer covers platforms that spawn workers instead
+            _import_modules(self.process_pool_modules)
+            kwargs = {}
+            if sys.version_info >= (3, 7):
+                kwargs.update(initializer=_import_modules, initargs=(self.process_pool_modules,))
+            self._process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.process_pool_size, **kwargs)
+        return self._process_pool
+
+    def run_in_process(self, fn, *args):
+        """runs `fn(*args)` in the listener's process pool"""
+        return asyncio.get_event_loop().run_in_executor(self._get_process_pool(), fn, *args)
+
+    def _task_failed(self, task, error):
+        if task.retry is not None and task.retry.should_retry(error, task.retries):
+            delay = task.retry.get_delay(task.retries)
+            task.retries += 1
+            task.deadline = None
+            task.sent = None
+            log.warning("Retrying '{}' in {} seconds after {}".format(task.function, delay, error.exc_type_name))
+            task._calling_task = asyncio.get_event_loop().call_later(delay, partial(self._call_task, task))
+            return
+        self._tasks.pop(task.task_id, None)
+        task.set_exception(error)
+
+    def sweep_tasks(self):
+        """fails calls that have passed their timeout (or `max_task_age`
+        if they have none) and forgets calls that were cancelled by the
+        caller"""
+
+        now = time.time()
+        for task in list(self._tasks.values()):
+            if task._future.done():
+                self._tasks.pop(task.task_id, None)
+            elif task.deadline is not None:
+                if task.deadline <= now:
+                    self._task_failed(task, TaskTimeoutError(task.function, task.timeout))
+            elif self.max_task_age is not None and task.sent is not None and \
+                    task.sent + self.max_task_age <= now:
+                # not retried, the call may still be running somewhere
+                self._tasks.pop(task.task_id, None)
+                task.set_exception(TaskTimeoutError(task.function, self.max_task_age))
+
+    async def _sweep_loop(self):
+        while not self._shutdown_task_dispatch:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                self.sweep_tasks()
+            except:
+                log.exception("Error sweeping tasks")
+
     def _runner_done(self, task_id, runner):
-        self._running_tasks.pop(task_id)
+        self._running_tasks.pop(task_id, None)
 
     def start_task_listener(self):
         return asyncio.ensure_future(self._start())
@@ -255,21 +1785,54 @@ class TaskListener:
 
     async def _start(self):
         self._shutdown_task_dispatch = False
+        self._cancelling_tasks = False
         try:
             if not hasattr(self, 'aio_redis_connection_pool') or self.aio_redis_connection_pool.closed:
-                self.aio_redis_connection_pool = await aioredis.create_redis_pool(**self._get_redis_config())
+                self.aio_redis_connection_pool = await self._create_redis_pool()
             if not hasattr(self, '_disp_task') or self._disp_task.done():
                 self._disp_task = asyncio.ensure_future(self._task_dispatch_loop())
+            if not hasattr(self, '_sweep_task') or self._sweep_task.done():
+                self._sweep_task = asyncio.ensure_future(self._sweep_loop())
+            self.task_queue.start()
+            if self.shard_queue is not None:
+                self.shard_queue.start()
+            if self.durable_delays or self.scheduler.periodic_tasks:
+                self.scheduler.start()
         except:
             log.exception("failed to start")
 
     async def _shutdown(self, *, soft=False):
         self._shutdown_task_dispatch = True
-        for task_id, runner in list(self._running_tasks.items()):
-            if not soft and not runner.done():
-                print('cancelling', task_id)
-                runner.cancel()
-            await runner
+        self._cancelling_tasks = not soft
+        self.task_queue.close()
+        if self.shard_queue is not None:
+            self.shard_queue.close()
+        if hasattr(self, '_sweep_task'):
+            self._sweep_task.cancel()
+        if not soft:
+            for lane in self._pending_calls.values():
+                lane.clear()
+        # a soft shutdown also runs the calls waiting for a free slot
+        while self._running_tasks or self._in_flight:
+            for task_id, runner in list(self._running_tasks.items()):
+                if not soft and not runner.done():
+                    print('cancelling', task_id)
+                    runner.cancel()
+                await runner
+            if self._in_flight:
+                await self.wait_for_capacity(0.1)
+        await self.task_queue.wait_closed()
+        if self.shard_queue is not None:
+            await self.shard_queue.wait_closed()
+        await self.scheduler.stop()
+        if self._process_pool is not None:
+            pool, self._process_pool = self._process_pool, None
+            if soft:
+                # waiting for the workers to exit blocks, so it's done in
+                # a thread to keep the loop running while they finish
+                await asyncio.get_event_loop().run_in_executor(None, pool.shutdown, True)
+            else:
+                pool.shutdown(wait=False)
         if hasattr(self, '_sub_con') and self._sub_con is not None:
             self._sub_con.close()
             await self._sub_con.wait_closed()
@@ -281,36 +1844,191 @@ class TaskListener:
         if hasattr(self, 'aio_redis_connection_pool'):
             self.aio_redis_connection_pool.close()
             await self.aio_redis_connection_pool.wait_closed()
+        if getattr(self, '_redis_sentinel', None) is not None:
+            self._redis_sentinel.close()
+            await self._redis_sentinel.wait_closed()
+            self._redis_sentinel = None
+
+    async def _send_call(self, fnname, data, priority=None, shard=None, wait=False):
+        """sends the call, if `wait` is True sharded calls are written to
+        their shard before returning, instead of being queued"""
+        if shard is None:
+            await self.task_queue.publish(fnname, data, priority)
+        elif self.shard_queue is None:
+            raise Exception("Sharded call to '{}' on a listener without shards".format(fnname))
+        elif wait:
+            await self.shard_queue.add(shard, data)
+        else:
+            self.shard_queue.send(shard, data)
 
     async def _publish_task(self, task):
         """publishes the task to the redis channel"""
         try:
-            await self.aio_redis_connection_pool.publish(
-                self.queue_name,
-                task.pack())
+            data = await self._pack_call(task)
+            await self._send_call(task.function, data, task.priority, task.shard)
         except aioredis.errors.PoolClosedError:
             # ignoring pool closed errors
             pass
 
+    async def _publish_tasks(self, tasks):
+        try:
+            calls = []
+            for task in tasks:
+                calls.append((task.function, await self._pack_call(task), task.priority))
+            await self.task_queue.publish_many(calls)
+        except aioredis.errors.PoolClosedError:
+            pass
+
+    def _start_call(self, task):
+        """starts the timeout for the call, and runs it if it should be
+        run locally. returns False if the call still needs sending"""
+        task.sent = time.time()
+        if task.timeout is not None:
+            task.deadline = time.time() + task.timeout
+            task.expires = task.deadline
+        if task.shard is None and task.idempotency_key is None and self._should_run_locally(task.function):
+            options = task.options
+            options['local'] = True
+            self._dispatch_call(task.task_id, task.function, task.arguments, options)
+            return True
+        return False
+
     def _call_task(self, task):
         """used to prevent the creation of a coroutine before the task actually gets called"""
+        if task._future.done() or self._start_call(task):
+            return
+        if task.shard is not None:
+            # sent straight away to keep the calls in order
+            self.shard_queue.send(task.shard, task.pack(self.serializer))
+            return
         return asyncio.ensure_future(self._publish_task(task))
 
-    def call_task(self, function, *args, delay=None):
+    def _should_run_locally(self, fnname):
+        if self.local_dispatch is None or fnname not in self._task_handlers:
+            return False
+        return self.local_dispatch == 'always' or self._has_capacity(fnname)
+
+    async def _schedule_task(self, task, delay):
+        when = task.sent = time.time() + delay
+        if task.timeout is not None:
+            task.deadline = task.expires = when + task.timeout
+        try:
+            # stored messages have to outlive the delay
+            data = await self._pack_call(task, ttl=self.serializer.reference_ttl + delay)
+            await self.scheduler.schedule(task.function, data, when, task.priority, task.shard)
+        except aioredis.errors.PoolClosedError:
+            pass
+
+    def add_periodic_task(self, function, *args, cron=None, interval=None, name=None, priority=None):
+        """calls `function` with `args` on the schedule given by either
+        `cron` (a cron expression in UTC) or `interval` (in seconds).
+        every listener sharing the queue should register the same
+        periodic tasks, each run is only called by one of them.
+        """
+
+        if (cron is None) == (interval is None):
+            raise ValueError("One of cron or interval is required")
+        self._check_priority(priority)
+        schedule = CronSchedule(cron) if cron is not None else IntervalSchedule(interval)
+        self.scheduler.add_periodic_task(PeriodicTask(name or function, function, args, schedule, priority))
+        if hasattr(self, 'aio_redis_connection_pool') and not self._shutdown_task_dispatch:
+            self.scheduler.start()
+
+    def _check_priority(self, priority):
+        if priority is not None and priority not in self.priorities:
+            raise ValueError("Unknown task priority: {}".format(priority))
+
+    def _new_task(self, function, args, timeout, retry, priority, shard_key=None, idempotency_key=None):
+        self._check_priority(priority)
+        shard = None
+        if shard_key is not None:
+            if self.shard_queue is None:
+                raise ValueError("shard_key requires a listener with shards")
+            shard = self.shard_queue.shard_for(shard_key)
         task_id = uuid.uuid4().hex
-        task = self._tasks[task_id] = Task(task_id, function, *args)
+        task = self._tasks[task_id] = Task(
+            task_id, function, *args, reply_to=self.reply_channel,
+            timeout=timeout if timeout is not None else self.task_timeout,
+            retry=retry if retry is not None else self.retry_policy,
+            priority=priority, shard=shard, idempotency_key=idempotency_key)
+        return task
+
+    def call_task(self, function, *args, delay=None, timeout=None, retry=None, priority=None, shard_key=None,
+                  idempotency_key=None):
+        """calls `function` on a listener with a handler for it, returning
+        an awaitable Task for the result.
+
+        delay: seconds to wait before sending the call (see `durable_delays`)
+        timeout: seconds to wait for the result of each attempt (defaults
+          to the listener's `task_timeout`)
+        retry: RetryPolicy to use (defaults to the listener's `retry_policy`)
+        priority: the priority lane to send the call on (see `priorities`)
+        shard_key: calls with the same shard key are run one at a time in
+          the order they were sent (see `shards`). sharded calls don't
+          use the priority lanes
+        idempotency_key: calls with the same key are only run once every
+          `idempotency_ttl` seconds. duplicates sent while the first call
+          is running get its result when it finishes, later ones get the
+          stored result. failed calls aren't stored. these calls are never
+          run locally
+        """
+        task = self._new_task(function, args, timeout, retry, priority, shard_key, idempotency_key)
         loop = asyncio.get_event_loop()
         fn = partial(self._call_task, task)
-        if delay:
+        if delay and self.durable_delays:
+            task._calling_task = asyncio.ensure_future(self._schedule_task(task, delay))
+        elif delay:
             task._calling_task = loop.call_later(delay, fn)
         else:
             task._calling_task = loop.call_soon(fn)
         return task
 
+    def call_tasks_many(self, function, arg_lists, *, timeout=None, retry=None, priority=None):
+        """calls `function` once for each list of arguments in `arg_lists`,
+        sending all the calls in one pipelined write. returns the list of
+        Tasks (see `gather_results`)"""
+
+        tasks = [self._new_task(function, args, timeout, retry, priority) for args in arg_lists]
+        remote = [task for task in tasks if not self._start_call(task)]
+        if remote:
+            asyncio.ensure_future(self._publish_tasks(remote))
+        return tasks
+
+async def gather_results(tasks, timeout=None):
+    """waits for the results of `tasks`, returning them in the same order.
+    calls that failed have their exception in place of the result, calls
+    still running after `timeout` seconds are cancelled and have a
+    TaskTimeoutError"""
+
+    if not tasks:
+        return []
+    futures = [task._future for task in tasks]
+    await asyncio.wait(futures, timeout=timeout)
+    results = []
+    for task in tasks:
+        if not task._future.done():
+            task.cancel()
+            results.append(TaskTimeoutError(task.function, timeout))
+        elif task._future.cancelled():
+            results.append(asyncio.CancelledError())
+        elif task._future.exception() is not None:
+            results.append(task._future.exception())
+        else:
+            results.append(task._future.result())
+    return results
+
 class TaskDispatcher:
 
-    def __init__(self, task_listener):
+    def __init__(self, task_listener, priority=None):
         self._task_listener = task_listener
+        self._priority = priority
+
+    def with_priority(self, priority):
+        """returns a dispatcher sending calls on the `priority` lane"""
+        self._task_listener._check_priority(priority)
+        return TaskDispatcher(self._task_listener, priority)
 
     def __getattr__(self, function):
+        if self._priority is not None:
+            return partial(self._task_listener.call_task, function, priority=self._priority)
         return partial(self._task_listener.call_task, function)
@@ -0,0 +1,51 @@
+"""Microbenchmark of the TaskListener dispatch loop.
+
+Runs calls through `_dispatch_message` (decoding, handler lookup and
+creation, running the method) without redis, for handlers created per
+call and for stateless handlers.
+
+    python -m dgas.test.benchmark_tasks [number of calls]
+"""
+
+import asyncio
+import sys
+import time
+
+from dgas.tasks import Task, TaskHandler, TaskListener
+
+class BenchmarkTaskHandler(TaskHandler):
+
+    def initialize(self, counter=None):
+        self.counter = counter
+
+    def add(self, a, b):
+        return a + b
+
+    async def async_add(self, a, b):
+        return a + b
+
+class StatelessBenchmarkTaskHandler(BenchmarkTaskHandler):
+
+    stateless = True
+
+async def run_benchmark(handler_class, function, calls):
+    listener = TaskListener([(handler_class, {'counter': 0})], None)
+    # calls without a reply channel don't send results, so the
+    # benchmark doesn't need redis
+    messages = [Task(str(i), function, i, i).pack() for i in range(calls)]
+    start = time.perf_counter()
+    for message in messages:
+        listener._dispatch_message(message)
+    while listener.in_flight:
+        await listener.wait_for_capacity(0.1)
+    return calls / (time.perf_counter() - start)
+
+def main(calls=100000):
+    loop = asyncio.get_event_loop()
+    for handler_class in (BenchmarkTaskHandler, StatelessBenchmarkTaskHandler):
+        for function in ('add', 'async_add'):
+            rate = loop.run_until_complete(run_benchmark(handler_class, function, calls))
+            print("{:<32} {:<10} {:>10.0f} calls/s".format(handler_class.__name__, function, rate))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
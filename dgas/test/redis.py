@@ -34,6 +34,25 @@ class RedisServer(testing.redis.RedisServer):
         """stops redis, without calling the cleanup"""
         self.terminate(signal.SIGTERM)
 
+class RedisSentinelServer(RedisServer):
+    """runs redis-server in sentinel mode, monitoring the master at
+    `master_port` under the name `master_name`"""
+
+    def initialize(self):
+        super().initialize()
+        master_name = self.settings.get('master_name', 'mymaster')
+        self.redis_conf['sentinel monitor'] = "{} 127.0.0.1 {} 1".format(master_name, self.settings['master_port'])
+        self.redis_conf['sentinel down-after-milliseconds'] = "{} 1000".format(master_name)
+        self.redis_conf['sentinel failover-timeout'] = "{} 5000".format(master_name)
+        # sentinels don't store any data
+        self.redis_conf.pop('dbfilename', None)
+
+    def get_server_commandline(self):
+        return super().get_server_commandline() + ['--sentinel']
+
+    def address(self):
+        return "127.0.0.1:{}".format(self.redis_conf['port'])
+
 
 def requires_redis(func=None, pass_redis=None):
     """Used to ensure all database connections are returned to the pool
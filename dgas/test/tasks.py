@@ -1,9 +1,10 @@
 import asyncio
 from dgas.tasks import TaskListener
 
-def requires_task_listener(func=None):
+def requires_task_listener(func=None, **listener_kwargs):
     """Used to ensure all database connections are returned to the pool
-    before finishing the test"""
+    before finishing the test. `listener_kwargs` are passed on to the
+    TaskListener"""
 
     def wrap(fn):
 
@@ -12,7 +13,7 @@ def requires_task_listener(func=None):
             if 'redis' not in self._app.config:
                 raise Exception("Missing redis config from setup")
 
-            self._app.task_listener = TaskListener([], self._app)
+            self._app.task_listener = TaskListener([], self._app, **listener_kwargs)
 
             kwargs['task_listener'] = self._app.task_listener
 
@@ -1,8 +1,18 @@
+import asyncio
+import os
+import tempfile
+from decimal import Decimal
+
 from dgas.test.base import AsyncHandlerTest
 from dgas.test.database import requires_database
 
 from dgas.handlers import BaseHandler
-from dgas.database import DatabaseMixin
+from dgas.database import (
+    DatabaseMixin, create_tables, wait_for_migration, get_latest_migration_version,
+    get_query_coalescer, create_pool, prepare_database_shards, set_database_shards,
+    HandlerDatabasePoolContext, warm_up_pool, DatabaseNotificationListener, _array_parameters_cache)
+from dgas.config import config
+from dgas.errors import DatabaseError
 from tornado.testing import gen_test
 
 class Handler(DatabaseMixin, BaseHandler):
@@ -36,3 +46,343 @@ class DatabaseTest(AsyncHandlerTest):
         async with self.pool.acquire() as con:
             row = await con.fetchrow("SELECT * FROM store WHERE key = $1", "TESTKEY")
             self.assertEqual(row['value'], '1')
+
+class MigrationTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    @gen_test(timeout=30)
+    @requires_database
+    async def test_concurrent_migration(self):
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.chdir(tmpdir)
+            try:
+                os.mkdir("sql")
+                with open("sql/create_tables.sql", "w") as f:
+                    f.write("CREATE TABLE store (key VARCHAR PRIMARY KEY, value VARCHAR);")
+
+                async with self.pool.acquire() as con:
+                    await create_tables(con)
+                    self.assertEqual(await con.fetchval("SELECT version_number FROM database_version"), 0)
+
+                with open("sql/migrate_00000001.sql", "w") as f:
+                    f.write("ALTER TABLE store ADD COLUMN extra INTEGER;")
+                with open("sql/migrate_00000002.sql", "w") as f:
+                    # would fail with a unique violation if run twice
+                    f.write("INSERT INTO store VALUES ('key', 'value', 1);")
+                self.assertEqual(get_latest_migration_version(), 2)
+
+                async with self.pool.acquire() as con1, self.pool.acquire() as con2, self.pool.acquire() as con3:
+                    # use a large poll frequency to make sure the waiter is
+                    # woken up by the notification rather than polling
+                    waiter = asyncio.ensure_future(wait_for_migration(con1, poll_frequency=60))
+                    await asyncio.gather(create_tables(con2), create_tables(con3))
+                    await asyncio.wait_for(waiter, 5)
+
+                    self.assertEqual(await con2.fetchval("SELECT version_number FROM database_version"), 2)
+                    self.assertEqual(await con2.fetchval("SELECT COUNT(*) FROM store"), 1)
+            finally:
+                os.chdir(cwd)
+
+class QueryCoalescingTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    @gen_test
+    @requires_database
+    async def test_identical_queries_are_coalesced(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("CREATE SEQUENCE test_seq")
+
+        coalescer = get_query_coalescer(self.pool)
+        self.assertIs(coalescer, get_query_coalescer(self.pool))
+
+        query = "SELECT nextval('test_seq'), pg_sleep(0.1)"
+        rows = await asyncio.gather(*[coalescer.fetchrow(query) for _ in range(10)])
+        # all calls should have shared the same execution
+        self.assertEqual(set(row[0] for row in rows), {1})
+        self.assertEqual(len(coalescer._inflight), 0)
+
+        # results are not reused once the query has completed
+        row = await coalescer.fetchrow(query)
+        self.assertEqual(row[0], 2)
+
+        # different arguments are not coalesced
+        rows = await asyncio.gather(*[coalescer.fetchrow("SELECT nextval('test_seq'), $1::INTEGER", i) for i in range(3)])
+        self.assertEqual(len(set(row[0] for row in rows)), 3)
+
+class EthereumCodecsTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    @gen_test
+    @requires_database
+    async def test_ethereum_codecs(self):
+
+        dbconfig = dict(config['database'])
+        dbconfig.pop('ssl', None)
+        pool = await create_pool(ethereum_codecs=True, min_size=1, max_size=1, **dbconfig)
+        try:
+            async with pool.acquire() as con:
+                await con.execute("CREATE TABLE balances (address BYTEA PRIMARY KEY, value NUMERIC)")
+                values = [
+                    ("0x0000000000000000000000000000000000000001", 0),
+                    ("0x056db290f8ba3250ca64a45d16284d04bc6f5fbf", 10 ** 30),
+                    ("0xde3d2d9dd52ea80f7799ef4791063a5458d13913", -123456789012345678900),
+                    ("0xe8e7d8d7d4ef3d0e8bed9e4cc3b7cb1e1c0d5e80", 100000001)
+                ]
+                await con.executemany("INSERT INTO balances VALUES ($1, $2)", values)
+                rows = await con.fetch("SELECT address, value FROM balances ORDER BY address")
+                self.assertEqual([tuple(row) for row in rows], values)
+                # make sure values are stored as expected
+                self.assertEqual(await con.fetchval("SELECT value::VARCHAR FROM balances WHERE value > $1", 10 ** 20),
+                                 str(10 ** 30))
+                self.assertEqual(await con.fetchval("SELECT LENGTH(address) FROM balances LIMIT 1"), 20)
+                # values with a scale are read as Decimals
+                self.assertEqual(await con.fetchval("SELECT 12345.678::NUMERIC"), Decimal('12345.678'))
+                self.assertEqual(await con.fetchval("SELECT -0.05::NUMERIC(10, 2)"), Decimal('-0.05'))
+                await con.execute("CREATE TABLE prices (name VARCHAR PRIMARY KEY, price NUMERIC(20, 4))")
+                await con.execute("INSERT INTO prices VALUES ($1, $2)", "eth", Decimal('1234.5'))
+                price = await con.fetchval("SELECT price FROM prices WHERE name = $1", "eth")
+                self.assertIsInstance(price, Decimal)
+                self.assertEqual(str(price), '1234.5000')
+                self.assertEqual(str(await con.fetchval("SELECT 12345.000::NUMERIC")), '12345.000')
+        finally:
+            await pool.close()
+
+class ShardingTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    @gen_test(timeout=30)
+    @requires_database
+    async def test_sharded_pools(self):
+
+        dsns = []
+        async with self.pool.acquire() as con:
+            for i in range(3):
+                await con.execute("CREATE DATABASE shard_{}".format(i))
+                dsns.append("postgres://{user}@{host}:{port}/shard_{}".format(i, **config['database']))
+
+        shards = await prepare_database_shards({'dsns': ','.join(dsns), 'min_size': 1, 'max_size': 2},
+                                               handle_migration=True)
+        set_database_shards(shards)
+        try:
+            self.assertEqual(len(shards), 3)
+            await shards.execute("CREATE TABLE balances (address VARCHAR PRIMARY KEY, value INTEGER)")
+
+            addresses = ["0x{:040x}".format(i) for i in range(30)]
+            db = HandlerDatabasePoolContext(self.pool)
+            for i, address in enumerate(addresses):
+                async with db.for_key(address) as shard_db:
+                    await shard_db.execute("INSERT INTO balances VALUES ($1, $2)", address, i)
+                    await shard_db.commit()
+
+            # routing is stable and case insensitive
+            for address in addresses:
+                self.assertIs(shards.get_pool(address), shards.get_pool(address.upper()))
+                async with db.for_key(address) as shard_db:
+                    self.assertIsNotNone(await shard_db.fetchval("SELECT value FROM balances WHERE address = $1", address))
+
+            # every shard should have been used
+            counts = [len(await pool.fetch("SELECT * FROM balances")) for pool in shards.pools]
+            self.assertTrue(all(count > 0 for count in counts))
+
+            rows = await shards.fetch("SELECT * FROM balances")
+            self.assertEqual(sorted(row['address'] for row in rows), addresses)
+        finally:
+            set_database_shards(None)
+            await shards.close()
+
+class WarmUpTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    @gen_test
+    @requires_database
+    async def test_warm_up_pool(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("CREATE TABLE store (key VARCHAR PRIMARY KEY, value VARCHAR)")
+
+        dbconfig = dict(config['database'])
+        dbconfig.pop('ssl', None)
+        pool = await create_pool(min_size=3, max_size=5, **dbconfig)
+        try:
+            query = "SELECT value FROM store WHERE key = $1"
+            await warm_up_pool(pool, [query])
+            connected = [holder for holder in pool._holders if holder._con is not None]
+            self.assertEqual(len(connected), 3)
+            for holder in connected:
+                self.assertIsNotNone(holder._con._stmt_cache.get(query))
+            self.assertEqual(pool._queue.qsize(), len(pool._holders))
+
+            # invalid statements should fail the warm up
+            with self.assertRaises(Exception):
+                await warm_up_pool(pool, ["SELECT * FROM missing_table"])
+            self.assertEqual(pool._queue.qsize(), len(pool._holders))
+        finally:
+            await pool.close()
+
+class NotificationListenerTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    @gen_test(timeout=30)
+    @requires_database
+    async def test_notification_subscriptions(self):
+
+        listener = DatabaseNotificationListener(keepalive_interval=0.1, reconnect_delay=0.1)
+        try:
+            sub1 = await listener.subscribe('test_channel')
+            sub2 = await listener.subscribe('test_channel')
+            other = await listener.subscribe('other_channel')
+
+            async with self.pool.acquire() as con:
+                await con.execute("NOTIFY test_channel, 'hello'")
+                await con.execute("NOTIFY other_channel, 'world'")
+
+            self.assertEqual(await asyncio.wait_for(sub1.__anext__(), 5), 'hello')
+            self.assertEqual(await asyncio.wait_for(sub2.__anext__(), 5), 'hello')
+            self.assertEqual(await asyncio.wait_for(other.__anext__(), 5), 'world')
+
+            # kill the listening connection and make sure it recovers
+            pid = listener._connection.get_server_pid()
+            async with self.pool.acquire() as con:
+                await con.execute("SELECT pg_terminate_backend($1)", pid)
+
+                payload = None
+                for _ in range(50):
+                    await con.execute("NOTIFY test_channel, 'reconnected'")
+                    try:
+                        payload = await asyncio.wait_for(sub1.__anext__(), 0.2)
+                        break
+                    except asyncio.TimeoutError:
+                        pass
+                self.assertEqual(payload, 'reconnected')
+                self.assertNotEqual(listener._connection.get_server_pid(), pid)
+
+            await sub2.close()
+            await other.close()
+            self.assertNotIn('other_channel', listener._subscribers)
+            with self.assertRaises(StopAsyncIteration):
+                await sub2.__anext__()
+
+            async with self.pool.acquire() as con:
+                await con.execute("NOTIFY test_channel, 'last'")
+            payloads = []
+            async for payload in sub1:
+                payloads.append(payload)
+                if payload == 'last':
+                    break
+            self.assertEqual(payloads[-1], 'last')
+
+            # closing wakes up anything waiting on the subscription
+            waiter = asyncio.ensure_future(sub1.__anext__())
+            await asyncio.sleep(0.1)
+            await sub1.close()
+            with self.assertRaises(StopAsyncIteration):
+                await asyncio.wait_for(waiter, 5)
+            self.assertEqual(listener._subscribers, {})
+        finally:
+            await listener.close()
+
+    @gen_test(timeout=30)
+    async def test_subscribe_fails_without_connection(self):
+
+        # nothing listens on port 1, so connecting is refused straight away
+        listener = DatabaseNotificationListener({'host': '127.0.0.1', 'port': 1},
+                                                reconnect_delay=0.1, subscribe_timeout=5)
+        try:
+            with self.assertRaises(DatabaseError):
+                await listener.subscribe('test_channel')
+            self.assertEqual(listener._subscribers, {})
+        finally:
+            await listener.close()
+
+class BulkOperationsTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    @gen_test
+    @requires_database
+    async def test_update_and_delete_many(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("CREATE TABLE balances (address VARCHAR, token VARCHAR, value NUMERIC, "
+                              "updated TIMESTAMP WITHOUT TIME ZONE DEFAULT (now() AT TIME ZONE 'utc'), "
+                              "PRIMARY KEY (address, token))")
+            await con.executemany("INSERT INTO balances (address, token, value) VALUES ($1, $2, $3)",
+                                  [("0x{:040x}".format(i), token, 0) for i in range(10) for token in ('A', 'B')])
+
+        db = HandlerDatabasePoolContext(self.pool)
+        async with db:
+            resp = await db.update_many("balances", [
+                {'address': "0x{:040x}".format(i), 'token': 'A', 'value': i * 10}
+                for i in range(5)], ['address', 'token'])
+            self.assertEqual(resp, "UPDATE 5")
+            resp = await db.update_many("balances", [
+                {'token': 'B', 'value': 100}], 'token')
+            self.assertEqual(resp, "UPDATE 10")
+            # the column types are only looked up once
+            self.assertIn(('balances', ('token', 'value')), _array_parameters_cache[self.pool])
+            resp = await db.update_many("balances", [
+                {'token': 'B', 'value': 100}], 'token')
+            self.assertEqual(resp, "UPDATE 10")
+            resp = await db.update_many("balances", [
+                {'address': "0x{:040x}".format(9), 'token': 'A', 'value': 0}], ['address', 'token'],
+                column_types={'address': 'varchar', 'token': 'varchar', 'value': 'numeric'})
+            self.assertEqual(resp, "UPDATE 1")
+            await db.commit()
+
+        async with self.pool.acquire() as con:
+            rows = await con.fetch("SELECT * FROM balances WHERE token = 'A' ORDER BY address")
+            self.assertEqual([int(row['value']) for row in rows], [0, 10, 20, 30, 40, 0, 0, 0, 0, 0])
+            self.assertEqual(await con.fetchval("SELECT COUNT(*) FROM balances WHERE token = 'B' AND value = 100"), 10)
+
+        async with db.acquire() as db2:
+            resp = await db2.delete_many("balances", {'address': ["0x{:040x}".format(i) for i in range(3)]})
+            self.assertEqual(resp, "DELETE 6")
+            resp = await db2.delete_many("balances", [
+                {'address': "0x{:040x}".format(i), 'token': 'B'} for i in range(3, 10)])
+            self.assertEqual(resp, "DELETE 7")
+            with self.assertRaises(DatabaseError):
+                await db2.update_many("balances", [{'address': '0x', 'missing': 1}], 'address')
+            await db2.commit()
+
+        async with self.pool.acquire() as con:
+            rows = await con.fetch("SELECT * FROM balances ORDER BY address")
+            self.assertEqual([(row['address'], row['token']) for row in rows],
+                             [("0x{:040x}".format(i), 'A') for i in range(3, 10)])
+
+    @gen_test
+    @requires_database
+    async def test_concurrent_commit_callbacks(self):
+
+        running = []
+        max_running = []
+
+        async def callback():
+            running.append(1)
+            max_running.append(len(running))
+            await asyncio.sleep(0.1)
+            running.pop()
+
+        for concurrent, expected in [(False, 1), (True, 3)]:
+            max_running.clear()
+            db = HandlerDatabasePoolContext(self.pool, concurrent_callbacks=concurrent)
+            async with db:
+                for _ in range(3):
+                    db.on_commit(lambda: callback())
+                await db.commit()
+            self.assertEqual(max(max_running), expected)
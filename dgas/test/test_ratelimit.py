@@ -0,0 +1,118 @@
+import asyncio
+import time
+
+from tornado.testing import gen_test
+
+from dgas.handlers import BaseHandler, RequestVerificationMixin
+from dgas.ratelimit import rate_limit, RateLimiter, RateLimitMixin
+from dgas.test.redis import requires_redis
+
+from dgas.test.base import AsyncHandlerTest
+
+TEST_PRIVATE_KEY = "0xe8f32e723decf4051aefac8e2c93c9c5b214313817cdb01a1494b917c8436b35"
+TEST_PRIVATE_KEY_2 = "0x8945608e66736aceb34a83f94689b4e98af497ffc9dc2004a93824096330fa77"
+
+class IpLimitedHandler(BaseHandler):
+
+    @rate_limit(2, period=60, key='ip')
+    def get(self):
+        self.set_status(204)
+
+class AddressLimitedHandler(RequestVerificationMixin, BaseHandler):
+
+    @rate_limit(1, period=60, key='address')
+    async def get(self):
+        self.write({'address': self.verify_request()})
+
+class RouteLimitedHandler(RateLimitMixin, BaseHandler):
+
+    rate_limiter = RateLimiter(1, period=60)
+    rate_limit_key = 'route'
+
+    def get(self):
+        self.set_status(204)
+
+class RateLimitTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return [
+            (r"^/ip/?$", IpLimitedHandler),
+            (r"^/address/?$", AddressLimitedHandler),
+            (r"^/route/?$", RouteLimitedHandler)
+        ]
+
+    @gen_test
+    @requires_redis
+    async def test_rate_limit_by_ip(self):
+
+        for _ in range(2):
+            resp = await self.fetch("/ip")
+            self.assertResponseCodeEqual(resp, 204)
+        resp = await self.fetch("/ip")
+        self.assertResponseCodeEqual(resp, 429)
+
+    @gen_test
+    @requires_redis
+    async def test_rate_limit_by_address(self):
+
+        resp = await self.fetch_signed("/address", signing_key=TEST_PRIVATE_KEY)
+        self.assertResponseCodeEqual(resp, 200)
+        resp = await self.fetch_signed("/address", signing_key=TEST_PRIVATE_KEY)
+        self.assertResponseCodeEqual(resp, 429)
+        # other addresses are unaffected
+        resp = await self.fetch_signed("/address", signing_key=TEST_PRIVATE_KEY_2)
+        self.assertResponseCodeEqual(resp, 200)
+        # unsigned requests are rejected by verify_request
+        resp = await self.fetch("/address")
+        self.assertResponseCodeEqual(resp, 400)
+
+    @gen_test
+    @requires_redis
+    async def test_rate_limit_mixin(self):
+
+        resp = await self.fetch("/route")
+        self.assertResponseCodeEqual(resp, 204)
+        resp = await self.fetch("/route")
+        self.assertResponseCodeEqual(resp, 429)
+
+    @gen_test
+    @requires_redis
+    async def test_cluster_wide_limit(self):
+
+        # two limiters sharing redis simulate two processes
+        limiter1 = RateLimiter(10, period=60, burst=10, sync_interval=0)
+        limiter2 = RateLimiter(10, period=60, burst=10, sync_interval=0)
+
+        results = []
+        for _ in range(10):
+            results.append(await limiter1.check("key"))
+            results.append(await limiter2.check("key"))
+        self.assertEqual(results.count(True), 10)
+
+        # once blocked the limiter doesn't need to check redis
+        self.redis.close()
+        await self.redis.wait_closed()
+        self.assertFalse(await limiter1.check("key"))
+        self.assertFalse(await limiter2.check("key"))
+        # other keys fall back to the local bucket when redis is unavailable
+        self.assertTrue(await limiter1.check("other"))
+
+    @gen_test
+    @requires_redis
+    async def test_pending_counts_flushed(self):
+
+        limiter = RateLimiter(10, period=3600, sync_interval=0.2, prefix='flushtest:')
+        window = int(time.time() // 3600)
+        # the first request syncs straight away, the others are pending
+        for _ in range(3):
+            self.assertTrue(await limiter.check("timer"))
+        self.assertEqual(int(await self.redis.get("flushtest:timer:{}".format(window))), 1)
+        # the timer flushes them without any further requests
+        await asyncio.sleep(0.5)
+        self.assertEqual(int(await self.redis.get("flushtest:timer:{}".format(window))), 3)
+
+        limiter = RateLimiter(10, period=3600, sync_interval=60, prefix='flushtest:')
+        for _ in range(3):
+            self.assertTrue(await limiter.check("close"))
+        await limiter.close()
+        self.assertEqual(int(await self.redis.get("flushtest:close:{}".format(window))), 3)
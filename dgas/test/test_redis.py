@@ -1,8 +1,15 @@
+import aioredis
+import asyncio
+import time
+
 from dgas.test.base import AsyncHandlerTest
-from dgas.test.redis import requires_redis
+from dgas.test.redis import requires_redis, RedisServer, RedisSentinelServer
 
 from dgas.handlers import BaseHandler
-from dgas.redis import RedisMixin
+from dgas.redis import (
+    RedisMixin, RedisCache, AutoPipeline, prepare_redis, mget_many, mset_many,
+    get_redis_connection, set_redis_connection, get_redis_sentinel, RedisScriptRegistry, scripts)
+from dgas.config import config
 from tornado.testing import gen_test
 
 class Handler(RedisMixin, BaseHandler):
@@ -38,3 +45,247 @@ class RedisTest(AsyncHandlerTest):
 
         await self.fetch('/?key=TESTKEY&value=3')
         self.assertEqual(await self.redis.get("TESTKEY"), b'3')
+
+class RedisCacheTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    async def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                raise AssertionError("timed out waiting for condition")
+            await asyncio.sleep(0.01)
+
+    @gen_test(timeout=30)
+    @requires_redis
+    async def test_two_tier_cache(self):
+
+        # use a separate redis pool to simulate a 2nd process
+        other_redis = await prepare_redis(dict(config['redis']))
+        cache1 = RedisCache(self.redis)
+        cache2 = RedisCache(other_redis)
+        try:
+            for cache in (cache1, cache2):
+                cache._ensure_invalidation_listener()
+            await asyncio.sleep(0.1)
+
+            calls = []
+
+            async def compute():
+                calls.append(1)
+                await asyncio.sleep(0.2)
+                return {'value': len(calls)}
+
+            results = await asyncio.gather(*[cache.get_or_compute('key', compute)
+                                             for cache in (cache1, cache2) for _ in range(5)])
+            # only computed once across both "processes"
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(results, [{'value': 1}] * 10)
+            self.assertIn('key', cache1._local)
+            self.assertIn('key', cache2._local)
+
+            # invalidation is sent to other processes
+            await cache1.invalidate('key')
+            self.assertNotIn('key', cache1._local)
+            await self.wait_for(lambda: 'key' not in cache2._local)
+            self.assertIsNone(await cache2.get('key'))
+
+            await cache2.set('key', 'new value')
+            self.assertEqual(await cache1.get('key'), 'new value')
+            await cache2.set('key', 'newer value')
+            await self.wait_for(lambda: 'key' not in cache1._local)
+            self.assertEqual(await cache1.get('key'), 'newer value')
+
+            # ttl expiry
+            await cache1.set('short', 1, ttl=1)
+            self.assertEqual(await cache1.get('short'), 1)
+            await asyncio.sleep(1.5)
+            self.assertIsNone(await cache1.get('short'))
+
+            # decorator
+            lookups = []
+
+            @cache1.cached(ttl=10)
+            async def lookup(address):
+                lookups.append(address)
+                return address.upper()
+
+            self.assertEqual(await lookup('0xabc'), '0XABC')
+            self.assertEqual(await lookup('0xabc'), '0XABC')
+            self.assertEqual(await lookup('0xdef'), '0XDEF')
+            self.assertEqual(lookups, ['0xabc', '0xdef'])
+
+            @cache2.cached(key=lambda address: address)
+            def sync_lookup(address):
+                lookups.append(address)
+                return address
+
+            self.assertEqual(await sync_lookup('0x123'), '0x123')
+            self.assertEqual(await cache1.get('0x123'), '0x123')
+        finally:
+            await cache1.close()
+            await cache2.close()
+            other_redis.close()
+            await other_redis.wait_closed()
+
+class RedisBatchingTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    @gen_test
+    @requires_redis
+    async def test_auto_pipeline(self):
+
+        batch = AutoPipeline(self.redis)
+        futures = [batch.set("key{}".format(i), i) for i in range(50)]
+        # all commands issued in this loop iteration share a pipeline
+        pipeline = batch._pipeline
+        self.assertIsNotNone(pipeline)
+        futures.append(batch.incr("counter"))
+        self.assertIs(batch._pipeline, pipeline)
+        results = await asyncio.gather(*futures)
+        self.assertEqual(results[-1], 1)
+        self.assertIsNone(batch._pipeline)
+
+        values = await asyncio.gather(*[batch.get("key{}".format(i)) for i in range(50)])
+        self.assertEqual(values, [str(i).encode('utf-8') for i in range(50)])
+
+        # errors are returned for the failing command only
+        bad, good = batch.lpush("key1", "x"), batch.get("key2")
+        with self.assertRaises(aioredis.errors.ReplyError):
+            await bad
+        self.assertEqual(await good, b'2')
+
+    @gen_test
+    @requires_redis
+    async def test_mget_mset_many(self):
+
+        pairs = {"key{}".format(i): "value{}".format(i) for i in range(50)}
+        await mset_many(pairs, redis=self.redis, chunk_size=7)
+        keys = sorted(pairs.keys()) + ["missing"]
+        values = await mget_many(keys, redis=self.redis, chunk_size=7, encoding='utf-8')
+        self.assertEqual(values, [pairs[k] for k in keys[:-1]] + [None])
+
+        await mset_many([("expiring", "1")], redis=self.redis, expire=10)
+        self.assertGreater(await self.redis.ttl("expiring"), 0)
+        self.assertEqual(await mget_many([], redis=self.redis), [])
+
+class RedisSentinelTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    async def retry(self, fn, timeout=30):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                return await fn()
+            except Exception:
+                if time.time() > deadline:
+                    raise
+                await asyncio.sleep(0.5)
+
+    @gen_test(timeout=120)
+    async def test_sentinel_master_and_replica(self):
+
+        master = RedisServer(redis_conf={'loglevel': 'warning'})
+        master_port = master.dsn()['port']
+        replica = RedisServer(redis_conf={'loglevel': 'warning',
+                                          'slaveof': '127.0.0.1 {}'.format(master_port)})
+        sentinel = RedisSentinelServer(master_port=master_port, redis_conf={'loglevel': 'warning'})
+        try:
+            config['redis'] = {
+                'sentinels': sentinel.address(),
+                'sentinel_master': 'mymaster'
+            }
+            set_redis_connection(None)
+            redis = await prepare_redis()
+
+            await redis.set("key", "value")
+
+            # reads can be routed to the replica
+            replica_redis = get_redis_connection(readonly=True)
+            self.assertIsNot(replica_redis, redis)
+
+            async def read_from_replica():
+                self.assertEqual(await replica_redis.get("key"), b"value")
+            await self.retry(read_from_replica)
+            with self.assertRaises(aioredis.errors.RedisError):
+                await replica_redis.set("key", "other")
+
+            # after a failover writes go to the new master
+            async def failover():
+                await get_redis_sentinel().failover('mymaster')
+            await self.retry(failover)
+
+            async def write_to_new_master():
+                address = await get_redis_sentinel().master_address('mymaster')
+                self.assertEqual(address[1], replica.dsn()['port'])
+                await redis.set("key", "after failover")
+            await self.retry(write_to_new_master)
+            self.assertEqual(await redis.get("key"), b"after failover")
+        finally:
+            if get_redis_sentinel() is not None:
+                redis = get_redis_connection()
+                redis.close()
+                await redis.wait_closed()
+                get_redis_sentinel().close()
+                await get_redis_sentinel().wait_closed()
+            set_redis_connection(None)
+            del config['redis']
+            sentinel.stop()
+            replica.stop()
+            master.stop()
+
+class RedisScriptsTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    @gen_test
+    @requires_redis
+    async def test_script_registry(self):
+
+        registry = RedisScriptRegistry()
+        script = registry.register('get_and_double', "return tonumber(redis.call('GET', KEYS[1])) * 2")
+        self.assertIs(registry.get_and_double, script)
+        with self.assertRaises(ValueError):
+            registry.register('get_and_double', "return 1")
+        with self.assertRaises(AttributeError):
+            registry.missing
+
+        await self.redis.set("number", 21)
+        await self.redis.script_flush()
+        # not loaded yet: falls back to EVAL
+        self.assertEqual(await script(keys=["number"]), 42)
+        self.assertEqual(await self.redis.script_exists(script.sha), [1])
+        self.assertEqual(await script(keys=["number"]), 42)
+
+        await self.redis.script_flush()
+        await registry.load_all()
+        self.assertEqual(await self.redis.script_exists(script.sha), [1])
+
+        # errors other than NOSCRIPT are raised
+        with self.assertRaises(aioredis.errors.ReplyError):
+            await script(keys=["missing"])
+
+    @gen_test
+    @requires_redis
+    async def test_builtin_scripts(self):
+
+        await self.redis.set("lock", "token")
+        self.assertEqual(await scripts.compare_and_delete(keys=["lock"], args=["other"]), 0)
+        self.assertEqual(await scripts.compare_and_delete(keys=["lock"], args=["token"]), 1)
+        self.assertIsNone(await self.redis.get("lock"))
+
+        self.assertEqual(await scripts.compare_and_set(keys=["cas"], args=["", "1"]), 1)
+        self.assertEqual(await scripts.compare_and_set(keys=["cas"], args=["0", "2"]), 0)
+        self.assertEqual(await scripts.compare_and_set(keys=["cas"], args=["1", "2"]), 1)
+        self.assertEqual(await self.redis.get("cas"), b"2")
+
+        self.assertEqual(await scripts.rate_counter(keys=["counter"], args=[1, 10]), 1)
+        self.assertEqual(await scripts.rate_counter(keys=["counter"], args=[5, 10]), 6)
+        self.assertGreater(await self.redis.ttl("counter"), 0)
@@ -0,0 +1,956 @@
+import aioredis
+import asyncio
+import calendar
+import datetime
+import msgpack
+import os
+import time
+import unittest
+from tornado.testing import gen_test
+from dgas.test.redis import requires_redis
+from dgas.test.tasks import requires_task_listener
+from tornado.ioloop import IOLoop
+
+from dgas.tasks import (
+    Task, TaskHandler, TaskError, TaskListener, StreamTaskQueue, TaskTimeoutError, RetryPolicy,
+    CronSchedule, gather_results, cpu_bound, TaskDispatcher, TaskSerializer, zstandard, lz4)
+from dgas.database import get_shard_index
+from dgas.test.base import AsyncHandlerTest
+
+class TestTaskHandler(TaskHandler):
+
+    def hello(self, name):
+        return "hello, {}".format(name)
+
+    def throws_exception(self, name):
+        name = blah  # noqa: on purpose to make sure exception is thrown by task handlers
+
+    async def async_fn(self, val):
+        await self.application.test_queue.put(val)
+        return True
+
+class CountingTaskHandler(TaskHandler):
+
+    async def count(self, val):
+        self.listener.test_counts.append(val)
+        await asyncio.sleep(0.01)
+        return val
+
+class ConcurrencyTaskHandler(TaskHandler):
+
+    async def slow(self, val):
+        self.listener.active += 1
+        self.listener.peak = max(self.listener.peak, self.listener.active)
+        await asyncio.sleep(0.05)
+        self.listener.active -= 1
+        return val
+
+class FlakyTaskHandler(TaskHandler):
+
+    def flaky(self, failures):
+        self.listener.attempts += 1
+        if self.listener.attempts <= failures:
+            raise ConnectionError("failed attempt {}".format(self.listener.attempts))
+        return self.listener.attempts
+
+    def fails(self):
+        raise ValueError("not retried")
+
+class CpuBoundTaskHandler(TaskHandler):
+
+    @cpu_bound
+    def checksum(data):
+        return os.getpid(), sum(data) % 256
+
+    @cpu_bound
+    def fails(message):
+        raise ValueError(message)
+
+class LaneTaskHandler(TaskHandler):
+
+    async def work(self, lane):
+        self.listener.test_order.append(lane)
+        await asyncio.sleep(0.01)
+        return lane
+
+class IdempotentTaskHandler(TaskHandler):
+
+    async def expensive(self, val):
+        self.listener.test_runs += 1
+        await asyncio.sleep(0.1)
+        if val is None:
+            raise ValueError("no value")
+        return val * 2
+
+    async def blocking(self, val):
+        self.listener.test_runs += 1
+        await self.listener.test_blocker.wait()
+        return val
+
+class StatelessTaskHandler(TaskHandler):
+
+    stateless = True
+
+    def initialize(self):
+        self.listener.test_instances += 1
+
+    def instance(self):
+        return id(self)
+
+class OrderedTaskHandler(TaskHandler):
+
+    async def step(self, key, i):
+        await asyncio.sleep(0.001 * (i % 3))
+        self.listener.test_steps.setdefault(key, []).append(i)
+        return i
+
+class TestTaskListener(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    @gen_test
+    @requires_redis
+    @requires_task_listener
+    async def test_call_handler_method(self, task_listener):
+        task_listener.add_task_handler(TestTaskHandler)
+
+        welcome = await self._app.task_listener.call_task("hello", "world")
+        self.assertEqual(welcome, "hello, world")
+
+    @gen_test
+    @requires_redis
+    @requires_task_listener
+    async def test_call_bad_handler(self, task_listener):
+        task_listener.add_task_handler(TestTaskHandler)
+        with self.assertRaises(TaskError):
+            await self._app.task_listener.call_task("throws_exception", "world")
+
+    @gen_test
+    @requires_redis
+    @requires_task_listener
+    async def test_call_async_handler(self, task_listener):
+        task_listener.add_task_handler(TestTaskHandler)
+        task_listener.test_queue = asyncio.Queue()
+        val = 10
+        res = await self._app.task_listener.call_task("async_fn", val)
+        # async_fn returns True
+        self.assertTrue(res)
+        val2 = await task_listener.test_queue.get()
+        self.assertEqual(val, val2)
+
+    @gen_test
+    @requires_redis
+    @requires_task_listener
+    async def test_call_with_ioloop_add_callback(self, task_listener):
+        task_listener.add_task_handler(TestTaskHandler)
+        task_listener.test_queue = asyncio.Queue()
+        val = 11
+        IOLoop.current().add_callback(self._app.task_listener.call_task, "async_fn", val)
+        val2 = await task_listener.test_queue.get()
+        self.assertEqual(val, val2)
+
+class TestStreamTaskQueue(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    @gen_test(timeout=30)
+    @requires_redis
+    @requires_task_listener(backend='streams')
+    async def test_tasks_run_once_across_listeners(self, task_listener):
+
+        workers = [TaskListener([(CountingTaskHandler,)], self._app, backend='streams') for _ in range(2)]
+        for worker in workers:
+            worker.test_counts = []
+            await worker.start_task_listener()
+
+        try:
+            results = await asyncio.gather(*[task_listener.call_task("count", i) for i in range(50)])
+            self.assertEqual(results, list(range(50)))
+            counts = workers[0].test_counts + workers[1].test_counts
+            self.assertEqual(sorted(counts), list(range(50)))
+            # the stream is emptied once tasks are acknowledged
+            self.assertEqual(await task_listener.aio_redis_connection_pool.execute(
+                'XLEN', task_listener.task_queue.stream_key('count')), 0)
+        finally:
+            for worker in workers:
+                await worker.stop_task_listener(soft=True)
+
+    @gen_test(timeout=30)
+    @requires_redis
+    @requires_task_listener(backend='streams')
+    async def test_tasks_published_before_listener_starts(self, task_listener):
+
+        task = task_listener.call_task("hello", "world")
+        await asyncio.sleep(0.1)
+
+        worker = TaskListener([(TestTaskHandler,)], self._app, backend='streams')
+        await worker.start_task_listener()
+        try:
+            self.assertEqual(await task, "hello, world")
+        finally:
+            await worker.stop_task_listener(soft=True)
+
+    @gen_test(timeout=30)
+    @requires_redis
+    @requires_task_listener(backend='streams')
+    async def test_claim_stale_entries(self, task_listener):
+
+        queue = task_listener.task_queue
+        redis = task_listener.aio_redis_connection_pool
+        key = queue.stream_key('hello')
+
+        tasks = [task_listener.call_task("hello", str(i)) for i in range(5)]
+        await asyncio.sleep(0.1)
+        # read the entries as a consumer that never acknowledges them
+        await redis.execute('XGROUP', 'CREATE', key, queue.group, '0', 'MKSTREAM')
+        entries = await redis.execute('XREADGROUP', 'GROUP', queue.group, 'dead-consumer',
+                                      'COUNT', 10, 'STREAMS', key, '>')
+        self.assertEqual(len(entries[0][1]), 5)
+
+        # more entries are pending than fit in one batch, a single claim
+        # pages through all of them
+        worker = TaskListener([(TestTaskHandler,)], self._app, backend=lambda listener: StreamTaskQueue(
+            listener, batch_size=2, claim_timeout=0.2, claim_interval=60))
+        await worker.start_task_listener()
+        try:
+            await asyncio.sleep(0.2)
+            await worker.task_queue.claim_stale_entries()
+            self.assertEqual(await asyncio.wait_for(asyncio.gather(*tasks), 5),
+                             ["hello, {}".format(i) for i in range(5)])
+        finally:
+            await worker.stop_task_listener(soft=True)
+
+        # the worker's consumer is removed once it has nothing pending
+        consumers = await redis.execute('XINFO', 'CONSUMERS', key, queue.group)
+        names = [dict(zip(consumer[::2], consumer[1::2]))[b'name'] for consumer in consumers]
+        self.assertNotIn(worker.listener_id.encode('utf-8'), names)
+
+class TestReplyChannels(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    @gen_test(timeout=30)
+    @requires_redis
+    @requires_task_listener
+    async def test_results_sent_to_reply_channel(self, task_listener):
+
+        worker = TaskListener([(TestTaskHandler,)], self._app)
+        await worker.start_task_listener()
+
+        redis = await aioredis.create_redis(**task_listener._get_redis_config())
+        try:
+            ch, = await redis.subscribe(task_listener.queue_name)
+
+            self.assertEqual(await task_listener.call_task("hello", "world"), "hello, world")
+            with self.assertRaises(TaskError):
+                await task_listener.call_task("throws_exception", "world")
+
+            actions = []
+            while True:
+                try:
+                    message = await asyncio.wait_for(ch.get(), 0.5)
+                except asyncio.TimeoutError:
+                    break
+                actions.append(task_listener.serializer.decode(message)[1])
+            # only the calls go over the shared queue channel
+            self.assertEqual(actions, ['task', 'task'])
+        finally:
+            redis.close()
+            await redis.wait_closed()
+            await worker.stop_task_listener(soft=True)
+
+    @gen_test(timeout=30)
+    @requires_redis
+    @requires_task_listener
+    async def test_calls_without_reply_channel(self, task_listener):
+
+        task_listener.add_task_handler(TestTaskHandler)
+        task = Task('legacy-task', 'hello', 'world')
+        task_listener._tasks[task.task_id] = task
+        await task_listener.aio_redis_connection_pool.publish(
+            task_listener.queue_name,
+            msgpack.packb([task.task_id, 'call', 'hello', 'world'], use_bin_type=True, encoding="utf-8"))
+        self.assertEqual(await task, "hello, world")
+
+class TestConcurrencyLimits(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    async def _run_slow_tasks(self, task_listener, worker):
+        worker.active = worker.peak = 0
+        tasks = [task_listener.call_task("slow", i) for i in range(20)]
+        await asyncio.sleep(0.1)
+        stats = worker.get_stats()
+        results = await asyncio.gather(*tasks)
+        self.assertEqual(results, list(range(20)))
+        return stats
+
+    @gen_test(timeout=30)
+    @requires_redis
+    @requires_task_listener
+    async def test_function_concurrency_limit(self, task_listener):
+
+        worker = TaskListener([(ConcurrencyTaskHandler,)], self._app, concurrency_limits={'slow': 3})
+        await worker.start_task_listener()
+        try:
+            stats = await self._run_slow_tasks(task_listener, worker)
+            self.assertEqual(worker.peak, 3)
+            self.assertEqual(stats['functions']['slow']['in_flight'], 3)
+            self.assertGreater(stats['queue_depth'], 0)
+            self.assertEqual(worker.in_flight, 0)
+            self.assertEqual(worker.queue_depth, 0)
+        finally:
+            await worker.stop_task_listener(soft=True)
+
+    @gen_test(timeout=30)
+    @requires_redis
+    @requires_task_listener(backend='streams')
+    async def test_stream_calls_left_in_backend(self, task_listener):
+
+        worker = TaskListener([(ConcurrencyTaskHandler,)], self._app, backend='streams', max_concurrency=2)
+        await worker.start_task_listener()
+        try:
+            stats = await self._run_slow_tasks(task_listener, worker)
+            self.assertEqual(worker.peak, 2)
+            self.assertEqual(stats['in_flight'], 2)
+            # calls that can't be run are not read from the stream
+            self.assertEqual(stats['queue_depth'], 0)
+        finally:
+            await worker.stop_task_listener(soft=True)
+
+    @gen_test(timeout=30)
+    @requires_redis
+    @requires_task_listener(backend='streams')
+    async def test_stream_reads_limited_by_function_capacity(self, task_listener):
+
+        worker = TaskListener([(IdempotentTaskHandler,)], self._app, backend='streams',
+                              concurrency_limits={'blocking': 2})
+        worker.test_runs = 0
+        worker.test_blocker = asyncio.Event()
+        tasks = [task_listener.call_task("blocking", i) for i in range(5)]
+        await asyncio.sleep(0.1)
+        await worker.start_task_listener()
+        try:
+            await asyncio.sleep(0.2)
+            redis = task_listener.aio_redis_connection_pool
+            key = worker.task_queue.stream_key('blocking')
+            # only the calls that could be started were read
+            pending = await redis.execute('XPENDING', key, worker.task_queue.group)
+            self.assertEqual(pending[0], 2)
+            self.assertEqual(await redis.execute('XLEN', key), 5)
+            self.assertEqual(worker.test_runs, 2)
+            self.assertEqual(worker.queue_depth, 0)
+
+            worker.test_blocker.set()
+            self.assertEqual(await asyncio.wait_for(asyncio.gather(*tasks), 5), list(range(5)))
+            await asyncio.sleep(0.1)
+            self.assertEqual(await redis.execute('XLEN', key), 0)
+        finally:
+            await worker.stop_task_listener(soft=True)
+
+    @gen_test(timeout=30)
+    @requires_redis
+    @requires_task_listener
+    async def test_pubsub_calls_dropped_when_queue_full(self, task_listener):
+
+        worker = TaskListener([(ConcurrencyTaskHandler,)], self._app, max_concurrency=1, max_pending=2)
+        await worker.start_task_listener()
+        try:
+            worker.active = worker.peak = 0
+            tasks = [task_listener.call_task("slow", i) for i in range(5)]
+            results = await gather_results(tasks, timeout=5)
+            self.assertEqual(results[:3], [0, 1, 2])
+            # dropped calls fail straight away
+            for result in results[3:]:
+                self.assertIsInstance(result, TaskError)
+                self.assertEqual(result.exc_type_name, 'TaskQueueFullError')
+            self.assertEqual(worker.get_stats()['dropped'], 2)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await worker.stop_task_listener(soft=True)
+
+class TestTimeoutsAndRetries(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    @gen_test(timeout=30)
+    @requires_redis
+    @requires_task_listener(sweep_interval=0.05)
+    async def test_call_timeout(self, task_listener):
+
+        with self.assertRaises(TaskTimeoutError):
+            await task_listener.call_task("no_handler", timeout=0.2)
+        self.assertEqual(task_listener._tasks, {})
+
+    @gen_test(timeout=30)
+    @requires_redis
+    @requires_task_listener(sweep_interval=0.05, max_task_age=0.2)
+    async def test_calls_without_timeout_expire(self, task_listener):
+
+        # calls that never get a result are dropped after max_task_age
+        with self.assertRaises(TaskTimeoutError):
+            await task_listener.call_task("no_handler")
+        self.assertEqual(task_listener._tasks, {})
+
+    @gen_test(timeout=30)
+    @requires_redis
+    @requires_task_listener(sweep_interval=0.05)
+    async def test_cancelled_calls_are_swept(self, task_listener):
+
+        task = task_listener.call_task("no_handler")
+        task.cancel()
+        await asyncio.sleep(0.2)
+        self.assertEqual(task_listener._tasks, {})
+
+    @gen_test(timeout=30)
+    @requires_redis
+    @requires_task_listener(retry_policy=RetryPolicy(max_retries=3, backoff=0.01, retry_on=[ConnectionError]))
+    async def test_retries(self, task_listener):
+
+        task_listener.add_task_handler(FlakyTaskHandler)
+        task_listener.attempts = 0
+        self.assertEqual(await task_listener.call_task("flaky", 2), 3)
+
+        task_listener.attempts = 0
+        with self.assertRaises(TaskError) as cm:
+            await task_listener.call_task("flaky", 10)
+        self.assertEqual(cm.exception.exc_type_name, 'ConnectionError')
+        self.assertEqual(task_listener.attempts, 4)
+
+        task_listener.attempts = 0
+        with self.assertRaises(TaskError):
+            await task_listener.call_task("fails")
+        self.assertEqual(task_listener.attempts, 0)
+
+class TestScheduledTasks(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    @gen_test(timeout=30)
+    @requires_redis
+    @requires_task_listener(durable_delays=True, scheduler_interval=0.1)
+    async def test_durable_delay(self, task_listener):
+
+        task_listener.add_task_handler(TestTaskHandler)
+        task = task_listener.call_task("hello", "world", delay=0.5)
+        await asyncio.sleep(0.1)
+        self.assertEqual(await task_listener.aio_redis_connection_pool.zcard(
+            task_listener.scheduler.scheduled_key), 1)
+        self.assertFalse(task._future.done())
+        self.assertEqual(await task, "hello, world")
+        self.assertEqual(await task_listener.aio_redis_connection_pool.zcard(
+            task_listener.scheduler.scheduled_key), 0)
+
+    @gen_test(timeout=30)
+    @requires_redis
+    @requires_task_listener(scheduler_interval=0.05)
+    async def test_periodic_task_runs_once_per_interval(self, task_listener):
+
+        workers = [TaskListener([(CountingTaskHandler,)], self._app, scheduler_interval=0.05)
+                   for _ in range(2)]
+        try:
+            for worker in [task_listener, *workers]:
+                worker.test_counts = []
+                worker.add_periodic_task("count", 1, interval=0.5)
+            for worker in workers:
+                await worker.start_task_listener()
+            await asyncio.sleep(2.2)
+        finally:
+            for worker in workers:
+                await worker.stop_task_listener(soft=True)
+        # the first run is an interval after the task is registered, and
+        # each run is called once but handled by every pubsub listener
+        runs = len(workers[0].test_counts)
+        self.assertIn(runs, (3, 4))
+        self.assertEqual(len(workers[1].test_counts), runs)
+
+    @gen_test(timeout=30)
+    @requires_redis
+    @requires_task_listener
+    async def test_failed_poll_keeps_unsent_calls(self, task_listener):
+
+        scheduler = task_listener.scheduler
+        for i in range(3):
+            await scheduler.schedule("hello", str(i).encode('utf-8'), time.time() - 1)
+        sent = []
+
+        async def send_call(fnname, data, priority=None, shard=None, wait=False):
+            if len(sent) == 1:
+                raise ConnectionError("failed to send")
+            sent.append(data)
+
+        task_listener._send_call = send_call
+        with self.assertRaises(ConnectionError):
+            await scheduler.poll()
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(await task_listener.aio_redis_connection_pool.zcard(scheduler.scheduled_key), 2)
+
+    @gen_test(timeout=30)
+    @requires_redis
+    @requires_task_listener
+    async def test_unsendable_scheduled_calls_moved_aside(self, task_listener):
+
+        worker = TaskListener([(TestTaskHandler,)], self._app)
+        await worker.start_task_listener()
+        try:
+            scheduler = task_listener.scheduler
+            redis = task_listener.aio_redis_connection_pool
+            # an undecodable entry and a sharded call on a listener without shards
+            await redis.zadd(scheduler.scheduled_key, time.time() - 2, b'\xc1')
+            await scheduler.schedule("hello", b'', time.time() - 2, shard=1)
+            task = task_listener._tasks['scheduled-task'] = Task(
+                'scheduled-task', "hello", "world", reply_to=task_listener.reply_channel)
+            await scheduler.schedule("hello", task.pack(task_listener.serializer), time.time() - 1)
+
+            await scheduler.poll()
+            # the good call after the bad ones is still sent
+            self.assertEqual(await asyncio.wait_for(task, 5), "hello, world")
+            self.assertEqual(await redis.zcard(scheduler.scheduled_key), 0)
+            self.assertEqual(await redis.zcard(scheduler.failed_key), 2)
+        finally:
+            await worker.stop_task_listener(soft=True)
+
+class TestCronSchedule(unittest.TestCase):
+
+    def _next(self, expression, *after):
+        after = calendar.timegm(datetime.datetime(*after).timetuple())
+        return datetime.datetime.utcfromtimestamp(CronSchedule(expression).next_after(after))
+
+    def test_next_after(self):
+        self.assertEqual(self._next('*/15 * * * *', 2018, 1, 1, 10, 7, 30), datetime.datetime(2018, 1, 1, 10, 15))
+        self.assertEqual(self._next('0 3 * * 1', 2018, 1, 1, 10, 7), datetime.datetime(2018, 1, 8, 3, 0))
+        self.assertEqual(self._next('30 2 29 2 *', 2018, 1, 1), datetime.datetime(2020, 2, 29, 2, 30))
+        # day of month or day of week when both are given
+        self.assertEqual(self._next('0 0 1,15 * 0', 2018, 1, 2), datetime.datetime(2018, 1, 7))
+        self.assertEqual(self._next('0 9-17/4 * * 1-5', 2018, 1, 5, 17), datetime.datetime(2018, 1, 8, 9))
+
+    def test_invalid_expressions(self):
+        for expression in ['* * *', '60 * * * *', '* * * 0 *', '5-1 * * * *']:
+            with self.assertRaises(ValueError):
+                CronSchedule(expression)
+        with self.assertRaises(ValueError):
+            CronSchedule('0 0 31 2 *').next_after(0)
+
+class TestLocalDispatch(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    @gen_test(timeout=30)
+    @requires_redis
+    @requires_task_listener(local_dispatch='always')
+    async def test_local_calls(self, task_listener):
+
+        worker = TaskListener([(CountingTaskHandler,)], self._app)
+        worker.test_counts = []
+        await worker.start_task_listener()
+        try:
+            task_listener.add_task_handler(CountingTaskHandler)
+            task_listener.add_task_handler(TestTaskHandler)
+            task_listener.test_counts = []
+            # arguments are passed without being serialized
+            self.assertEqual(await task_listener.call_task("count", (1, 2)), (1, 2))
+            self.assertEqual(task_listener.test_counts, [(1, 2)])
+            self.assertEqual(worker.test_counts, [])
+            with self.assertRaises(TaskError) as cm:
+                await task_listener.call_task("throws_exception", "world")
+            self.assertEqual(cm.exception.exc_type_name, 'NameError')
+        finally:
+            await worker.stop_task_listener(soft=True)
+
+    @gen_test(timeout=30)
+    @requires_redis
+    @requires_task_listener(local_dispatch='available', max_concurrency=1, backend='streams')
+    async def test_local_calls_when_available(self, task_listener):
+
+        worker = TaskListener([(CountingTaskHandler,)], self._app, backend='streams')
+        worker.test_counts = []
+        await worker.start_task_listener()
+        try:
+            task_listener.add_task_handler(CountingTaskHandler)
+            task_listener.test_counts = []
+            self.assertEqual(await asyncio.gather(*[task_listener.call_task("count", i) for i in range(2)]), [0, 1])
+            # the first call runs locally, the second goes through the
+            # stream as the listener is at its concurrency limit
+            self.assertIn(0, task_listener.test_counts)
+            self.assertEqual(sorted(task_listener.test_counts + worker.test_counts), [0, 1])
+        finally:
+            await worker.stop_task_listener(soft=True)
+
+class TestBatchedCalls(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    @gen_test(timeout=30)
+    @requires_redis
+    @requires_task_listener
+    async def test_call_tasks_many(self, task_listener):
+
+        worker = TaskListener([(TestTaskHandler,)], self._app)
+        await worker.start_task_listener()
+        try:
+            tasks = task_listener.call_tasks_many("hello", [["world"], ["there"]])
+            tasks += task_listener.call_tasks_many("throws_exception", [["world"]])
+            tasks += task_listener.call_tasks_many("no_handler", [[]])
+            results = await gather_results(tasks, timeout=1)
+            self.assertEqual(results[:2], ["hello, world", "hello, there"])
+            self.assertIsInstance(results[2], TaskError)
+            self.assertIsInstance(results[3], TaskTimeoutError)
+            self.assertEqual(await gather_results([]), [])
+        finally:
+            await worker.stop_task_listener(soft=True)
+
+    @gen_test(timeout=30)
+    @requires_redis
+    @requires_task_listener(backend='streams')
+    async def test_call_tasks_many_streams(self, task_listener):
+
+        worker = TaskListener([(CountingTaskHandler,)], self._app, backend='streams')
+        worker.test_counts = []
+        await worker.start_task_listener()
+        try:
+            tasks = task_listener.call_tasks_many("count", [[i] for i in range(100)])
+            self.assertEqual(await gather_results(tasks, timeout=10), list(range(100)))
+        finally:
+            await worker.stop_task_listener(soft=True)
+
+class TestCpuBoundTasks(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    @gen_test(timeout=30)
+    @requires_redis
+    @requires_task_listener(process_pool_size=2)
+    async def test_cpu_bound_methods(self, task_listener):
+
+        task_listener.add_task_handler(CpuBoundTaskHandler)
+        pid, checksum = await task_listener.call_task("checksum", list(range(1000)))
+        self.assertNotEqual(pid, os.getpid())
+        self.assertEqual(checksum, sum(range(1000)) % 256)
+        with self.assertRaises(TaskError) as cm:
+            await task_listener.call_task("fails", "bad data")
+        self.assertEqual(cm.exception.exc_type_name, 'ValueError')
+        self.assertEqual(cm.exception.exc_message, 'bad data')
+
+class TestPriorityLanes(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    async def _check_lanes(self, task_listener, backend):
+
+        priorities = {'high': 3, 'normal': 1}
+        worker = TaskListener([(LaneTaskHandler,)], self._app, backend=backend,
+                              max_concurrency=1, priorities=priorities)
+        worker.test_order = []
+        await worker.start_task_listener()
+        try:
+            dispatcher = TaskDispatcher(task_listener)
+            tasks = [dispatcher.work('normal') for _ in range(20)]
+            tasks += [dispatcher.with_priority('high').work('high') for _ in range(20)]
+            await gather_results(tasks, timeout=20)
+            # once both lanes have calls waiting, three high priority calls
+            # are run for every normal one
+            first_high = worker.test_order.index('high')
+            window = worker.test_order[first_high:first_high + 20]
+            self.assertGreaterEqual(window.count('high'), 13)
+            self.assertGreaterEqual(window.count('normal'), 3)
+        finally:
+            await worker.stop_task_listener(soft=True)
+
+    @gen_test(timeout=60)
+    @requires_redis
+    @requires_task_listener(priorities={'high': 3, 'normal': 1})
+    async def test_pubsub_priority_lanes(self, task_listener):
+        await self._check_lanes(task_listener, 'pubsub')
+
+    @gen_test(timeout=60)
+    @requires_redis
+    @requires_task_listener(priorities={'high': 3, 'normal': 1}, backend='streams')
+    async def test_stream_priority_lanes(self, task_listener):
+        await self._check_lanes(task_listener, 'streams')
+
+    @gen_test
+    @requires_redis
+    @requires_task_listener
+    async def test_unknown_priority(self, task_listener):
+        with self.assertRaises(ValueError):
+            TaskDispatcher(task_listener).with_priority('high')
+        with self.assertRaises(ValueError):
+            TaskListener([], self._app, priorities={'high': 1})
+
+SHARD_OPTIONS = {'heartbeat_interval': 0.1, 'lease_timeout': 1.0, 'block_timeout': 0.1}
+
+class TestShardedTasks(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    def _worker(self):
+        worker = TaskListener([(OrderedTaskHandler,)], self._app, shards=8, consume_shards=True,
+                              shard_options=SHARD_OPTIONS)
+        worker.test_steps = {}
+        return worker
+
+    @gen_test(timeout=60)
+    @requires_redis
+    @requires_task_listener(shards=8, shard_options=SHARD_OPTIONS)
+    async def test_calls_run_in_order_per_key(self, task_listener):
+
+        workers = [self._worker() for _ in range(2)]
+        for worker in workers:
+            await worker.start_task_listener()
+        try:
+            await asyncio.sleep(0.5)
+            owned = [set(worker.get_stats()['shards']) for worker in workers]
+            self.assertEqual(owned[0] | owned[1], set(range(8)))
+            self.assertEqual(owned[0] & owned[1], set())
+
+            keys = ['0x{:040x}'.format(i) for i in range(10)]
+            tasks = [task_listener.call_task("step", key, i, shard_key=key)
+                     for i in range(20) for key in keys]
+            await gather_results(tasks, timeout=30)
+            for key in keys:
+                steps = workers[0].test_steps.get(key, []) + workers[1].test_steps.get(key, [])
+                self.assertEqual(steps, list(range(20)))
+                # each key is only handled by one worker
+                self.assertTrue(key not in workers[0].test_steps or key not in workers[1].test_steps)
+
+            # the remaining worker takes over the shards
+            await workers[1].stop_task_listener(soft=True)
+            await asyncio.sleep(0.5)
+            self.assertEqual(workers[0].get_stats()['shards'], list(range(8)))
+            workers[0].test_steps = {}
+            await gather_results([task_listener.call_task("step", key, 0, shard_key=key) for key in keys], timeout=10)
+            self.assertEqual(len(workers[0].test_steps), len(keys))
+        finally:
+            for worker in workers:
+                if not worker._shutdown_task_dispatch:
+                    await worker.stop_task_listener(soft=True)
+
+    @gen_test
+    @requires_redis
+    @requires_task_listener
+    async def test_shard_key_requires_shards(self, task_listener):
+        with self.assertRaises(ValueError):
+            task_listener.call_task("step", "key", 0, shard_key="key")
+
+    def test_shard_keys_match_database_shards(self):
+        queue = TaskListener([], None, shards=8).shard_queue
+        address = '0x{:040x}'.format(0xabcdef)
+        self.assertEqual(queue.shard_for(address.upper()), queue.shard_for(address))
+        for key in [address, 12345, b'raw']:
+            self.assertEqual(queue.shard_for(key), get_shard_index(key, 8))
+
+class TestTaskSerializer(unittest.TestCase):
+
+    def test_round_trip(self):
+        serializer = TaskSerializer(envelope=True)
+        message = ['id', 'task', 'hello', ['world'], {'priority': 'normal'}]
+        data = serializer.encode(message)
+        self.assertEqual(data[0], TaskSerializer.VERSION)
+        self.assertEqual(serializer.decode(data), message)
+
+    def test_plain_messages_by_default(self):
+        # listeners that predate the envelope can read the default format
+        message = ['id', 'task', 'hello', ['world'], {}]
+        data = TaskSerializer().encode(message)
+        self.assertEqual(data, msgpack.packb(message, use_bin_type=True, encoding="utf-8"))
+        self.assertEqual(TaskSerializer(envelope=True).decode(data), message)
+        self.assertTrue(TaskSerializer(compression_threshold=100, reference_threshold=1024).envelope)
+        with self.assertRaises(ValueError):
+            TaskSerializer(reference_threshold=1024, envelope=False)
+
+    def test_legacy_messages(self):
+        message = ['id', 'task', 'hello', ['world'], {}]
+        data = msgpack.packb(message, use_bin_type=True, encoding="utf-8")
+        self.assertEqual(TaskSerializer().decode(data), message)
+
+    def test_unknown_version(self):
+        with self.assertRaises(ValueError):
+            TaskSerializer().decode(bytes([TaskSerializer.VERSION + 1, 0]) + b'data')
+
+    def _test_compression(self, compression):
+        serializer = TaskSerializer(compression=compression, compression_threshold=100)
+        small = ['id', 'result', 'x']
+        self.assertEqual(serializer.encode(small)[1], 0)
+        large = ['id', 'result', 'x' * 10000]
+        data = serializer.encode(large)
+        self.assertNotEqual(data[1], 0)
+        self.assertLess(len(data), 1000)
+        # any listener can decode compressed messages
+        self.assertEqual(TaskSerializer().decode(data), large)
+
+    @unittest.skipIf(zstandard is None, "zstandard not installed")
+    def test_zstd_compression(self):
+        self._test_compression('zstd')
+
+    @unittest.skipIf(lz4 is None, "lz4 not installed")
+    def test_lz4_compression(self):
+        self._test_compression('lz4')
+
+class TestLargeMessages(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    @gen_test
+    @requires_redis
+    @requires_task_listener(serializer=TaskSerializer(reference_threshold=1024, reference_ttl=60))
+    async def test_large_messages_stored_by_reference(self, task_listener):
+        task_listener.add_task_handler(TestTaskHandler)
+
+        name = "x" * 10000
+        welcome = await task_listener.call_task("hello", name)
+        self.assertEqual(welcome, "hello, {}".format(name))
+
+        keys = await task_listener.aio_redis_connection_pool.keys("{}:message:*".format(task_listener.queue_name))
+        # the call and the result
+        self.assertEqual(len(keys), 2)
+        for key in keys:
+            ttl = await task_listener.aio_redis_connection_pool.ttl(key)
+            self.assertTrue(0 < ttl <= 60)
+
+    @gen_test
+    @requires_redis
+    @requires_task_listener(backend='streams', serializer=TaskSerializer(reference_threshold=1024))
+    async def test_large_calls_kept_in_stream(self, task_listener):
+        task_listener.add_task_handler(TestTaskHandler)
+
+        name = "x" * 10000
+        welcome = await task_listener.call_task("hello", name)
+        self.assertEqual(welcome, "hello, {}".format(name))
+
+        # only the result, sent over pubsub, is stored
+        keys = await task_listener.aio_redis_connection_pool.keys("{}:message:*".format(task_listener.queue_name))
+        self.assertEqual(len(keys), 1)
+
+    @gen_test
+    @requires_redis
+    @requires_task_listener(serializer=TaskSerializer(reference_threshold=1024))
+    async def test_expired_message_fails_call(self, task_listener):
+
+        task = task_listener.call_task("no_handler")
+        reference = task_listener.serializer.encode_reference(
+            "{}:message:missing".format(task_listener.queue_name), task.task_id, task_listener.reply_channel)
+        await task_listener._dispatch_stored_message(reference)
+        with self.assertRaises(TaskError) as cm:
+            await asyncio.wait_for(task, 5)
+        self.assertEqual(cm.exception.exc_type_name, 'TaskMessageExpired')
+
+class TestIdempotentCalls(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    @gen_test
+    @requires_redis
+    @requires_task_listener
+    async def test_duplicate_calls_run_once(self, task_listener):
+        task_listener.add_task_handler(IdempotentTaskHandler)
+        task_listener.test_runs = 0
+
+        # duplicates sent while the call is running attach to it
+        results = await gather_results([task_listener.call_task("expensive", 2, idempotency_key="block:1")
+                                        for _ in range(3)], timeout=5)
+        self.assertEqual(results, [4, 4, 4])
+        self.assertEqual(task_listener.test_runs, 1)
+
+        # later duplicates get the stored result
+        self.assertEqual(await task_listener.call_task("expensive", 2, idempotency_key="block:1"), 4)
+        self.assertEqual(task_listener.test_runs, 1)
+
+        self.assertEqual(await task_listener.call_task("expensive", 3, idempotency_key="block:2"), 6)
+        self.assertEqual(task_listener.test_runs, 2)
+
+    @gen_test
+    @requires_redis
+    @requires_task_listener
+    async def test_failed_calls_not_stored(self, task_listener):
+        task_listener.add_task_handler(IdempotentTaskHandler)
+        task_listener.test_runs = 0
+
+        results = await gather_results([task_listener.call_task("expensive", None, idempotency_key="block:3")
+                                        for _ in range(2)], timeout=5)
+        self.assertTrue(all(isinstance(result, TaskError) for result in results))
+        self.assertEqual(task_listener.test_runs, 1)
+
+        with self.assertRaises(TaskError):
+            await task_listener.call_task("expensive", None, idempotency_key="block:3")
+        self.assertEqual(task_listener.test_runs, 2)
+
+class TestStatelessHandlers(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    @gen_test
+    @requires_redis
+    @requires_task_listener
+    async def test_stateless_handler_reused(self, task_listener):
+        task_listener.test_instances = 0
+        task_listener.add_task_handler(StatelessTaskHandler)
+        self.assertEqual(task_listener.test_instances, 1)
+
+        results = await gather_results([task_listener.call_task("instance") for _ in range(5)], timeout=5)
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(task_listener.test_instances, 1)
+
+    @gen_test(timeout=30)
+    @requires_redis
+    @requires_task_listener(backend='streams')
+    async def test_reclaimed_call_runs_after_listener_dies(self, task_listener):
+
+        def worker():
+            worker = TaskListener([(IdempotentTaskHandler,)], self._app, idempotency_lease=0.5,
+                                  backend=lambda listener: StreamTaskQueue(
+                                      listener, claim_timeout=0.2, claim_interval=0.1))
+            worker.test_runs = 0
+            worker.test_blocker = asyncio.Event()
+            return worker
+
+        dead = worker()
+        await dead.start_task_listener()
+        task = task_listener.call_task("blocking", 1, idempotency_key="block:4")
+        while dead.test_runs == 0:
+            await asyncio.sleep(0.05)
+
+        # the listener dies without releasing the key or acknowledging the call
+        async def no_release(*args):
+            return []
+        dead._complete_idempotency_key = no_release
+        await dead.stop_task_listener()
+
+        # the redelivered call takes over the key
+        live = worker()
+        live.test_blocker.set()
+        await live.start_task_listener()
+        try:
+            self.assertEqual(await asyncio.wait_for(task, 10), 1)
+            self.assertEqual(live.test_runs, 1)
+        finally:
+            await live.stop_task_listener(soft=True)
+
+    @gen_test
+    @requires_redis
+    @requires_task_listener(idempotency_lease=0.3)
+    async def test_claim_expires_without_refresh(self, task_listener):
+
+        self.assertEqual(await task_listener._claim_idempotency_key("block:5", "a", None), ('claimed', None))
+        self.assertEqual(await task_listener._claim_idempotency_key("block:5", "b", None), ('attached', None))
+        # the same call can take the key over
+        self.assertEqual(await task_listener._claim_idempotency_key("block:5", "a", None), ('claimed', None))
+        await asyncio.sleep(0.5)
+        self.assertEqual(await task_listener._claim_idempotency_key("block:5", "b", None), ('claimed', None))
+        # the expired call can't release the new claim
+        self.assertEqual(await task_listener._complete_idempotency_key("block:5", "a"), [])
+        self.assertEqual(await task_listener._claim_idempotency_key("block:5", "c", None), ('attached', None))
@@ -12,6 +12,8 @@ class Application(tornado.web.Application):
     def __init__(self, urls, **kwargs):
 
         cookie_secret = kwargs.pop('cookie_secret', None)
+        # statements to prepare on each database connection before listening
+        self.database_warm_up_statements = kwargs.pop('database_warm_up_statements', [])
         if cookie_secret is None:
             cookie_secret = config['general'].get('cookie_secret', None)
 
@@ -41,7 +43,10 @@ class Application(tornado.web.Application):
     async def _start(self):
         if 'database' in config:
             from dgas.database import prepare_database
-            await prepare_database()
+            await prepare_database(warm_up_statements=self.database_warm_up_statements)
+        if 'database_shards' in config:
+            from dgas.database import prepare_database_shards
+            await prepare_database_shards(warm_up_statements=self.database_warm_up_statements)
         if 'redis' in config:
             from dgas.redis import prepare_redis
             await prepare_redis()
@@ -26,7 +26,9 @@ setup(
         'ethereum': [
             'ethereum==2.3.0',
             'coincurve'
-        ]
+        ],
+        'zstd': ['zstandard'],
+        'lz4': ['lz4']
     },
     tests_require=[
         'pytest',